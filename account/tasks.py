@@ -0,0 +1,90 @@
+"""
+Background tasks of the account app, run by the jobs worker
+"""
+import logging
+import uuid
+from datetime import timedelta
+
+import jwt
+import requests
+from django.utils import timezone
+
+from config import settings
+from jobs.queue import task
+from .emails import verification_email_html, reset_password_email_html, successful_reset_email_html
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+MAILGUN_URL = "https://api.mailgun.net/v3/mail.praiseafk.tech/messages"
+
+# connect and read timeouts for mailgun, in seconds
+MAILGUN_TIMEOUT = (5, 30)
+
+verification_url = "https://www.dalle-stores.praiseafk.tech/accounts/verify/{}/"
+
+password_reset_url = "https://www.dalle-stores.praiseafk.tech/accounts/create_new_password/{}/"
+
+# the emails send_email can queue, by name: (html, link the token goes in)
+EMAILS = {
+    'verification': (verification_email_html, verification_url),
+    'reset_password': (reset_password_email_html, password_reset_url),
+    'successful_reset': (successful_reset_email_html, None),
+}
+
+
+def generate_jwt(user: User) -> str:
+    """
+    returns a token carrying the user's id that expires in two minutes
+    """
+    exp_seconds = int((timezone.now() + timedelta(minutes=2)).timestamp())
+
+    # Create the payload dictionary
+    payload = {
+        "user_id": str(user.id),  # uuid object is not json serializable so convert to string
+        "iss": int(timezone.now().timestamp()),
+        "exp": exp_seconds,
+    }
+    return jwt.encode(payload, settings.JWT_KEY, algorithm='HS256')
+
+
+def mailgun_send(session: requests.Session, to: str | list[str], subject: str, html: str) -> None:
+    """
+    sends one email through mailgun, raising if mailgun doesn't accept it
+    """
+    response = session.post(
+        url=MAILGUN_URL,
+        auth=("api", settings.MAILGUN_API_KEY),
+        data={"from": "noreply@mail.praiseafk.tech",
+              "to": to,
+              "subject": subject,
+              "html": html},
+        timeout=MAILGUN_TIMEOUT)
+    response.raise_for_status()
+
+
+@task('account.send_email', batch_size=50, timeout=sum(MAILGUN_TIMEOUT))
+def send_emails(payloads: list[dict]) -> list:
+    """
+    sends a batch of queued account emails over one keep-alive connection
+    payload: {"user_id": ..., "email": one of EMAILS}
+    """
+    users = User.objects.in_bulk([uuid.UUID(payload['user_id']) for payload in payloads])
+    results = []
+    with requests.Session() as session:
+        for payload in payloads:
+            user = users.get(uuid.UUID(payload['user_id']))
+            if user is None:
+                logger.info("not sending %s, user %s no longer exists", payload['email'], payload['user_id'])
+                results.append(None)
+                continue
+
+            # the token is made at send time so its two minutes start when the email goes out
+            text, url = EMAILS[payload['email']]
+            try:
+                mailgun_send(session, user.email, f"Hey {user.get_full_name()}",
+                             text.format(url.format(generate_jwt(user)) if url else text))
+                results.append(None)
+            except requests.RequestException as e:
+                results.append(e)
+    return results
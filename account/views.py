@@ -1,7 +1,4 @@
-import requests
-from datetime import datetime, timedelta
 from django.shortcuts import render, redirect, reverse
-from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from django.contrib.auth import authenticate, login as login, logout
 from django.http import HttpResponse, JsonResponse, HttpRequest
@@ -16,7 +13,7 @@ from .forms import (
 import jwt
 from config import settings
 from .models import User
-from .emails import verification_email_html, reset_password_email_html, successful_reset_email_html
+from jobs.queue import enqueue
 import uuid
 from django.views.generic import CreateView, UpdateView
 from django.contrib.auth.mixins import LoginRequiredMixin
@@ -24,34 +21,12 @@ from django.urls import reverse_lazy
 
 
 
-verification_url = "https://www.dalle-stores.praiseafk.tech/accounts/verify/{}/"
-
-password_reset_url = "https://www.dalle-stores.praiseafk.tech/accounts/create_new_password/{}/"
-
-def send_email(user: User, text: str | None=None, url: str | None=None):
+def send_email(user: User, email: str) -> None:
     """
-    Sends emails to users.
+    Queues an email to the user, sent by the jobs worker (see account/tasks.py).
+    email names the template: 'verification', 'reset_password' or 'successful_reset'
     """
-    exp_seconds = int((timezone.now() + timedelta(minutes=2)).timestamp())
-
-    # Create the payload dictionary
-    payload = {
-        "user_id": str(user.id),  # uuid object is not json serializable so convert to string
-        "iss": int(timezone.now().timestamp()),
-        "exp": exp_seconds,
-    }
-    token = jwt.encode(payload, settings.JWT_KEY, algorithm='HS256')
-    return requests.post(
-        url="https://api.mailgun.net/v3/mail.praiseafk.tech/messages",
-        auth=("api", settings.MAILGUN_API_KEY),
-        data={"from": "noreply@mail.praiseafk.tech",
-              "to": user.email,
-              "subject": f"Hey {user.get_full_name()}",
-              "html": text.format(url.format(token) if url else text)
-              },
-        timeout=120)
-
-
+    enqueue('account.send_email', {'user_id': str(user.id), 'email': email})
 
 
 def signup(request: HttpRequest) -> HttpResponse:
@@ -64,11 +39,8 @@ def signup(request: HttpRequest) -> HttpResponse:
         form = CustomUserCreationForm(request.POST)
         if form.is_valid():
             user = form.save()
-            response = send_email(user, verification_email_html, verification_url)
-
-            # if the email was sent successfully redirect to account:verify_user
-            if response.status_code == 200:
-                return redirect("account:verify_user")
+            send_email(user, 'verification')
+            return redirect("account:verify_user")
         else:
             return render(request, 'account/signup_form.html', {'form': form})
     return render(request, 'account/signup_form.html', {'form': form})
@@ -113,11 +85,10 @@ def generate_token(request: HttpRequest, pk: str) -> JsonResponse:
     user_id = uuid.UUID(pk)
     user = get_object_or_404(User, id=user_id)
     if request.GET.get('from') == "create_new_password":
-        response = send_email(user, reset_password_email_html, password_reset_url)
+        send_email(user, 'reset_password')
     else:
-        response = send_email(user, verification_email_html, verification_url)
-    return JsonResponse(
-        {'status': 200}) if response.status_code == 200 else JsonResponse({'status': 400}, status=400)
+        send_email(user, 'verification')
+    return JsonResponse({'status': 200})
 
 def _login(request: HttpRequest) -> HttpResponse:
     """
@@ -137,17 +108,8 @@ def _login(request: HttpRequest) -> HttpResponse:
         user = authenticate(request, email=email, password=password)
 
         if _user and not _user.is_active:
-            response = generate_token(request, str(_user.id))
-            if response.status_code == 200:
-                return HttpResponse(render_to_string("account/verify_user.html", {}))
-            else:
-                messages.error(request, "Something went wrong, try again later")
-                
-                response = render(request, 'account/login_form.html', {'form': form})
-                # prevent caching of forms so that new csrf tokens are generated
-                # when the user hits the back button to a login page
-                response.headers.setdefault('Cache-Control', 'no-store')
-                return response
+            send_email(_user, 'verification')
+            return HttpResponse(render_to_string("account/verify_user.html", {}))
 
         if user is not None:
             login(request, user)
@@ -186,13 +148,9 @@ def reset_password(request: HttpRequest) -> HttpResponse:
         email = request.POST['email']
         try:
             user = get_object_or_404(User, email=email)
-            response = send_email(user, reset_password_email_html, password_reset_url)
-
-            if response.status_code == 200:
-                messages.success(request, f"sent successfully to {email}")
-                # TODO use javascript to take away the submit button
-            else:
-                messages.error(request, f"Something went wrong. Try again later")
+            send_email(user, 'reset_password')
+            messages.success(request, f"sent successfully to {email}")
+            # TODO use javascript to take away the submit button
         except User.DoesNotExist:
             messages.error(request, f"{email} is not linked to any account")
     
@@ -226,7 +184,7 @@ def create_new_password(request, token) -> HttpResponse:
                 decoded_user.save()
                 email = decoded_user.email
                 messages.success(request, f"Your password has been changed successfully")
-                send_email(decoded_user, successful_reset_email_html)
+                send_email(decoded_user, 'successful_reset')
                 logout(request)  # clear user's current session
                 return redirect("account:login")
         return render(request, 'account/create_new_password_form.html', {'form': form})
@@ -18,3 +18,22 @@ capture_output = True
 pidfile = "/var/run/gunicorn/dev.pid"
 # Daemonize the Gunicorn process (detach & enter background)
 daemon = True
+
+
+def post_worker_init(worker):
+    # cart summaries are dropped and stamps started in the cache, each worker needs to see the others'
+    from django.conf import settings
+    from django.core.exceptions import ImproperlyConfigured
+    if worker.cfg.workers > 1 and settings.CACHES['default']['BACKEND'].endswith('.LocMemCache'):
+        raise ImproperlyConfigured("set REDIS_URL, the workers can't share an in-process cache")
+    # each worker applies the cache invalidations of the others, see store/invalidation.py
+    from store.invalidation import get_bus
+    get_bus().start()
+    # after the bus, so products changed while loading are updated again, see store/catalog_index.py
+    from store.catalog_index import index
+    index.load()
+
+
+def worker_exit(server, worker):
+    from store.invalidation import get_bus
+    get_bus().stop()
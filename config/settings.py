@@ -48,6 +48,7 @@ INSTALLED_APPS = [
     # my apps
     "account.apps.AuthxConfig",
     "store.apps.StoreConfig",
+    "jobs.apps.JobsConfig",
 
     # third party
     "corsheaders",
@@ -64,6 +65,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'store.guest_cart.GuestCartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -127,6 +129,25 @@ else:
 
     }
 
+# Cache
+# shared by the gunicorn workers through redis; the in-process fallback is only
+# right for a single process (runserver, tests), as workers can't clear each
+# other's entries, so gunicorn refuses to start more than one worker on it
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -195,6 +216,7 @@ if not os.path.exists(MEDIA_ROOT):
     os.makedirs(MEDIA_ROOT)
 
 PAYSATCK_SECRETE_KEY = os.environ.get('PAYSTACK_SECRET_KEY')
+PAYSTACK_BASE_URL = os.environ.get('PAYSTACK_BASE_URL', 'https://api.paystack.co')
 
 CSRF_TRUSTED_ORIGINS = allowed_origins.split(',')
 
@@ -213,3 +235,7 @@ if USE_S3:
 
     STATIC_URL = f'https://{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com/static/'
     STATICFILES_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
+
+# SEARCH SETTINGS
+# dotted path of a store.search backend, picked from the database vendor when unset
+STORE_SEARCH_BACKEND = os.environ.get('STORE_SEARCH_BACKEND')
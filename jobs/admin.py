@@ -0,0 +1,18 @@
+from django.contrib import admin
+from .models import Job
+from .queue import requeue
+
+
+@admin.action(description="Retry the selected jobs")
+def retry_jobs(modeladmin, request, queryset):
+    requeue(queryset)
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('task', 'status', 'attempts', 'run_at', 'updated_at')
+    list_filter = ('status', 'task')
+    readonly_fields = ('last_error',)
+    actions = [retry_jobs]
+
+
+admin.site.register(Job, JobAdmin)
@@ -0,0 +1,41 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from jobs.queue import process, purge_done
+
+
+class Command(BaseCommand):
+    help = "Runs queued background jobs until stopped"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--task', action='append', dest='tasks',
+                            help="only run this task, may be repeated")
+        parser.add_argument('--limit', type=int, default=100,
+                            help="jobs claimed per round")
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help="seconds to wait when no job is due")
+        parser.add_argument('--keep-days', type=int, default=7,
+                            help="days finished jobs are kept")
+        parser.add_argument('--once', action='store_true',
+                            help="run jobs until none is due, then exit")
+
+    def handle(self, *args, **options):
+        keep = timedelta(days=options['keep_days'])
+        last_purge = 0.0
+        while True:
+            close_old_connections()
+            count = process(limit=options['limit'], task_names=options['tasks'])
+            if count and options['verbosity'] > 1:
+                self.stdout.write(f"ran {count} jobs")
+
+            if time.monotonic() - last_purge > 3600:
+                purge_done(keep)
+                last_purge = time.monotonic()
+
+            if not count:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
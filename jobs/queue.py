@@ -0,0 +1,242 @@
+"""
+A job queue kept in the database, so no broker is needed.
+
+Apps register tasks in their tasks.py:
+
+    @task('account.send_email', batch_size=50)
+    def send_emails(payloads):
+        ...
+
+and views call enqueue('account.send_email', {...}), which only inserts a
+Job row (in the caller's transaction, so a rolled back request enqueues
+nothing). The process_jobs worker claims due jobs with SELECT ... FOR UPDATE
+SKIP LOCKED, runs them a batch at a time, retries failures with exponential
+backoff and marks jobs that ran out of attempts as DEAD for inspection in
+the admin.
+
+A batched task receives a list of payloads and returns one result per
+payload: None on success or the error (an exception or message). A plain
+task receives one payload and raises to fail.
+
+A claimed job is leased to its worker, which may not run it once another
+worker took it over after the lease ran out. Before each batch the worker
+renews the leases of the jobs it still holds for as long as the batch may
+take (batch size times the task's timeout) plus LEASE, and it only records
+the outcome of jobs whose lease it still holds.
+"""
+import logging
+import random
+import traceback
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Callable
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# how long a claimed job belongs to a worker, beyond the time its batch may
+# take, before another may take it over
+LEASE = timedelta(minutes=5)
+
+
+@dataclass
+class Task:
+    name: str
+    func: Callable
+    batch_size: int = 1
+    max_attempts: int = 5
+    backoff: int = 30  # seconds before the first retry, doubled on each one
+    timeout: int = 60  # seconds one payload may take at worst, leases are sized from it
+
+    @property
+    def batched(self) -> bool:
+        return self.batch_size > 1
+
+
+tasks: dict[str, Task] = {}
+
+
+def task(name: str, batch_size: int = 1, max_attempts: int = 5, backoff: int = 30, timeout: int = 60):
+    """
+    registers the decorated function as the task `name`
+    """
+    def register(func):
+        tasks[name] = Task(name, func, batch_size, max_attempts, backoff, timeout)
+        return func
+    return register
+
+
+def enqueue(name: str, payload: dict | None = None, run_at=None) -> Job:
+    """
+    queues a run of the task `name` with payload, as soon as possible or at run_at
+    """
+    registered = tasks.get(name)
+    return Job.objects.create(task=name,
+                              payload=payload or {},
+                              run_at=run_at or timezone.now(),
+                              max_attempts=registered.max_attempts if registered else 5)
+
+
+def requeue(queryset) -> int:
+    """
+    makes dead or failed jobs due again with a fresh set of attempts
+    """
+    return queryset.update(status=Job.PENDING, attempts=0, run_at=timezone.now(),
+                           locked_until=None, last_error='', updated_at=timezone.now())
+
+
+def claim(limit: int, task_names=None) -> list[Job]:
+    """
+    takes up to limit due jobs, including ones whose worker's lease ran out,
+    skipping rows other workers are claiming at the same time
+    """
+    now = timezone.now()
+    due = Job.objects.filter(Q(status=Job.PENDING, run_at__lte=now) |
+                             Q(status=Job.RUNNING, locked_until__lt=now))
+    if task_names:
+        due = due.filter(task__in=task_names)
+
+    with transaction.atomic():
+        ids = list(due.select_for_update(skip_locked=True).order_by('run_at').values_list('id', flat=True)[:limit])
+        if not ids:
+            return []
+        Job.objects.filter(id__in=ids).update(status=Job.RUNNING,
+                                              locked_until=now + LEASE,
+                                              attempts=F('attempts') + 1,
+                                              updated_at=now)
+    return list(Job.objects.filter(id__in=ids).order_by('run_at'))
+
+
+def _held(jobs: list[Job]) -> Q:
+    """
+    matches the jobs whose lease is still the one this worker holds
+    """
+    held = Q(pk__in=[])
+    for locked_until in {job.locked_until for job in jobs}:
+        held |= Q(id__in=[job.id for job in jobs if job.locked_until == locked_until], locked_until=locked_until)
+    return held
+
+
+def renew(jobs: list[Job], duration: timedelta) -> list[Job]:
+    """
+    extends the leases of the jobs to duration from now
+    returns the jobs this worker still holds, the others were taken over
+    after their lease ran out
+    """
+    if not jobs:
+        return []
+    now = timezone.now()
+    lease = now + duration
+    Job.objects.filter(_held(jobs), status=Job.RUNNING).update(locked_until=lease, updated_at=now)
+    renewed = set(Job.objects.filter(id__in=[job.id for job in jobs], locked_until=lease)
+                  .values_list('id', flat=True))
+    held = []
+    for job in jobs:
+        if job.id in renewed:
+            job.locked_until = lease
+            held.append(job)
+        else:
+            logger.warning("job %s of %s was taken over by another worker, not running it", job.id, job.task)
+    return held
+
+
+def _run(registered: Task, jobs: list[Job]) -> list:
+    """
+    runs the task over jobs, returning one error (or None) per job
+    """
+    if registered.batched:
+        try:
+            results = list(registered.func([job.payload for job in jobs]))
+        except Exception as e:
+            return [e] * len(jobs)
+        if len(results) != len(jobs):
+            return [RuntimeError(f'{registered.name} returned {len(results)} results for {len(jobs)} jobs')] * len(jobs)
+        return results
+
+    results = []
+    for job in jobs:
+        try:
+            registered.func(job.payload)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _describe(error) -> str:
+    if isinstance(error, BaseException):
+        return ''.join(traceback.format_exception(error))[-4000:]
+    return str(error)
+
+
+def _finish(jobs: list[Job], errors: list, backoff: int) -> None:
+    """
+    records the outcome of the jobs whose lease this worker still holds
+    """
+    now = timezone.now()
+    done = [job for job, error in zip(jobs, errors) if error is None]
+    if done:
+        finished = Job.objects.filter(_held(done)).update(status=Job.DONE, locked_until=None,
+                                                          last_error='', updated_at=now)
+        if finished < len(done):
+            logger.warning("%s jobs of %s lost their lease while running", len(done) - finished, done[0].task)
+
+    for job, error in zip(jobs, errors):
+        if error is None:
+            continue
+        logger.warning("job %s of %s failed (attempt %s): %s", job.id, job.task, job.attempts, error)
+        if job.attempts >= job.max_attempts:
+            status, run_at = Job.DEAD, job.run_at
+        else:
+            # exponential backoff with jitter so failed batches don't retry in lockstep
+            delay = backoff * 2 ** (job.attempts - 1)
+            status, run_at = Job.PENDING, now + timedelta(seconds=delay * random.uniform(1, 1.25))
+        Job.objects.filter(id=job.id, locked_until=job.locked_until).update(
+            status=status, run_at=run_at, locked_until=None, last_error=_describe(error), updated_at=now)
+
+
+def process(limit: int = 100, task_names=None) -> int:
+    """
+    claims due jobs and runs them, grouped into batches per task
+    returns the number of jobs run
+    """
+    jobs = claim(limit, task_names)
+    by_task = defaultdict(list)
+    for job in jobs:
+        by_task[job.task].append(job)
+
+    batches = []
+    for name, task_jobs in by_task.items():
+        registered = tasks.get(name)
+        if registered is None:
+            for job in task_jobs:
+                job.attempts = job.max_attempts
+            _finish(task_jobs, [f'no task named {name}'] * len(task_jobs), 0)
+            continue
+        for start in range(0, len(task_jobs), registered.batch_size):
+            batches.append((registered, task_jobs[start:start + registered.batch_size]))
+
+    waiting = [job for _, batch in batches for job in batch]
+    for registered, batch in batches:
+        # every job still waiting must stay ours while this batch runs
+        waiting = renew(waiting, LEASE + timedelta(seconds=registered.timeout * len(batch)))
+        held = {job.id for job in waiting}
+        batch = [job for job in batch if job.id in held]
+        if batch:
+            _finish(batch, _run(registered, batch), registered.backoff)
+        waiting = [job for job in waiting if job not in batch]
+    return len(jobs)
+
+
+def purge_done(older_than: timedelta) -> int:
+    """
+    deletes jobs that finished before older_than ago
+    """
+    deleted, _ = Job.objects.filter(status=Job.DONE, updated_at__lt=timezone.now() - older_than).delete()
+    return deleted
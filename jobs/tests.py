@@ -0,0 +1,190 @@
+import threading
+from datetime import timedelta
+from unittest import mock, skipUnless
+
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from jobs import queue
+from jobs.models import Job
+
+
+class QueueTestCase(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(queue.tasks)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ran = []
+
+    def register(self, name, func=None, **options):
+        queue.task(name, **options)(func or self.ran.append)
+
+    def expire(self, *jobs):
+        Job.objects.filter(pk__in=[job.pk for job in jobs]).update(locked_until=timezone.now() - timedelta(seconds=1))
+
+
+class LeaseTests(QueueTestCase):
+
+    def test_expired_leases_are_taken_over_and_the_old_worker_records_nothing(self):
+        self.register('jobs.echo')
+        job = queue.enqueue('jobs.echo', {'n': 1})
+        [claimed] = queue.claim(10)
+        self.assertEqual(queue.claim(10), [])
+
+        self.expire(job)
+        [taken] = queue.claim(10)
+        self.assertEqual(taken.attempts, 2)
+
+        # the first worker finishing late doesn't overwrite the new lease
+        queue._finish([claimed], [None], 30)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_until), (Job.RUNNING, taken.locked_until))
+        queue._finish([taken], [None], 30)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+
+    def test_leases_are_renewed_for_each_batch(self):
+        jobs = [queue.enqueue('jobs.slow', {'n': n}) for n in range(3)]
+
+        def slow(payload):
+            if payload['n'] == 0:
+                # another worker takes over the last job while the first batch runs
+                self.expire(jobs[2])
+                queue.claim(10)
+            self.ran.append(payload)
+        self.register('jobs.slow', slow, timeout=600)
+
+        started = timezone.now()
+        self.assertEqual(queue.process(), 3)
+        self.assertEqual(self.ran, [{'n': 0}, {'n': 1}])
+        statuses = dict(Job.objects.values_list('payload__n', 'status'))
+        self.assertEqual(statuses, {0: Job.DONE, 1: Job.DONE, 2: Job.RUNNING})
+        # the lease of the job another worker took over is theirs
+        self.assertLess(Job.objects.get(pk=jobs[2].pk).locked_until, started + queue.LEASE + timedelta(seconds=60))
+
+    def test_leases_cover_the_batch(self):
+        job = queue.enqueue('jobs.batch', {})
+        leases = []
+
+        def record(payloads):
+            leases.append(Job.objects.get(pk=job.pk).locked_until)
+            return [None] * len(payloads)
+        self.register('jobs.batch', record, batch_size=50, timeout=35)
+
+        queue.process()
+        self.assertGreater(leases[0], timezone.now() + queue.LEASE + timedelta(seconds=30))
+
+
+class ClaimTests(QueueTestCase):
+
+    def test_claims_due_jobs_once(self):
+        due = queue.enqueue('jobs.echo')
+        queue.enqueue('jobs.echo', run_at=timezone.now() + timedelta(hours=1))
+        queue.enqueue('jobs.other')
+
+        claimed = queue.claim(10, task_names=['jobs.echo'])
+        self.assertEqual([job.pk for job in claimed], [due.pk])
+        self.assertEqual((claimed[0].status, claimed[0].attempts), (Job.RUNNING, 1))
+        # another worker polling now finds nothing of the task
+        self.assertEqual(queue.claim(10, task_names=['jobs.echo']), [])
+
+
+@skipUnless(connection.features.has_select_for_update_skip_locked, "the database can't skip locked rows")
+class SkipLockedClaimTests(TransactionTestCase):
+    """
+    another worker's claim holds its rows in its own transaction
+    """
+
+    def test_rows_locked_by_another_claim_are_skipped(self):
+        locked, free = queue.enqueue('jobs.echo'), queue.enqueue('jobs.echo', run_at=timezone.now())
+        ready, release = threading.Event(), threading.Event()
+
+        def other_worker():
+            try:
+                with transaction.atomic():
+                    list(Job.objects.select_for_update().filter(pk=locked.pk))
+                    ready.set()
+                    release.wait(5)
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        ready.wait(5)
+        try:
+            claimed = queue.claim(10)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual([job.pk for job in claimed], [free.pk])
+
+
+class RetryTests(QueueTestCase):
+
+    def fail(self, payload):
+        raise ValueError('mailgun said no')
+
+    def test_failures_retry_with_backoff(self):
+        self.register('jobs.flaky', self.fail, backoff=30)
+        job = queue.enqueue('jobs.flaky')
+        before = timezone.now()
+        queue.process()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.locked_until), (Job.PENDING, 1, None))
+        self.assertIn('mailgun said no', job.last_error)
+        self.assertGreaterEqual(job.run_at, before + timedelta(seconds=30))
+        self.assertLessEqual(job.run_at, timezone.now() + timedelta(seconds=30 * 1.25))
+
+        # not due yet, then twice as long after the second failure
+        self.assertEqual(queue.process(), 0)
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        before = timezone.now()
+        queue.process()
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 2)
+        self.assertGreaterEqual(job.run_at, before + timedelta(seconds=60))
+
+    def test_jobs_out_of_attempts_are_dead(self):
+        self.register('jobs.flaky', self.fail, max_attempts=2)
+        job = queue.enqueue('jobs.flaky')
+        for _ in range(2):
+            Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+            queue.process()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.DEAD, 2))
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        self.assertEqual(queue.process(), 0)
+
+        queue.requeue(Job.objects.filter(pk=job.pk))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.PENDING, 0))
+
+    def test_batches_fail_per_payload(self):
+        self.register('jobs.batch', lambda payloads: [None if payload['ok'] else 'bounced' for payload in payloads],
+                      batch_size=10)
+        good, bad = queue.enqueue('jobs.batch', {'ok': True}), queue.enqueue('jobs.batch', {'ok': False})
+        self.assertEqual(queue.process(), 2)
+        self.assertEqual(Job.objects.get(pk=good.pk).status, Job.DONE)
+        self.assertEqual(Job.objects.get(pk=bad.pk).last_error, 'bounced')
+
+    def test_unknown_tasks_are_dead_at_once(self):
+        job = queue.enqueue('jobs.missing')
+        queue.process()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.last_error), (Job.DEAD, 'no task named jobs.missing'))
+
+
+class PurgeTests(QueueTestCase):
+
+    def test_purges_only_old_finished_jobs(self):
+        self.register('jobs.echo')
+        old, recent = queue.enqueue('jobs.echo'), queue.enqueue('jobs.echo')
+        queue.process()
+        dead = queue.enqueue('jobs.missing')
+        queue.process()
+        Job.objects.filter(pk__in=[old.pk, dead.pk]).update(updated_at=timezone.now() - timedelta(days=8))
+
+        self.assertEqual(queue.purge_done(timedelta(days=7)), 1)
+        self.assertEqual(set(Job.objects.values_list('pk', flat=True)), {recent.pk, dead.pk})
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django import forms
 from .forms import ProductForm, CategoryForm, GenderForm
-from .models import Product, Size, Category, Gender, Order, OrderItem, CartItem, Product_Image, Review, Like
+from .models import Product, Size, Category, Gender, Order, OrderItem, CartItem, Product_Image, Review, Like, PaymentEvent, StockMovement
 
 class SizeInlineFormSet(forms.BaseInlineFormSet):
     def clean(self):
@@ -79,4 +79,4 @@ admin.site.register(Category, CategoryAdmin)
 admin.site.register(Gender, GenderAdmin)
 admin.site.register(Size, SizeAdmin)
 admin.site.register(Product_Image, ProductImageAdmin)
-admin.site.register((Order, OrderItem, CartItem, Review, Like))
+admin.site.register((Order, OrderItem, CartItem, Review, Like, PaymentEvent, StockMovement))
@@ -6,4 +6,7 @@ class StoreConfig(AppConfig):
     name = 'store'
 
     def ready(self):
-        from . import signals
\ No newline at end of file
+        from . import catalog_index, fragments, query_cache, signals
+        query_cache.connect_signals()
+        catalog_index.connect()
+        fragments.connect()
\ No newline at end of file
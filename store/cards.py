@@ -0,0 +1,143 @@
+"""
+Maintenance of the ProductCard read model.
+
+Each write path only touches the card columns it affects:
+
+    Product saved             -> name, brand, description, price, stock and
+                                 review_count, which mirrors total_reviews
+    Product_Image changed     -> thumbnail
+    OrderItem created/deleted -> units_sold (sum of ordered quantities),
+                                 add_units_sold_many() for bulk created orders
+    Review created/deleted    -> review_count
+
+rebuild_cards() recomputes every card from the source tables.
+"""
+from django.db.models import Case, CharField, Count, Exists, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils.text import Truncator
+
+from . import ledger
+from .models import OrderItem, Product, Product_Image, ProductCard, Review
+
+DESCRIPTION_LENGTH = ProductCard._meta.get_field('description').max_length
+
+PRODUCT_FIELDS = ['name', 'brand', 'description', 'unit_price', 'in_stock', 'review_count', 'updated_at']
+
+
+def _card(product: Product, **extra) -> ProductCard:
+    return ProductCard(product_id=product.pk,
+                       name=product.name,
+                       brand=product.brand,
+                       description=Truncator(product.description).chars(DESCRIPTION_LENGTH),
+                       unit_price=product.unit_price,
+                       in_stock=product.in_stock,
+                       review_count=product.total_reviews,
+                       **extra)
+
+
+def update_card(product: Product) -> None:
+    """
+    upserts the product's columns of its card
+    """
+    ProductCard.objects.bulk_create([_card(product)],
+                                    update_conflicts=True,
+                                    unique_fields=['product'],
+                                    update_fields=PRODUCT_FIELDS)
+
+
+def card(product: Product) -> ProductCard:
+    """
+    returns the product's card, building it first if it hasn't been yet
+    """
+    try:
+        return product.card
+    except ProductCard.DoesNotExist:
+        update_card(product)
+        refresh_thumbnail(product.pk)
+        product.card = ProductCard.objects.get(product_id=product.pk)
+        return product.card
+
+
+def refresh_thumbnail(product_id) -> None:
+    """
+    points the card at the product's first image
+    """
+    first_image = Product_Image.objects.filter(product_id=product_id).order_by('pk').values('image')[:1]
+    ProductCard.objects.filter(product_id=product_id).update(
+        thumbnail=Coalesce(Subquery(first_image), Value(''), output_field=CharField()))
+
+
+def add_units_sold(product_id, quantity: int) -> None:
+    ProductCard.objects.filter(product_id=product_id).update(
+        units_sold=Greatest(F('units_sold') + quantity, 0))
+
+
+def add_units_sold_many(quantities: dict) -> None:
+    """
+    add_units_sold for many products in one statement, for order items
+    written with bulk_create (which sends no post_save)
+    """
+    if not quantities:
+        return
+    added = Case(*[When(product_id=product_id, then=Value(quantity)) for product_id, quantity in quantities.items()],
+                 default=Value(0), output_field=IntegerField())
+    ProductCard.objects.filter(product_id__in=quantities).update(units_sold=Greatest(F('units_sold') + added, 0))
+
+
+def add_reviews(product_id, count: int) -> None:
+    ProductCard.objects.filter(product_id=product_id).update(
+        review_count=Greatest(F('review_count') + count, 0))
+
+
+def sync_stock(product_ids) -> None:
+    """
+    recomputes in_stock of the products' cards, after their stock moved
+    """
+    ProductCard.objects.filter(product_id__in=product_ids).update(
+        in_stock=Exists(ledger.in_stock(Product.objects.filter(pk=OuterRef('product_id')))))
+
+
+def sync_review_counts(product_ids) -> None:
+    """
+    copies total_reviews of the products onto their cards
+    """
+    total_reviews = Product.objects.filter(pk=OuterRef('product_id')).values('total_reviews')[:1]
+    ProductCard.objects.filter(product_id__in=product_ids).update(review_count=Subquery(total_reviews))
+
+
+def rebuild_cards(batch_size: int = 2000) -> int:
+    """
+    recomputes every card from the product, image, order item and review
+    tables with one query per batch of products
+    returns the number of cards written
+    """
+    first_image = Product_Image.objects.filter(product=OuterRef('pk')).order_by('pk').values('image')[:1]
+    units_sold = (OrderItem.objects.filter(product=OuterRef('pk')).order_by()
+                  .values('product').annotate(total=Sum('quantity')).values('total'))
+    reviews = (Review.objects.filter(product=OuterRef('pk')).order_by()
+               .values('product').annotate(total=Count('pk')).values('total'))
+    products = ledger.with_stock(Product.objects.order_by()).annotate(
+        card_thumbnail=Coalesce(Subquery(first_image), Value(''), output_field=CharField()),
+        card_units_sold=Coalesce(Subquery(units_sold, output_field=IntegerField()), 0),
+        card_reviews=Coalesce(Subquery(reviews, output_field=IntegerField()), 0),
+    )
+
+    count = 0
+    batch = []
+    for product in products.iterator(chunk_size=batch_size):
+        product.total_reviews = product.card_reviews
+        batch.append(_card(product, thumbnail=product.card_thumbnail, units_sold=product.card_units_sold))
+        if len(batch) == batch_size:
+            count += _write(batch)
+            batch = []
+    if batch:
+        count += _write(batch)
+    return count
+
+
+def _write(cards: list) -> int:
+    ProductCard.objects.bulk_create(cards,
+                                    update_conflicts=True,
+                                    unique_fields=['product'],
+                                    update_fields=PRODUCT_FIELDS + ['thumbnail', 'units_sold'])
+    return len(cards)
@@ -0,0 +1,245 @@
+"""
+Cart writes.
+
+A cart holds one row per (user, product, size), enforced by the
+cartitem_unique_line constraint. change_quantity writes a line with a
+single INSERT ... ON CONFLICT DO UPDATE, so a double click can't create a
+second row. The update only happens if the whole increase fits within
+the size's available stock (read just before), so whether the line moved
+comes from the statement itself rather than from a quantity read before it:
+
+    INSERT INTO cartitem (...) VALUES (...)
+    ON CONFLICT (user_id, product_id, size) DO UPDATE
+    SET quantity = cartitem.quantity + delta
+    WHERE cartitem.quantity + delta <= available
+    RETURNING id, quantity, created_at = updated_at
+
+A decrease never starts a line, it is a plain UPDATE of the existing one:
+
+    UPDATE cartitem SET quantity = quantity + delta
+    WHERE user_id = ... AND product_id = ... AND size = ... AND quantity + delta >= 1
+    RETURNING id, quantity
+
+cart_summary() gives a cart's line count, quantity and price from one
+aggregate query, cached per user until the next write to their cart or to
+one of its products (a price change, a sell-out, compaction), which gives
+the product a new version stamp (fragments.py).
+"""
+import uuid
+from dataclasses import dataclass
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+
+from . import fragments, ledger
+from .models import CartItem, Size
+from .reservations import available_sizes, with_available_stock
+
+
+@dataclass
+class CartChange:
+    id: uuid.UUID
+    quantity: int
+    # the quantity didn't move by the whole delta, stock or the minimum of 1 stopped it
+    limited: bool
+
+
+# the cached summary is dropped on every cart write and checked against its
+# products' stamps, this only bounds memory of idle carts
+SUMMARY_TIMEOUT = 60 * 5
+
+
+@dataclass
+class CartSummary:
+    lines: int = 0
+    quantity: int = 0
+    total_price: int = 0
+
+
+def _summary_key(user_id) -> str:
+    return f'store:cart-summary:{user_id}'
+
+
+def cart_summary(user) -> CartSummary:
+    """
+    totals of the user's cart lines whose products are in stock
+    """
+    key = _summary_key(user.pk)
+    cached = cache.get(key)
+    if cached is not None:
+        summary, stamps = cached
+        if fragments.versions(stamps) == stamps:
+            return summary
+
+    # the stamps before the totals, so a write in between leaves them stale
+    stamps = fragments.versions(set(CartItem.objects.filter(user=user).order_by().values_list('product_id', flat=True)))
+    totals = (ledger.in_stock(CartItem.objects.filter(user=user), 'product')
+              .aggregate(lines=Count('pk'),
+                         total_quantity=Sum('quantity'),
+                         total_price=Sum(F('quantity') * F('product__unit_price'))))
+    summary = CartSummary(totals['lines'], totals['total_quantity'] or 0, totals['total_price'] or 0)
+    cache.set(key, (summary, stamps), SUMMARY_TIMEOUT)
+    return summary
+
+
+def forget_summary(user_id) -> None:
+    """
+    drops the user's cached summary, after a write to their cart
+    """
+    key = _summary_key(user_id)
+    cache.delete(key)
+    # again once the write commits, in case a read cached the old totals meanwhile
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def with_available(queryset):
+    """
+    annotates cart items with `available`, the stock of their size
+    """
+    available = available_sizes(OuterRef('product_id')).filter(size=OuterRef('size')).values('available')[:1]
+    return queryset.annotate(available=Subquery(available))
+
+
+def reconcile_cart(user) -> list[CartItem]:
+    """
+    the user's cart lines with their products, cards and the products' stock,
+    squared with stock in a fixed number of queries: lines whose size is no longer sold are
+    deleted and lines above their size's available stock are clamped to it
+    """
+    lines = list(ledger.with_stock(with_available(CartItem.objects.filter(user=user)), 'product')
+                 .select_related('product__card'))
+
+    gone = [line.pk for line in lines if line.available is None]
+    if gone:
+        CartItem.objects.filter(pk__in=gone).delete()
+
+    lines = [line for line in lines if line.available is not None]
+    # a line that can't have any stock right now (all of it held by buyers
+    # paying) stays as it is, checkout will tell
+    over = [line for line in lines if 1 <= line.available < line.quantity]
+    if over:
+        for line in over:
+            line.quantity = line.available
+        CartItem.objects.bulk_update(over, ['quantity'])
+        forget_summary(user.pk)
+    return lines
+
+
+def merge_lines(user, lines: dict) -> int:
+    """
+    adds {(product id, size): quantity} lines (a guest cart) to the user's
+    cart, each capped at its size's available stock, with one read and one
+    bulk upsert; lines of sizes no longer sold are dropped
+    returns the number of lines written
+    """
+    if not lines:
+        return 0
+    match = Q()
+    for product_id, size in lines:
+        match |= Q(product_id=product_id, size=size)
+    in_cart = CartItem.objects.filter(user=user, product_id=OuterRef('product_id'), size=OuterRef('size'))
+    sizes = (with_available_stock(Size.objects.filter(match))
+             .annotate(in_cart=Subquery(in_cart.values('quantity')[:1]))
+             .values_list('product_id', 'size', 'available', 'in_cart'))
+
+    merged = []
+    for product_id, size, available, current in sizes:
+        quantity = min((current or 0) + lines[product_id, size], available)
+        if quantity >= 1:
+            merged.append(CartItem(user=user, product_id=product_id, size=size, quantity=quantity))
+    CartItem.objects.bulk_create(merged, update_conflicts=True, unique_fields=['user', 'product', 'size'],
+                                 update_fields=['quantity', 'updated_at'])
+    forget_summary(user.pk)
+    return len(merged)
+
+
+def available_stock(product_id, size: str) -> int:
+    """
+    the available stock of the product's size, 0 if it isn't sold
+    """
+    return available_sizes(product_id).filter(size=size).values_list('available', flat=True).first() or 0
+
+
+def _upsert_sql() -> str:
+    quote = connection.ops.quote_name
+    opts = CartItem._meta
+    table = quote(opts.db_table)
+    column = {name: quote(opts.get_field(name).column)
+              for name in ('id', 'user', 'product', 'size', 'quantity', 'created_at', 'updated_at')}
+    return (
+        f"INSERT INTO {table} ({column['id']}, {column['user']}, {column['product']}, {column['size']}, "
+        f"{column['quantity']}, {column['created_at']}, {column['updated_at']}) "
+        f"VALUES (%s, %s, %s, %s, %s, %s, %s) "
+        f"ON CONFLICT ({column['user']}, {column['product']}, {column['size']}) DO UPDATE "
+        f"SET {column['quantity']} = {table}.{column['quantity']} + %s, "
+        f"{column['updated_at']} = EXCLUDED.{column['updated_at']} "
+        f"WHERE {table}.{column['quantity']} + %s <= %s "
+        # an inserted row has the same timestamps, an updated one keeps its created_at
+        f"RETURNING {column['id']}, {column['quantity']}, "
+        f"{column['created_at']} = {column['updated_at']}"
+    )
+
+
+def _decrease_sql() -> str:
+    quote = connection.ops.quote_name
+    opts = CartItem._meta
+    table = quote(opts.db_table)
+    column = {name: quote(opts.get_field(name).column)
+              for name in ('id', 'user', 'product', 'size', 'quantity', 'updated_at')}
+    return (
+        f"UPDATE {table} SET {column['quantity']} = {column['quantity']} + %s, {column['updated_at']} = %s "
+        f"WHERE {column['user']} = %s AND {column['product']} = %s AND {column['size']} = %s "
+        f"AND {column['quantity']} + %s >= 1 "
+        f"RETURNING {column['id']}, {column['quantity']}"
+    )
+
+
+def change_quantity(user, product_id, size: str, delta: int, available: int) -> CartChange | None:
+    """
+    adds delta (which may be negative) to the user's line of product in size,
+    creating the line if need be on an increase; an increase past available or
+    a decrease below 1 leaves the line as it is and is reported as limited
+    returns None when there is no line and, for an increase, no stock to start one from
+    """
+    opts = CartItem._meta
+    now = timezone.now()
+    line_key = [
+        opts.get_field('user').get_db_prep_value(user.pk, connection),
+        opts.get_field('product').get_db_prep_value(product_id, connection),
+        size,
+    ]
+    updated_at = opts.get_field('updated_at').get_db_prep_value(now, connection)
+    row = None
+    if delta < 0:
+        # never the upsert, whose INSERT arm would start a removed line again at 1
+        with connection.cursor() as cursor:
+            cursor.execute(_decrease_sql(), [delta, updated_at, *line_key, delta])
+            row = cursor.fetchone()
+        row = row and (*row, False)
+    elif available >= 1:
+        params = [
+            opts.get_field('id').get_db_prep_value(uuid.uuid4(), connection),
+            *line_key,
+            max(min(delta, available), 1),
+            opts.get_field('created_at').get_db_prep_value(now, connection),
+            updated_at,
+            delta,
+            delta,
+            available,
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(_upsert_sql(), params)
+            row = cursor.fetchone()
+    if row is None:
+        # the move didn't fit or there is no line, which stays as it was
+        line = CartItem.objects.filter(user=user, product_id=product_id, size=size).values_list('id', 'quantity')
+        line = line.first()
+        return CartChange(line[0], line[1], True) if line else None
+
+    line_id, quantity, inserted = row
+    # raw sql sends no signals
+    forget_summary(user.pk)
+    # a new line starts at delta, capped at available
+    return CartChange(opts.get_field('id').to_python(line_id), quantity, bool(inserted) and quantity != delta)
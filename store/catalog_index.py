@@ -0,0 +1,418 @@
+"""
+An in-memory bitmap index of the catalog's facets (see facets.py), so
+filter combinations are resolved in the worker rather than in SQL.
+
+Every product has a rank, its position in the listing order (name, brand,
+id) as the database sorts it, collation included, so cursors mean the same
+here and in SQL. Each facet value has a bitmap, a numpy bool array whose
+item r is set when the product ranked r has the value, so:
+
+    a filter          AND across facets of the OR of each facet's selected values
+    a page            the next set items after the cursor's rank
+    drill-down counts the set items of each value's bitmap ANDed with the matches
+
+None of these touch the database; only the page's products are read, by
+primary key. A bitmap takes a byte per product, 1MB per value at a million
+products.
+
+Python can't compare keys the way the database does, so the index never
+sorts or bisects them. load() reads the products in the database's order;
+a cursor's product is found by id; and where a product (re)enters the
+order, or a cursor's product is gone, the database names the products
+just before it, and the rank follows the nearest one indexed.
+
+Workers load the index when they start (config.py), and until then
+listings filter in SQL. facets.refresh() and forget() report the products
+they change: this worker updates them once the transaction commits, and
+the other workers hear about them through the invalidation bus
+(invalidation.py). An update re-reads the products and their facet rows by
+primary key. It sets or clears their item in every bitmap in place; when
+ranks move (products added, deleted or renamed) every bitmap is copied
+once for all of them, and changed() updates a transaction's products
+together.
+"""
+import threading
+import uuid
+from collections import defaultdict
+
+import numpy as np
+from django.db import transaction
+
+from . import facets, invalidation
+from .models import Product, ProductFacet
+from .pagination import KeysetPaginator
+
+# the name of an invalidation that reloads the whole index
+RELOAD = '*'
+
+# the listing order, see ProductListView
+ORDERING = ('name', 'brand', 'id')
+
+# products read before a key to find an indexed one to rank it after
+NEIGHBOURS = 50
+
+
+def _key(name: str, brand: str, product_id) -> tuple:
+    # the product's values in a cursor, see pagination.py
+    return (name, brand, str(product_id))
+
+
+def _uuid(product_id) -> uuid.UUID:
+    return product_id if isinstance(product_id, uuid.UUID) else uuid.UUID(str(product_id))
+
+
+def _before(key) -> list:
+    """
+    the ids of the products just before key in the database's order, nearest first
+    """
+    return KeysetPaginator(Product.objects.values_list('pk', flat=True), NEIGHBOURS - 1, ORDERING).fetch(
+        list(key), backwards=True)
+
+
+class CatalogIndex:
+
+    def __init__(self):
+        self.keys = []  # the products' listing keys, in rank order
+        self.ids = []  # their ids, in rank order
+        self.keys_by_id = {}
+        self._ranks = {}  # id -> rank, None once ranks moved until next needed
+        self.bitmaps = {}  # (facet, value) -> bool array, one item per rank
+        self.loaded = False
+        self._loading = False
+        # products changed while loading, updated again once loaded
+        self._pending = set()
+        self._lock = threading.RLock()
+
+    def load(self, chunk_size: int = 5000) -> int:
+        """
+        (re)builds the index from the products and their facet rows
+        returns the number of products
+        """
+        with self._lock:
+            self._loading = True
+            self._pending.clear()
+        try:
+            keys, ids = [], []
+            for pk, name, brand in (Product.objects.order_by(*ORDERING).values_list('pk', 'name', 'brand')
+                                    .iterator(chunk_size)):
+                keys.append(_key(name, brand, pk))
+                ids.append(pk)
+            rank = {pk: r for r, pk in enumerate(ids)}
+
+            # ranks are set a chunk at a time, a list of every row's would take more than the bitmaps
+            bitmaps = {}
+            ranks = defaultdict(list)
+
+            def set_ranks():
+                for value, found in ranks.items():
+                    bitmaps.setdefault(value, np.zeros(len(ids), dtype=bool))[found] = True
+                ranks.clear()
+
+            for count, (product_id, facet, value) in enumerate(
+                    ProductFacet.objects.order_by().values_list('product_id', 'facet', 'value').iterator(chunk_size),
+                    start=1):
+                r = rank.get(product_id)
+                if r is not None:  # else added since the products were read, it's pending
+                    ranks[facet, value].append(r)
+                if count % chunk_size == 0:
+                    set_ranks()
+            set_ranks()
+        except BaseException:
+            with self._lock:
+                self._loading = False
+            raise
+
+        with self._lock:
+            self.keys, self.ids, self.bitmaps = keys, ids, bitmaps
+            self.keys_by_id = dict(zip(ids, keys))
+            self._ranks = rank
+            self.loaded = True
+            self._loading = False
+            pending, self._pending = self._pending, set()
+        self.update(pending)
+        return len(ids)
+
+    def __contains__(self, product_id) -> bool:
+        with self._lock:
+            return _uuid(product_id) in self.keys_by_id
+
+    def update(self, product_ids) -> None:
+        """
+        brings the products in line with the database, two queries and one
+        more per product added or renamed; ranks move once for them all
+        """
+        product_ids = {_uuid(product_id) for product_id in product_ids}
+        with self._lock:
+            if self._loading:
+                self._pending |= product_ids
+            if not self.loaded or not product_ids:
+                return
+            known = {product_id: self.keys_by_id.get(product_id) for product_id in product_ids}
+
+        # in the database's order, so each product is placed after the ones before it
+        keys = {pk: _key(name, brand, pk) for pk, name, brand in
+                Product.objects.filter(pk__in=product_ids).order_by(*ORDERING).values_list('pk', 'name', 'brand')}
+        values = defaultdict(set)
+        for product_id, facet, value in (ProductFacet.objects.filter(product_id__in=product_ids)
+                                         .values_list('product_id', 'facet', 'value')):
+            values[product_id].add((facet, value))
+        before = {product_id: _before(key) for product_id, key in keys.items() if known[product_id] != key}
+
+        with self._lock:
+            moved = {product_id for product_id in product_ids if self.keys_by_id.get(product_id) != keys.get(product_id)}
+            for product_id in keys.keys() - moved:
+                self._set(self._rank(product_id), values[product_id])
+            self._remove([product_id for product_id in moved if product_id in self.keys_by_id])
+            for product_id in moved & keys.keys() - before.keys():
+                # placed by another update meanwhile, rare enough to read under the lock
+                before[product_id] = _before(keys[product_id])
+            self._insert([(product_id, keys[product_id], before[product_id], values[product_id])
+                          for product_id in keys if product_id in moved])
+
+    def _rank(self, product_id) -> int | None:
+        if self._ranks is None:
+            self._ranks = {pk: r for r, pk in enumerate(self.ids)}
+        return self._ranks.get(product_id)
+
+    def _set(self, r: int, values: set) -> None:
+        # one item of each bitmap, whichever values the product had
+        for value in values - self.bitmaps.keys():
+            self.bitmaps[value] = np.zeros(len(self.ids), dtype=bool)
+        for value, bitmap in self.bitmaps.items():
+            bitmap[r] = value in values
+
+    def _remove(self, product_ids: list) -> None:
+        if not product_ids:
+            return
+        ranks = sorted(self._rank(product_id) for product_id in product_ids)
+        gone = set(ranks)
+        self.ids = [pk for r, pk in enumerate(self.ids) if r not in gone]
+        self.keys = [key for r, key in enumerate(self.keys) if r not in gone]
+        for product_id in product_ids:
+            del self.keys_by_id[product_id]
+        self._ranks = None
+        for value, bitmap in self.bitmaps.items():
+            self.bitmaps[value] = np.delete(bitmap, ranks)
+
+    def _insert(self, products: list) -> None:
+        """
+        adds (id, key, ids before it nearest first, values) in the database's order
+        """
+        if not products:
+            return
+        placed = {}  # id -> rank among the current ones, for those placed earlier in the batch
+        ranks = []
+        for product_id, key, before, values in products:
+            # none indexed yet, or nothing before: first
+            r = 0
+            for other in before:
+                if other in placed:
+                    r = placed[other]
+                    break
+                indexed = self._rank(other)
+                if indexed is not None:
+                    r = indexed + 1
+                    break
+            placed[product_id] = r
+            ranks.append(r)
+
+        # items of equal rank go in the order given
+        order = sorted(range(len(products)), key=lambda i: (ranks[i], i))
+        ids, keys = [], []
+        at = 0
+        for i in order:
+            ids += self.ids[at:ranks[i]]
+            keys += self.keys[at:ranks[i]]
+            at = ranks[i]
+            ids.append(products[i][0])
+            keys.append(products[i][1])
+        self.ids = ids + self.ids[at:]
+        self.keys = keys + self.keys[at:]
+        self.keys_by_id.update((product_id, key) for product_id, key, _, _ in products)
+        self._ranks = None
+
+        for value in self.bitmaps.keys() | {value for *_, values in products for value in values}:
+            bitmap = self.bitmaps.get(value)
+            if bitmap is None:
+                bitmap = np.zeros(len(self.ids) - len(products), dtype=bool)
+            self.bitmaps[value] = np.insert(bitmap, ranks, [value in values for *_, values in products])
+
+    def _fit(self, matches: np.ndarray) -> np.ndarray:
+        # matched before ranks were added or removed, at worst a product off
+        if len(matches) == len(self.ids):
+            return matches
+        fitted = np.zeros(len(self.ids), dtype=bool)
+        size = min(len(matches), len(self.ids))
+        fitted[:size] = matches[:size]
+        return fitted
+
+    def matches(self, selected: dict) -> np.ndarray:
+        """
+        the bitmap of the products having one of the selected values of
+        every facet, selected as from facets.selection()
+        """
+        with self._lock:
+            found = np.ones(len(self.ids), dtype=bool)
+            for facet, values in selected.items():
+                either = np.zeros(len(self.ids), dtype=bool)
+                for value in values:
+                    bitmap = self.bitmaps.get((facet, value))
+                    if bitmap is not None:
+                        either |= bitmap
+                found &= either
+        return found
+
+    def counts(self, matches: np.ndarray) -> dict:
+        """
+        {facet: {value: count}} among the matches, shaped as facets.counts()
+        """
+        found = defaultdict(dict)
+        with self._lock:
+            matches = self._fit(matches)
+            for (facet, value), bitmap in self.bitmaps.items():
+                count = int(np.count_nonzero(bitmap & matches))
+                if count:
+                    found[facet][value] = count
+        return {facet: dict(sorted(found[facet].items())) for facet in facets.FACETS if facet in found}
+
+    def page(self, matches: np.ndarray, key: list | None, backwards: bool, size: int) -> list:
+        """
+        the ids of up to size matches after key (before it when backwards), nearest first
+        """
+        key = tuple(key) if key is not None else None
+        before = None
+        while True:
+            with self._lock:
+                if key is None:
+                    start, end = 0, len(self.keys)
+                    break
+                r = self._rank(_uuid(key[2]))
+                if r is not None and self.keys[r] == key:
+                    start, end = r + 1, r
+                    break
+                if before is not None:
+                    start = end = self._after(before)
+                    break
+            # the cursor's product is gone or renamed, rank the key after its neighbours
+            before = _before(key)
+
+        with self._lock:
+            matches = self._fit(matches)
+            if backwards:
+                ranks = np.flatnonzero(matches[:end])[::-1][:size]
+            else:
+                ranks = np.flatnonzero(matches[start:])[:size] + start
+            return [self.ids[r] for r in ranks]
+
+    def _after(self, before: list) -> int:
+        """
+        the rank after the nearest of before (ids nearest first) that is indexed
+        """
+        for product_id in before:
+            r = self._rank(product_id)
+            if r is not None:
+                return r + 1
+        # none indexed yet, or nothing before
+        return 0
+
+    def size(self) -> int:
+        """
+        the bytes taken by the bitmaps
+        """
+        with self._lock:
+            return sum(bitmap.nbytes for bitmap in self.bitmaps.values())
+
+
+index = CatalogIndex()
+
+
+class IndexPaginator(KeysetPaginator):
+    """
+    A KeysetPaginator seeking through the bits of the products matching
+    selected (as for CatalogIndex.matches()) rather than the database;
+    ordering must be the index's (name, brand, id)
+    """
+
+    def __init__(self, queryset, per_page: int, ordering, selected: dict, catalog: CatalogIndex = None,
+                 cursor_query_param: str = 'page'):
+        super().__init__(queryset, per_page, ordering, cursor_query_param)
+        self.selected = selected
+        self.catalog = catalog if catalog is not None else index
+        self.matches = self.catalog.matches(selected)
+
+    def fetch(self, key: list | None, backwards: bool) -> list:
+        while True:
+            ids = self.catalog.page(self.matches, key, backwards, self.per_page + 1)
+            rows = {row.pk: row for row in self.queryset.filter(pk__in=ids).order_by()}
+            missing = [pk for pk in ids if pk not in rows]
+            if not missing:
+                return [rows[pk] for pk in ids]
+            # deleted since they were ranked and the bus hasn't said yet; dropped
+            # here so the page, and the row telling there is a next one, fills up
+            self.catalog.update(missing)
+            if any(pk in self.catalog for pk in missing):
+                # still products, the queryset leaves them out
+                return [rows[pk] for pk in ids if pk in rows]
+            # the ranks moved
+            self.matches = self.catalog.matches(self.selected)
+
+
+# connection alias -> the products changed in the thread's transaction
+_local = threading.local()
+
+
+def _changes() -> dict:
+    if not hasattr(_local, 'changes'):
+        _local.changes = {}
+    return _local.changes
+
+
+def _flush(alias: str) -> None:
+    # the first callback of a commit takes every change, the others find none
+    product_ids = sorted(_changes().pop(alias, ()))
+    if product_ids:
+        index.update(product_ids)
+        invalidation.publish('catalog', ','.join(product_ids))
+
+
+def changed(product_ids) -> None:
+    """
+    updates the products in this worker's index once the current
+    transaction commits, and in the other workers' through the bus, the
+    transaction's changes as one invalidation
+    """
+    product_ids = {str(product_id) for product_id in product_ids}
+    if not product_ids:
+        return
+    alias = transaction.get_connection().alias
+    _changes().setdefault(alias, set()).update(product_ids)
+    # a callback per change, so changes after a rolled back savepoint still
+    # have one; rolled back changes go out with the next commit, their
+    # products are only read again
+    transaction.on_commit(lambda: _flush(alias))
+
+
+def reload() -> None:
+    """
+    reloads every worker's index, once the current transaction commits
+    """
+    def reloaded():
+        if index.loaded:
+            index.load()
+    transaction.on_commit(reloaded)
+    invalidation.publish('catalog', RELOAD)
+
+
+def _published(name: str) -> None:
+    if name == RELOAD:
+        if index.loaded:
+            index.load()
+    else:
+        index.update(name.split(','))
+
+
+def connect() -> None:
+    """
+    applies the changes other workers publish, called once the apps are ready
+    """
+    invalidation.subscribe('catalog', _published)
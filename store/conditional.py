@@ -0,0 +1,57 @@
+"""
+Conditional GETs for the catalog pages.
+
+A page's ETag is a hash of what decides its html, all of it known before
+rendering: the template picked, the version stamps of the products shown
+(see fragments.py, bumped on every write that changes a product's page),
+the page's cursors, the viewer (user id and csrf secret, which the
+templates embed) and, when media urls are signed, fragments.media_epoch(),
+so pages whose urls are about to expire are sent again. A client revalidating with If-None-Match gets a 304
+without the page being rendered.
+
+Responses are marked private and no-cache, so browsers and htmx's history
+cache keep the page but always revalidate it, and vary on HX-Request since
+htmx requests get partials from the same urls.
+"""
+import hashlib
+
+from django.contrib import messages
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+
+from . import fragments
+
+
+class ConditionalGetMixin:
+    """
+    Makes a view answer GETs with 304 Not Modified while the products it
+    shows haven't changed. Views call conditional_response() with the
+    version stamps of their products and a callable rendering the page.
+    """
+
+    def get_etag(self, versions: dict, extra=()) -> str | None:
+        # flash messages are shown once, a page carrying them is never reused
+        if len(messages.get_messages(self.request)):
+            return None
+        # starts the csrf secret now if the client has none, so the page and its ETag agree on it
+        get_token(self.request)
+        parts = [type(self).__name__, *self.get_template_names(),
+                 self.request.user.pk or '', self.request.META['CSRF_COOKIE'],
+                 fragments.media_epoch(), *extra]
+        parts += [f'{product_id}:{version}' for product_id, version in versions.items()]
+        return '"%s"' % hashlib.md5('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+    def conditional_response(self, versions: dict, render, extra=()):
+        """
+        a 304 if the client's copy matches, else render() with the ETag;
+        extra is anything besides the versions that the page depends on
+        """
+        etag = self.get_etag(versions, extra)
+        response = get_conditional_response(self.request, etag=etag) if etag else None
+        if response is None:
+            response = render()
+            if etag:
+                response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['HX-Request', 'Cookie'])
+        return response
@@ -0,0 +1,88 @@
+"""
+Reconciliation of the denormalized counters on Product.
+
+The counters are kept current by single statement F() updates on each
+write. These jobs recount them from the source tables in chunks of
+products, so they can verify and repair a large catalog without one long
+transaction or a full table lock.
+"""
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from . import cards, fragments
+from .models import Like, Product, Review
+
+
+def _count(queryset) -> Coalesce:
+    """
+    a correlated COUNT(*) over queryset's rows of the outer product
+    """
+    counted = (queryset.filter(product=OuterRef('pk')).order_by()
+               .values('product').annotate(total=Count('pk')).values('total'))
+    return Coalesce(Subquery(counted, output_field=IntegerField()), 0)
+
+
+def reconcile(counters: dict, batch_size: int = 5000, dry_run: bool = False,
+              on_repair=None, start_after=None, progress=None) -> tuple[int, int]:
+    """
+    compares each counter column with the count expression it maps to, one
+    chunk of products at a time in primary key order, and rewrites the
+    columns of the products that drifted
+
+    on_repair is called with the primary keys of each repaired chunk and
+    progress with (last primary key, checked, drifted) after every chunk, so
+    an interrupted run can be resumed with start_after
+
+    returns (products checked, products that had drifted)
+    """
+    checked = drifted = 0
+    last_pk = start_after
+    while True:
+        chunk = Product.objects.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        pks = list(chunk.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        checked += len(pks)
+
+        expected = {f'expected_{column}': expression for column, expression in counters.items()}
+        mismatch = Q()
+        for column in counters:
+            mismatch |= ~Q(**{column: F(f'expected_{column}')})
+        stale = list(Product.objects.filter(pk__in=pks).alias(**expected)
+                     .filter(mismatch).values_list('pk', flat=True))
+        drifted += len(stale)
+
+        if stale and not dry_run:
+            Product.objects.filter(pk__in=stale).update(**counters)
+            # the counts are in cached fragments, and update() sends no signals
+            fragments.bump(*stale, catalog=False)
+            if on_repair is not None:
+                on_repair(stale)
+        if progress is not None:
+            progress(last_pk, checked, drifted)
+    return checked, drifted
+
+
+def like_counters() -> dict:
+    return {
+        'total_likes': _count(Like.objects.filter(vote=Like.LIKE)),
+        'total_dislikes': _count(Like.objects.filter(vote=Like.DISLIKE)),
+    }
+
+
+def reconcile_likes(batch_size: int = 5000, dry_run: bool = False, **kwargs) -> tuple[int, int]:
+    return reconcile(like_counters(), batch_size, dry_run, **kwargs)
+
+
+def review_counters() -> dict:
+    return {
+        'total_reviews': _count(Review.objects.all()),
+    }
+
+
+def reconcile_reviews(batch_size: int = 5000, dry_run: bool = False, **kwargs) -> tuple[int, int]:
+    # cards mirror total_reviews so repaired products are copied onto them
+    return reconcile(review_counters(), batch_size, dry_run, on_repair=cards.sync_review_counts, **kwargs)
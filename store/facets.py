@@ -0,0 +1,218 @@
+"""
+Faceted filtering of the catalog.
+
+Every product has ProductFacet rows, one per value of each facet:
+
+    category  the names of its categories, lower cased
+    gender    male / female
+    brand     its brand, lower cased
+    price     the band of its price, see PRICE_BANDS
+    size      each size with units left
+    stock     in / out
+
+A filter is a set of values per facet: a product matches when it has one of
+the values of every facet filtered on, each an EXISTS on the
+(facet, value, product) index, so matches aren't duplicated the way joins
+across the m2m tables duplicate them.
+
+FacetCount holds the number of products in stock per facet value (stock
+itself counts every product), which are the counts of the unfiltered
+listing. refresh() keeps both tables current from the write paths: signals
+for products, sizes and their categories and genders, and ledger compaction
+for the stock counters. Filtered listings count their matches with one
+GROUP BY over the facet rows, or in the workers' bitmap index once it is
+loaded (catalog_index.py), which every change here is passed on to.
+"""
+import threading
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, IntegerField, OuterRef, Q, Value, When
+from django.db.models.functions import Greatest
+
+from . import catalog_index, ledger
+from .models import FacetCount, Product, ProductFacet, Size
+
+FACETS = ('category', 'gender', 'brand', 'price', 'size', 'stock')
+
+# naira, the last band is open ended
+PRICE_BANDS = (0, 5000, 10000, 25000, 50000)
+
+IN_STOCK, OUT_OF_STOCK = 'in', 'out'
+
+# products being deleted by this thread, which the cascade's size signals mustn't bring back
+_local = threading.local()
+
+
+def _deleting() -> set:
+    if not hasattr(_local, 'deleting'):
+        _local.deleting = set()
+    return _local.deleting
+
+
+def price_band(unit_price: int) -> str:
+    lower = max(bound for bound in PRICE_BANDS if bound <= unit_price)
+    upper = next((bound for bound in PRICE_BANDS if bound > unit_price), None)
+    return f'{lower}-{upper}' if upper is not None else f'{lower}+'
+
+
+def normalize(facet: str, value: str) -> str:
+    # sizes are saved upper cased, every other value is kept lower cased
+    return value.strip().upper() if facet == 'size' else value.strip().lower()
+
+
+def selection(params) -> dict:
+    """
+    {facet: [values]} of the facets filtered on in params (a QueryDict)
+    """
+    selected = {}
+    for facet in FACETS:
+        values = sorted({normalize(facet, value) for value in params.getlist(facet) if value.strip()})
+        if values:
+            selected[facet] = values
+    return selected
+
+
+def filter_products(queryset, selected: dict):
+    """
+    the products of queryset having one of the selected values of every facet
+    """
+    for facet, values in selected.items():
+        queryset = queryset.filter(Exists(ProductFacet.objects.filter(product=OuterRef('pk'), facet=facet,
+                                                                      value__in=values)))
+    return queryset
+
+
+def counts(products=None) -> dict:
+    """
+    {facet: {value: count}}: the precomputed counts of the unfiltered
+    listing, or those of products (a queryset of matches)
+    """
+    if products is None:
+        rows = FacetCount.objects.filter(count__gt=0).values_list('facet', 'value', 'count')
+    else:
+        rows = (ProductFacet.objects.filter(product__in=products.order_by().values('pk'))
+                .values('facet', 'value').order_by().annotate(total=Count('product'))
+                .values_list('facet', 'value', 'total'))
+    found = defaultdict(dict)
+    for facet, value, count in rows:
+        found[facet][value] = count
+    return {facet: dict(sorted(found[facet].items())) for facet in FACETS if facet in found}
+
+
+def _values(product_ids) -> dict:
+    """
+    {product id: {(facet, value)}} computed from the source tables, four queries
+    """
+    values = defaultdict(set)
+    for product_id, brand, unit_price, stock in (ledger.with_stock(Product.objects.filter(pk__in=product_ids))
+                                                 .values_list('pk', 'brand', 'unit_price', 'stock')):
+        values[product_id] |= {('brand', normalize('brand', brand)),
+                               ('price', price_band(unit_price)),
+                               ('stock', IN_STOCK if stock > 0 else OUT_OF_STOCK)}
+    for product_id, name in (Product.categories.through.objects.filter(product_id__in=product_ids)
+                             .values_list('product_id', 'category__name')):
+        values[product_id].add(('category', normalize('category', name)))
+    for product_id, sex in (Product.genders.through.objects.filter(product_id__in=product_ids)
+                            .values_list('product_id', 'gender__sex')):
+        values[product_id].add(('gender', normalize('gender', sex)))
+    for product_id, size in (Size.objects.filter(product_id__in=product_ids).alias(stock=ledger.size_stock())
+                             .filter(stock__gt=0).values_list('product_id', 'size')):
+        values[product_id].add(('size', normalize('size', size)))
+    return values
+
+
+def _counted(values: set) -> set:
+    """
+    the values of a product that count in FacetCount
+    """
+    if ('stock', IN_STOCK) in values:
+        return values
+    return {value for value in values if value[0] == 'stock'}
+
+
+def _add_counts(delta: Counter) -> None:
+    delta = {key: change for key, change in delta.items() if change}
+    if not delta:
+        return
+    FacetCount.objects.bulk_create([FacetCount(facet=facet, value=value) for facet, value in delta],
+                                   ignore_conflicts=True)
+    match = Q()
+    for facet, value in delta:
+        match |= Q(facet=facet, value=value)
+    added = Case(*[When(facet=facet, value=value, then=Value(change)) for (facet, value), change in delta.items()],
+                 default=Value(0), output_field=IntegerField())
+    FacetCount.objects.filter(match).update(count=Greatest(F('count') + added, 0))
+
+
+def _sync(product_ids, values: dict) -> None:
+    old = defaultdict(set)
+    for product_id, facet, value in (ProductFacet.objects.filter(product_id__in=product_ids)
+                                     .values_list('product_id', 'facet', 'value')):
+        old[product_id].add((facet, value))
+
+    removed = Q()
+    added = []
+    delta = Counter()
+    for product_id in product_ids:
+        new = values.get(product_id, set())
+        for facet, value in old[product_id] - new:
+            removed |= Q(product_id=product_id, facet=facet, value=value)
+        added += [ProductFacet(product_id=product_id, facet=facet, value=value)
+                  for facet, value in new - old[product_id]]
+        delta.update(_counted(new))
+        delta.subtract(_counted(old[product_id]))
+
+    if removed:
+        ProductFacet.objects.filter(removed).delete()
+    ProductFacet.objects.bulk_create(added)
+    _add_counts(delta)
+
+
+def refresh(product_ids) -> None:
+    """
+    brings the facet rows and counts of the products in line with the
+    source tables, in a fixed number of queries
+    """
+    product_ids = sorted(set(product_ids) - _deleting())
+    if not product_ids:
+        return
+    with transaction.atomic():
+        # concurrent refreshes of a product would both count its change; the
+        # stock lock serializes them without locking the hot product rows
+        ledger.lock_stock(product_ids)
+        _sync(product_ids, _values(product_ids))
+        catalog_index.changed(product_ids)
+
+
+def forget(product_id) -> None:
+    """
+    removes the product from the counts, before it is deleted
+    """
+    _deleting().add(product_id)
+    with transaction.atomic():
+        _sync([product_id], {})
+        catalog_index.changed([product_id])
+
+
+def forgotten(product_id) -> None:
+    """
+    the product is deleted
+    """
+    _deleting().discard(product_id)
+
+
+def rebuild(batch_size: int = 500) -> int:
+    """
+    recomputes every product's facets and all counts
+    returns the number of products
+    """
+    with transaction.atomic():
+        FacetCount.objects.all().delete()
+        ProductFacet.objects.all().delete()
+        product_ids = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(product_ids), batch_size):
+            batch = product_ids[start:start + batch_size]
+            _sync(batch, _values(batch))
+        catalog_index.reload()
+    return len(product_ids)
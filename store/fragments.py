@@ -0,0 +1,192 @@
+"""
+Fragment caching of product templates, keyed by product version stamps.
+
+Every product has a version stamp in the cache. Writes to a product or to
+anything its fragments show (sizes, images, reviews, votes, order items)
+bump it through bump(), so fragments rendered from the old inputs are never
+looked up again and simply age out; nothing has to find and delete them.
+
+Templates wrap the product specific parts in
+
+    {% load fragment_cache %}
+    {% cachefragment "card" product.pk %} ... {% endcachefragment %}
+
+with any extra values the fragment depends on after the product. Views that
+render many products can load all their stamps in one cache round trip with
+versions() and put them in the context as `fragment_versions`.
+
+The STORE_FRAGMENT_CACHE setting names the cache to use, 'default' unless
+set; any django cache backend works. Bumps are broadcast on the
+invalidation bus (invalidation.py) as 'version' events, so workers with a
+cache of their own start new stamps too. stats() reports hits and misses
+of this process.
+
+Fragments, cached pages (page_cache.py) and the pages browsers keep
+(conditional.py) hold media urls. When the storage signs them (S3 with
+querystring auth) they expire querystring_expire seconds after rendering,
+so each of the three keeps html at most a quarter of that, see
+media_timeout() and media_epoch(): nested, they still leave a browser a
+quarter of the lifetime to load the images.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from . import invalidation
+
+# fragments outlive no stamp change, this only bounds memory of unvisited products
+FRAGMENT_TIMEOUT = 60 * 60 * 24
+# a stamp that expires is started afresh, which only costs its fragments; this
+# bounds stamps of products nobody visits, or that don't exist
+STAMP_TIMEOUT = FRAGMENT_TIMEOUT
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _cache():
+    return caches[getattr(settings, 'STORE_FRAGMENT_CACHE', 'default')]
+
+
+def _version_key(product_id) -> str:
+    return f'store:product-version:{product_id}'
+
+
+# bumped along with products whose listing changed, for pages whose products
+# aren't known before rendering (the listing)
+CATALOG_VERSION_KEY = 'store:catalog-version'
+
+# the name of the catalog's stamp in a 'version' event, next to product ids
+CATALOG = 'catalog'
+
+
+def versions(product_ids) -> dict:
+    """
+    {product id: version stamp}, starting a stamp for products without one
+    """
+    product_ids = list(product_ids)
+    cache = _cache()
+    found = cache.get_many([_version_key(product_id) for product_id in product_ids])
+    stamps = {}
+    for product_id in product_ids:
+        key = _version_key(product_id)
+        stamp = found.get(key)
+        if stamp is None:
+            stamp = uuid.uuid4().hex[:12]
+            # another process may have started it first, theirs wins
+            if not cache.add(key, stamp, timeout=STAMP_TIMEOUT):
+                stamp = cache.get(key, stamp)
+        stamps[product_id] = stamp
+    return stamps
+
+
+def catalog_version() -> str:
+    """
+    the stamp of the whole catalog, new whenever any product's is
+    """
+    cache = _cache()
+    stamp = cache.get(CATALOG_VERSION_KEY)
+    if stamp is None:
+        stamp = uuid.uuid4().hex[:12]
+        if not cache.add(CATALOG_VERSION_KEY, stamp, timeout=STAMP_TIMEOUT):
+            stamp = cache.get(CATALOG_VERSION_KEY, stamp)
+    return stamp
+
+
+def bump(*product_ids, catalog: bool = True) -> None:
+    """
+    gives the products new stamps, now and again once the current
+    transaction commits, so a render that read the old rows in between
+    can't be cached under the new stamp; the catalog's too unless catalog
+    is False, for writes the listing doesn't show (votes, reviews, orders,
+    whose counts on cached listing pages may lag until the pages expire)
+    """
+    if not product_ids:
+        return
+
+    def committed():
+        _new_stamps(product_ids, catalog)
+        invalidation.publish('version', ','.join([str(product_id) for product_id in product_ids]
+                                                 + ([CATALOG] if catalog else [])))
+
+    _new_stamps(product_ids, catalog)
+    transaction.on_commit(committed)
+
+
+def _new_stamps(product_ids, catalog: bool) -> None:
+    stamps = {_version_key(product_id): uuid.uuid4().hex[:12] for product_id in product_ids}
+    if catalog:
+        stamps[CATALOG_VERSION_KEY] = uuid.uuid4().hex[:12]
+    _cache().set_many(stamps, timeout=STAMP_TIMEOUT)
+
+
+def _published(name: str) -> None:
+    names = name.split(',')
+    _new_stamps([product_id for product_id in names if product_id != CATALOG], CATALOG in names)
+
+
+def connect() -> None:
+    """
+    starts the stamps other workers bump, called once the apps are ready
+    """
+    invalidation.subscribe('version', _published)
+
+
+def _signed_url_lifetime() -> int | None:
+    if not getattr(default_storage, 'querystring_auth', False):
+        return None
+    return default_storage.querystring_expire
+
+
+def media_timeout(timeout: int) -> int:
+    """
+    timeout capped for cached html holding media urls
+    """
+    lifetime = _signed_url_lifetime()
+    return min(timeout, lifetime // 4) if lifetime else timeout
+
+
+def media_epoch() -> str:
+    """
+    changes every quarter lifetime of signed media urls, '' when they
+    aren't signed; part of the ETags of pages holding them
+    """
+    lifetime = _signed_url_lifetime()
+    return str(int(time.time()) // (lifetime // 4)) if lifetime else ''
+
+
+def fragment_key(name: str, product_id, version: str, vary=()) -> str:
+    extra = hashlib.md5(':'.join(str(value) for value in vary).encode()).hexdigest()[:12] if vary else ''
+    return f'store:fragment:{name}:{product_id}:{version}:{extra}'
+
+
+def get(key: str):
+    html = _cache().get(key)
+    with _stats_lock:
+        _stats['hits' if html is not None else 'misses'] += 1
+    return html
+
+
+def set(key: str, html: str) -> None:
+    _cache().set(key, html, media_timeout(FRAGMENT_TIMEOUT))
+
+
+def stats() -> dict:
+    """
+    {'hits': .., 'misses': .., 'hit_rate': ..} of this process
+    """
+    with _stats_lock:
+        hits, misses = _stats['hits'], _stats['misses']
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+
+def reset_stats() -> None:
+    with _stats_lock:
+        _stats.clear()
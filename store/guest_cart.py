@@ -0,0 +1,73 @@
+"""
+The cart of a visitor who hasn't logged in.
+
+It lives in a signed cookie rather than in CartItem, so browsing and adding
+to the cart writes nothing to the database. The payload is compact,
+"<product hex>:<size>:<quantity>" lines joined by commas, and capped at
+MAX_LINES to stay well inside the 4KB cookie limit.
+
+GuestCartMiddleware merges it into the user's CartItem rows with one bulk
+upsert on the first response after they log in, and drops the cookie.
+"""
+import uuid
+
+from django.conf import settings
+
+from .cart import merge_lines
+
+COOKIE_NAME = 'guest_cart'
+SALT = 'store.guest_cart'
+MAX_LINES = 50
+MAX_QUANTITY = 99
+MAX_AGE = 60 * 60 * 24 * 30
+
+
+def read(request) -> dict:
+    """
+    {(product id, size): quantity} of the request's guest cart, empty if the
+    cookie is missing or was tampered with
+    """
+    payload = request.get_signed_cookie(COOKIE_NAME, default='', salt=SALT, max_age=MAX_AGE)
+    lines = {}
+    for line in payload.split(',') if payload else []:
+        try:
+            product, size, quantity = line.split(':')
+            lines[uuid.UUID(hex=product), size[:4].upper()] = max(1, min(int(quantity), MAX_QUANTITY))
+        except ValueError:
+            continue
+    return lines
+
+
+def write(response, lines: dict) -> None:
+    payload = ','.join(f'{product.hex}:{size}:{quantity}' for (product, size), quantity in lines.items())
+    response.set_signed_cookie(COOKIE_NAME, payload, salt=SALT, max_age=MAX_AGE, httponly=True,
+                               samesite='Lax', secure=not settings.DEBUG)
+
+
+def add(lines: dict, product_id, size: str, available: int) -> bool:
+    """
+    adds one unit to the guest cart's line, up to available
+    returns whether it was added
+    """
+    key = (uuid.UUID(str(product_id)), size.upper())
+    quantity = lines.get(key, 0) + 1
+    if quantity > min(available, MAX_QUANTITY) or (key not in lines and len(lines) >= MAX_LINES):
+        return False
+    lines[key] = quantity
+    return True
+
+
+class GuestCartMiddleware:
+    """
+    moves a guest cart into the database once its visitor is authenticated
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if COOKIE_NAME in request.COOKIES and request.user.is_authenticated:
+            merge_lines(request.user, read(request))
+            response.delete_cookie(COOKIE_NAME, samesite='Lax')
+        return response
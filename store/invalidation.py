@@ -0,0 +1,356 @@
+"""
+Cache invalidations broadcast to every worker process.
+
+Caches kept in process memory (query_cache.py) go stale in the other
+workers, on this host and others, when one of them writes. Writers publish
+an invalidation, a key such as "table:store_category", and every worker
+applies it through the handler subscribed to its kind:
+
+    invalidation.subscribe('table', cache.invalidate)
+    invalidation.publish('table', 'store_category')
+
+Each invalidation is a row of InvalidationEvent, inserted once the writer's
+transaction commits, whose id is its sequence number. A transport then
+wakes the workers up with it (only the number when the name is too long
+for the key, the workers read the rest from the log):
+
+    PostgresTransport   LISTEN/NOTIFY, reaches every host
+    UnixSocketTransport datagrams to the workers of this host
+    InMemoryTransport   within one process, for tests
+
+Notifications may be lost (a listener reconnecting, a worker of another
+host with the unix transport), so they are only a shortcut. A worker that
+sees a gap in the sequence, or has heard nothing for MAX_LAG seconds, reads
+the events after the last one it applied, so every invalidation is applied
+within MAX_LAG. Ids are handed out before commit, so a lower id can commit
+after a higher one; a gap is waited on for REORDER_WINDOW before being
+taken for a rolled back insert.
+
+Gunicorn workers start their listener thread in post_worker_init
+(config.py). STORE_INVALIDATION_TRANSPORT picks the transport: 'postgres',
+'unix' (sockets in STORE_INVALIDATION_SOCKET_DIR) or 'memory'; by default
+postgres when the database is, memory otherwise.
+"""
+import glob
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+
+from django.conf import settings
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'store_invalidation'
+# the longest key of an event, longer names go in its payload
+KEY_LENGTH = 255
+MAX_LAG = 2
+REORDER_WINDOW = 30
+
+# kind -> handler(name), shared by the buses of the process
+handlers = {}
+
+
+def subscribe(kind: str, handler) -> None:
+    handlers[kind] = handler
+
+
+class InMemoryTransport:
+    """
+    delivers to the other transports sharing its hub, standing in for workers in tests
+    """
+
+    def __init__(self, hub: list | None = None):
+        self.hub = hub if hub is not None else []
+        self.inbox = deque()
+        self.hub.append(self)
+
+    def send(self, message: str) -> None:
+        for transport in self.hub:
+            if transport is not self:
+                transport.inbox.append(message)
+
+    def receive(self, timeout: float) -> list[str]:
+        messages = []
+        while self.inbox:
+            messages.append(self.inbox.popleft())
+        if not messages and timeout:
+            time.sleep(timeout)
+        return messages
+
+    def close(self) -> None:
+        if self in self.hub:
+            self.hub.remove(self)
+
+
+class UnixSocketTransport:
+    """
+    one datagram socket per worker in directory; a send goes to all the others
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.sock')
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+
+    def send(self, message: str) -> None:
+        data = message.encode()
+        for path in glob.glob(os.path.join(self.directory, '*.sock')):
+            if path == self.path:
+                continue
+            try:
+                self.sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the socket of a worker that died
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                # that worker's queue is full, it catches up from the log
+                pass
+
+    def receive(self, timeout: float) -> list[str]:
+        ready, _, _ = select.select([self.socket], [], [], timeout)
+        messages = []
+        while ready:
+            messages.append(self.socket.recv(1024).decode())
+            ready, _, _ = select.select([self.socket], [], [], 0)
+        return messages
+
+    def close(self) -> None:
+        self.socket.close()
+        self.sender.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class PostgresTransport:
+    """
+    NOTIFY on the database connection, LISTEN on a connection of its own
+    """
+
+    def __init__(self, using: str = 'default'):
+        self.using = using
+        self.listener = None
+
+    def send(self, message: str) -> None:
+        with connections[self.using].cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, message])
+
+    def _listen(self):
+        wrapper = connections[self.using]
+        listener = wrapper.get_new_connection(wrapper.get_connection_params())
+        listener.autocommit = True
+        with listener.cursor() as cursor:
+            cursor.execute(f'LISTEN {CHANNEL}')
+        return listener
+
+    def receive(self, timeout: float) -> list[str]:
+        try:
+            if self.listener is None:
+                self.listener = self._listen()
+            ready, _, _ = select.select([self.listener], [], [], timeout)
+            if not ready:
+                return []
+            self.listener.poll()
+            messages = [notify.payload for notify in self.listener.notifies]
+            self.listener.notifies.clear()
+            return messages
+        except Exception:
+            # notifications sent while reconnecting are caught up from the log
+            logger.exception("invalidation listener failed, reconnecting")
+            self.close()
+            time.sleep(timeout)
+            return []
+
+    def close(self) -> None:
+        if self.listener is not None:
+            try:
+                self.listener.close()
+            except Exception:
+                pass
+            self.listener = None
+
+
+class InvalidationBus:
+
+    def __init__(self, transport, handlers: dict = handlers, using: str = 'default'):
+        self.transport = transport
+        self.handlers = handlers
+        self.using = using
+        self.origin = uuid.uuid4().hex
+        # every event up to the watermark is applied (or given up on as rolled back)
+        self.watermark = None
+        self.applied = set()  # events above the watermark
+        self.gap_since = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def publish(self, kind: str, name: str) -> None:
+        """
+        broadcasts the invalidation once the current transaction commits
+        """
+        from .models import InvalidationEvent
+
+        def send():
+            key, payload = f'{kind}:{name}', ''
+            if len(key) > KEY_LENGTH:
+                key, payload = f'{kind}:', name
+            event = InvalidationEvent.objects.using(self.using).create(key=key, payload=payload, origin=self.origin)
+            # receivers read an event without a key from the log
+            self.transport.send(f'{event.pk}:{self.origin}:{"" if payload else key}')
+        transaction.on_commit(send, using=self.using)
+
+    def _latest(self) -> int:
+        from .models import InvalidationEvent
+
+        latest = InvalidationEvent.objects.using(self.using).order_by('-pk').values_list('pk', flat=True).first()
+        return latest or 0
+
+    def _apply(self, seq: int, origin: str, key: str, payload: str = '') -> None:
+        if seq <= self.watermark or seq in self.applied:
+            return
+        self.applied.add(seq)
+        kind, _, name = key.partition(':')
+        name = payload or name
+        handler = self.handlers.get(kind)
+        if origin != self.origin and handler is not None:
+            try:
+                handler(name)
+            except Exception:
+                logger.exception("applying invalidation %s failed", key)
+
+    def _advance(self) -> None:
+        while self.watermark + 1 in self.applied:
+            self.watermark += 1
+            self.applied.discard(self.watermark)
+        if not self.applied:
+            self.gap_since = None
+        elif self.gap_since is None:
+            self.gap_since = time.monotonic()
+        elif time.monotonic() - self.gap_since > REORDER_WINDOW:
+            # the missing events were never committed
+            self.watermark = min(self.applied) - 1
+            self.gap_since = None
+            self._advance()
+
+    def catch_up(self) -> None:
+        """
+        applies the events after the watermark from the log
+        """
+        from .models import InvalidationEvent
+
+        events = (InvalidationEvent.objects.using(self.using).filter(pk__gt=self.watermark)
+                  .order_by('pk').values_list('pk', 'origin', 'key', 'payload'))
+        for seq, origin, key, payload in events:
+            self._apply(seq, origin, key, payload)
+
+    def poll(self, timeout: float = 0) -> None:
+        """
+        applies what the transport delivers within timeout, reading the log
+        when there is a gap or nothing came
+        """
+        messages = self.transport.receive(timeout)
+        with self._lock:
+            if self.watermark is None:
+                self.watermark = self._latest()
+            gap = not messages
+            for message in messages:
+                seq, origin, key = message.split(':', 2)
+                seq = int(seq)
+                if seq > self.watermark + 1 and seq - 1 not in self.applied:
+                    gap = True
+                if not key:
+                    # the name is in the log
+                    gap = True
+                    continue
+                self._apply(seq, origin, key)
+            self._advance()
+            # while events are missing the log is read on every poll until they turn up
+            if gap or self.applied:
+                self.catch_up()
+                self._advance()
+
+    def start(self) -> None:
+        """
+        applies invalidations in a daemon thread from now on; earlier ones
+        don't concern a process that starts with empty caches
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            self.watermark = self._latest()
+
+        def listen():
+            while not self._stopped.is_set():
+                try:
+                    self.poll(MAX_LAG)
+                except Exception:
+                    logger.exception("invalidation poll failed")
+                    connections.close_all()
+                    time.sleep(MAX_LAG)
+        self._thread = threading.Thread(target=listen, name='store-invalidation', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(MAX_LAG * 2)
+            self._thread = None
+        self.transport.close()
+
+
+def purge(older_than) -> int:
+    """
+    deletes events created before older_than ago, long applied by every worker
+    """
+    from django.utils import timezone
+
+    from .models import InvalidationEvent
+
+    deleted, _ = InvalidationEvent.objects.filter(created_at__lt=timezone.now() - older_than).delete()
+    return deleted
+
+
+def _transport():
+    name = getattr(settings, 'STORE_INVALIDATION_TRANSPORT', None)
+    if name is None:
+        name = 'postgres' if connections['default'].vendor == 'postgresql' else 'memory'
+    if name == 'postgres':
+        return PostgresTransport()
+    if name == 'unix':
+        return UnixSocketTransport(getattr(settings, 'STORE_INVALIDATION_SOCKET_DIR', '/tmp/store-invalidation'))
+    return InMemoryTransport()
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_bus() -> InvalidationBus:
+    """
+    the process wide bus, created on first use
+    """
+    global _bus
+    if _bus is None:
+        with _bus_lock:
+            if _bus is None:
+                _bus = InvalidationBus(_transport())
+    return _bus
+
+
+def publish(kind: str, name: str) -> None:
+    get_bus().publish(kind, name)
@@ -0,0 +1,156 @@
+"""
+The stock ledger.
+
+Stock changes are inserted as StockMovement rows instead of updating the
+hot Product.inventory and Size.quantity rows on every sale, so the counters
+are only written by compact(), a batch at a time. Until then a product's
+stock is its counter plus its pending movements, which product_stock() and
+size_stock() sum through partial indexes on the uncompacted rows.
+
+Run compact_stock_ledger every minute or so from cron to keep the pending
+movements few. Nothing reads the counters alone: with_stock() and
+in_stock() give readers the same figure checkout uses, and a sale that
+sells a product out updates its card and facets at once.
+
+Sales and holds check that figure and insert their rows under lock_stock(),
+a per product advisory lock, so the Product and Size rows themselves are
+never locked by a checkout.
+"""
+import hashlib
+import logging
+from collections import Counter
+
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+
+from . import cards, facets, fragments
+from .models import Product, Reservation, Size, StockMovement
+
+logger = logging.getLogger(__name__)
+
+
+def product_stock(ref: str = 'pk', inventory: str = 'inventory'):
+    """
+    the outer query's product's stock, for annotations on Product, or on a
+    model pointing at one when ref and inventory lead to the product
+    """
+    return F(inventory) + StockMovement.objects.pending().total_for('product', ref)
+
+
+def size_stock(ref: str = 'pk'):
+    """
+    the outer query's size's stock, for annotations on Size
+    """
+    return F('quantity') + StockMovement.objects.pending().total_for('size', ref)
+
+
+def with_stock(queryset, product: str = ''):
+    """
+    annotates `stock` on a queryset of products, or of rows whose product
+    is reached through the `product` lookup (e.g. cart items)
+    """
+    if not product:
+        return queryset.annotate(stock=product_stock())
+    return queryset.annotate(stock=product_stock(product, f'{product}__inventory'))
+
+
+def in_stock(queryset, product: str = ''):
+    """
+    the products, or rows of products (see with_stock), that have stock
+    """
+    return with_stock(queryset, product).filter(stock__gt=0)
+
+
+def _lock_key(product_id) -> int:
+    digest = hashlib.blake2b(str(product_id).encode(), digest_size=8, person=b'store.stock').digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def lock_stock(product_ids) -> None:
+    """
+    serializes stock checks of the products until the current transaction
+    ends, without locking their rows: a transaction level advisory lock per
+    product on postgres, sqlite allows only one writer anyway
+    """
+    if connection.vendor != 'postgresql':
+        return
+    keys = sorted({_lock_key(product_id) for product_id in product_ids})
+    if not keys:
+        return
+    with connection.cursor() as cursor:
+        # the locks are taken after the sort, in key order, so two checkouts can't deadlock
+        cursor.execute("SELECT pg_advisory_xact_lock(key) FROM unnest(%s::bigint[]) AS key ORDER BY key", [keys])
+
+
+def record(product_id, quantity: int, kind: str, size: Size | None = None, order=None, note: str = '') -> StockMovement:
+    return StockMovement.objects.create(product_id=product_id, size=size, size_label=size.size if size else '',
+                                        order=order, kind=kind, quantity=quantity, note=note)
+
+
+def receive(product_id, quantity: int, size: Size | None = None, note: str = '') -> StockMovement:
+    """
+    records new stock coming in
+    """
+    return record(product_id, quantity, StockMovement.RECEIPT, size, note=note)
+
+
+def adjust(product_id, quantity: int, size: Size | None = None, note: str = '') -> StockMovement:
+    """
+    records a correction after a stock count, quantity is signed
+    """
+    return record(product_id, quantity, StockMovement.ADJUSTMENT, size, note=note)
+
+
+def _add(deltas: Counter) -> Case:
+    return Case(*[When(pk=pk, then=Value(delta)) for pk, delta in deltas.items()],
+                default=Value(0), output_field=IntegerField())
+
+
+def _report_negative(queryset, column: str, deltas: Counter) -> None:
+    """
+    logs the rows whose counter plus their movements sums below zero, an
+    oversell or drift between the counter and the ledger that the counter,
+    which can't go negative, would otherwise hide at 0
+    """
+    short = {str(pk): after for pk, after in (queryset.filter(pk__in=deltas).annotate(after=F(column) + _add(deltas))
+                                              .filter(after__lt=0).values_list('pk', 'after'))}
+    if short:
+        logger.error("compaction took %s.%s below zero, kept at 0: %s",
+                     queryset.model._meta.model_name, column, short)
+
+
+def compact(batch_size: int = 5000) -> int:
+    """
+    rolls pending movements into the counter columns, one transaction per
+    batch; concurrent runs skip each other's rows
+    returns the number of movements compacted
+    """
+    compacted = 0
+    while True:
+        with transaction.atomic():
+            movements = list(StockMovement.objects.pending().select_for_update(skip_locked=True)
+                             .order_by('pk').values_list('pk', 'product_id', 'size_id', 'quantity')[:batch_size])
+            if not movements:
+                return compacted
+
+            by_product = Counter()
+            by_size = Counter()
+            for _, product_id, size_id, quantity in movements:
+                by_product[product_id] += quantity
+                if size_id is not None:
+                    by_size[size_id] += quantity
+
+            _report_negative(Product.objects.all(), 'inventory', by_product)
+            Product.objects.filter(pk__in=by_product).update(inventory=Greatest(F('inventory') + _add(by_product), 0))
+            if by_size:
+                _report_negative(Size.objects.all(), 'quantity', by_size)
+                Size.objects.filter(pk__in=by_size).update(quantity=Greatest(F('quantity') + _add(by_size), 0))
+                # sold out sizes are deleted, as they always were, unless a buyer still holds some
+                (Size.objects.filter(pk__in=by_size, quantity=0)
+                 .exclude(pk__in=Reservation.objects.live().values('size')).delete())
+            StockMovement.objects.filter(pk__in=[movement[0] for movement in movements]).update(compacted=True)
+            cards.sync_stock(list(by_product))
+            facets.refresh(by_product)
+            fragments.bump(*by_product)
+            compacted += len(movements)
@@ -0,0 +1,103 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store import facets
+from store.catalog_index import CatalogIndex, IndexPaginator
+from store.models import Category, Gender, Product, Size
+from store.pagination import KeysetPaginator
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'te', 'vo', 'zi', 'bre', 'dan', 'fol', 'gri', 'hul']
+BRANDS = ['Nike', 'Adidas', 'Puma', 'Reebok', 'Vans', 'Converse', 'Clarks', 'Bata']
+CATEGORIES = ['Sneakers', 'Boots', 'Sandals', 'Loafers', 'Heels', 'Slippers', 'Running', 'Formal']
+SIZES = ['38', '39', '40', '41', '42', '43', '44', '45']
+ORDERING = ('name', 'brand', 'id')
+
+
+class Command(BaseCommand):
+    help = ("Compares filtering a generated catalog by facets in SQL against the "
+            "bitmap index: a page and the drill-down counts per filter. "
+            "Everything is rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000000)
+        parser.add_argument('--queries', type=int, default=100)
+        parser.add_argument('--page-size', type=int, default=5)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        words = sorted({''.join(rng.choices(SYLLABLES, k=3)) for _ in range(3000)})
+        page_size = options['page_size']
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            self.generate(rng, words, options['products'])
+            facets.rebuild(batch_size=5000)
+            self.stdout.write(f"catalog: {time.perf_counter() - started:.1f}s for {options['products']} products")
+
+            index = CatalogIndex()
+            started = time.perf_counter()
+            index.load()
+            self.stdout.write(f"index load: {time.perf_counter() - started:.1f}s, "
+                              f"{index.size() / 1024 / 1024:.1f}MB of bitmaps")
+
+            selections = [self.selection(rng) for _ in range(options['queries'])]
+            queryset = Product.objects.select_related('card')
+
+            def sql(selected):
+                products = facets.filter_products(queryset, selected)
+                KeysetPaginator(products, page_size, ORDERING).page(None)
+                facets.counts(products)
+
+            def bitmaps(selected):
+                paginator = IndexPaginator(queryset, page_size, ORDERING, selected, index)
+                paginator.page(None)
+                index.counts(paginator.matches)
+
+            for label, run in (('sql', sql), ('bitmaps', bitmaps)):
+                started = time.perf_counter()
+                for selected in selections:
+                    run(selected)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f"{label:>8}: {elapsed:.3f}s total, "
+                                  f"{elapsed / len(selections) * 1000:.2f}ms per filter")
+
+            transaction.set_rollback(True)
+
+    def generate(self, rng, words, count):
+        categories = [Category.objects.get_or_create(name=name)[0] for name in CATEGORIES]
+        genders = [Gender.objects.get_or_create(sex=sex)[0] for sex in ('Male', 'Female')]
+        batch_size = 5000
+        for start in range(0, count, batch_size):
+            products = Product.objects.bulk_create(
+                [Product(name=' '.join(rng.sample(words, 3)).capitalize(),
+                         brand=rng.choice(BRANDS),
+                         description='generated',
+                         unit_price=rng.randrange(1000, 80000),
+                         inventory=rng.choice((0, 5, 10, 20)))
+                 for _ in range(min(batch_size, count - start))])
+            Product.categories.through.objects.bulk_create(
+                [Product.categories.through(product_id=product.pk, category_id=category.pk)
+                 for product in products for category in rng.sample(categories, rng.randint(1, 2))])
+            Product.genders.through.objects.bulk_create(
+                [Product.genders.through(product_id=product.pk, gender_id=gender.pk)
+                 for product in products for gender in rng.sample(genders, rng.randint(1, 2))])
+            Size.objects.bulk_create(
+                [Size(product=product, size=size, quantity=rng.randint(0, 5))
+                 for product in products for size in rng.sample(SIZES, 3)])
+
+    def selection(self, rng):
+        # one to three facets, one or two values each, like the listing's links
+        choices = {
+            'category': [name.lower() for name in CATEGORIES],
+            'gender': ['male', 'female'],
+            'brand': [brand.lower() for brand in BRANDS],
+            'price': [facets.price_band(bound) for bound in facets.PRICE_BANDS],
+            'size': SIZES,
+        }
+        selected = {'stock': [facets.IN_STOCK]}
+        for facet in rng.sample(sorted(choices), rng.randint(1, 3)):
+            selected[facet] = sorted(rng.sample(choices[facet], rng.randint(1, 2)))
+        return selected
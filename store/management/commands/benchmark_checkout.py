@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from account.models import User
+from store.models import CartItem, Product
+from store.orders import place_order
+
+
+class Command(BaseCommand):
+    help = ("Places orders from generated carts of growing size and reports the "
+            "queries and time each takes. Everything is rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 30, 100])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user = User.objects.create_user('benchmark@example.com', 'Bench', 'Mark', '08000000000', 'pass@1234')
+            products = Product.objects.bulk_create(
+                [Product(name=f'Benchmark {i}', description='generated', unit_price=1000 + i, inventory=10 ** 6)
+                 for i in range(max(options['sizes']))])
+
+            for size in options['sizes']:
+                CartItem.objects.filter(user=user).delete()
+                CartItem.objects.bulk_create([CartItem(user=user, product=product, quantity=2, size='42')
+                                              for product in products[:size]])
+                started = time.perf_counter()
+                for _ in range(options['repeat']):
+                    with CaptureQueriesContext(connection) as queries:
+                        place_order(user, 'somewhere')
+                elapsed = (time.perf_counter() - started) / options['repeat']
+                self.stdout.write(f"{size:>5} items: {len(queries.captured_queries)} queries, "
+                                  f"{elapsed * 1000:.2f}ms per order")
+
+            transaction.set_rollback(True)
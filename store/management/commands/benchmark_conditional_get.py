@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import Client
+from django.urls import reverse
+
+from store.models import Product
+
+
+class Command(BaseCommand):
+    help = ("Fetches the product list and detail pages in full and then revalidates "
+            "them with If-None-Match, reporting bytes sent and CPU time per request. "
+            "Everything is rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def measure(self, client, url, headers):
+        started = time.process_time()
+        sent = 0
+        for _ in range(self.repeat):
+            response = client.get(url, headers=headers)
+            sent += len(response.content)
+        elapsed = (time.process_time() - started) / self.repeat
+        return response, sent // self.repeat, elapsed
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        with transaction.atomic():
+            products = [Product.objects.create(name=f'Benchmark {i}', description='generated ' * 20,
+                                               unit_price=1000 + i, inventory=10)
+                        for i in range(5)]
+            client = Client()
+            pages = [('list', reverse('store:product-list')),
+                     ('detail', reverse('store:product-detail', args=[products[0].pk]))]
+
+            for name, url in pages:
+                for kind, headers in (('full page', {}), ('htmx', {'HX-Request': 'true'})):
+                    response, full_bytes, full_cpu = self.measure(client, url, headers)
+                    revalidate = {**headers, 'If-None-Match': response['ETag']}
+                    response, cached_bytes, cached_cpu = self.measure(client, url, revalidate)
+                    self.stdout.write(
+                        f"{name:>6} {kind:>9}: 200 {full_bytes}B {full_cpu * 1000:.2f}ms cpu, "
+                        f"{response.status_code} {cached_bytes}B {cached_cpu * 1000:.2f}ms cpu")
+
+            transaction.set_rollback(True)
@@ -0,0 +1,56 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.models import Product
+from store.search import get_search_backend, icontains_search
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'te', 'vo', 'zi', 'bre', 'dan', 'fol', 'gri', 'hul']
+BRANDS = ['Nike', 'Adidas', 'Puma', 'Reebok', 'Vans', 'Converse', 'Clarks', 'Bata']
+
+
+class Command(BaseCommand):
+    help = ("Compares the search backend against the old icontains filter "
+            "on a generated catalog. Everything is rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=20000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--page-size', type=int, default=5)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        # a few thousand made up words so queries are as selective as real ones
+        words = sorted({''.join(rng.choices(SYLLABLES, k=3)) for _ in range(3000)})
+        backend = get_search_backend()
+        queries = [' '.join(rng.sample(words, rng.randint(1, 2))) for _ in range(options['queries'])]
+        page_size = options['page_size']
+
+        with transaction.atomic():
+            Product.objects.bulk_create(
+                [Product(name=' '.join(rng.sample(words, 3)).capitalize(),
+                         brand=rng.choice(BRANDS),
+                         description=' '.join(rng.choices(words, k=25)).capitalize())
+                 for _ in range(options['products'])],
+                batch_size=2000)
+
+            started = time.perf_counter()
+            backend.rebuild()
+            self.stdout.write(f"index build: {time.perf_counter() - started:.3f}s "
+                              f"for {options['products']} products")
+
+            products = Product.objects.filter(inventory__gt=0)
+            for label, search in (('icontains', icontains_search), ('backend', backend.search)):
+                started = time.perf_counter()
+                for query in queries:
+                    list(search(products, query)[:page_size])
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f"{label:>10}: {elapsed:.3f}s total, "
+                                  f"{elapsed / len(queries) * 1000:.2f}ms per query")
+
+            transaction.set_rollback(True)
+
+        if hasattr(backend, 'reset'):
+            backend.reset()
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F
+
+from store.ledger import compact
+from store.models import Product, Size
+from store.stock import OutOfStock, commit_stock
+
+Line = namedtuple('Line', 'product_id quantity size')
+
+
+class Command(BaseCommand):
+    help = ("Compares the throughput of concurrent sales of one size when they update "
+            "the counter rows against inserting into the stock ledger. The generated "
+            "product is deleted afterwards. Run it against Postgres, SQLite serializes "
+            "every writer.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--sales', type=int, default=200, help="sales per thread")
+
+    def sell_by_update(self, product, size):
+        with transaction.atomic():
+            if not Size.objects.filter(pk=size.pk, quantity__gte=1).update(quantity=F('quantity') - 1):
+                raise OutOfStock([])
+            Product.objects.filter(pk=product.pk, inventory__gte=1).update(inventory=F('inventory') - 1)
+
+    def sell_by_ledger(self, product, size):
+        commit_stock([Line(product.pk, 1, size.size)])
+
+    def run(self, sell, product, size, threads, sales):
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(sales):
+                    try:
+                        sell(product, size)
+                    except (DatabaseError, OutOfStock) as e:
+                        errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return time.perf_counter() - started, len(errors)
+
+    def handle(self, *args, **options):
+        threads, sales = options['threads'], options['sales']
+        stock = threads * sales
+        product = Product.objects.create(name='Ledger benchmark', description='generated', inventory=stock)
+        try:
+            for label, sell in (('counters', self.sell_by_update), ('ledger', self.sell_by_ledger)):
+                Product.objects.filter(pk=product.pk).update(inventory=stock)
+                size = Size.objects.create(product=product, size='BM', quantity=stock)
+                elapsed, errors = self.run(sell, product, size, threads, sales)
+                compacted = time.perf_counter()
+                compact()
+                compacted = time.perf_counter() - compacted
+                self.stdout.write(f"{label:>9}: {stock / elapsed:,.0f} sales/s over {threads} threads, "
+                                  f"{errors} failed, compaction {compacted * 1000:.0f}ms")
+                size.delete()
+        finally:
+            product.delete()
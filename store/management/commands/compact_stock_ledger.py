@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.ledger import compact
+
+
+class Command(BaseCommand):
+    help = "Rolls pending stock movements into Product.inventory and Size.quantity. Run it from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        compacted = compact(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Compacted {compacted} stock movements"))
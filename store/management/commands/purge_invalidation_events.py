@@ -0,0 +1,16 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from store.invalidation import purge
+
+
+class Command(BaseCommand):
+    help = "Deletes cache invalidation events every worker has long applied. Run it from cron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24)
+
+    def handle(self, *args, **options):
+        deleted = purge(timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} invalidation events"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.facets import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the products' facets and the facet counts from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt the facets of {count} products"))
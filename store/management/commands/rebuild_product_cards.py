@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.cards import rebuild_cards
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the product card read model from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        count = rebuild_cards(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} product cards"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from store.counters import reconcile_likes
+
+
+class Command(BaseCommand):
+    help = "Recounts Product.total_likes and total_dislikes from the votes and repairs drifted products"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help="only report how many products drifted")
+
+    def handle(self, *args, **options):
+        checked, drifted = reconcile_likes(batch_size=options['batch_size'], dry_run=options['dry_run'])
+        verb = "would repair" if options['dry_run'] else "repaired"
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} products, {verb} {drifted}"))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from store.counters import reconcile_reviews
+
+
+class Command(BaseCommand):
+    help = "Recounts Product.total_reviews from the reviews and repairs drifted products"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--start-after', default=None,
+                            help="resume after this product id, as printed by a previous run")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="only report how many products drifted")
+
+    def handle(self, *args, **options):
+        def progress(last_pk, checked, drifted):
+            if options['verbosity'] > 1:
+                self.stdout.write(f"up to {last_pk}: checked {checked}, drifted {drifted}")
+
+        checked, drifted = reconcile_reviews(batch_size=options['batch_size'],
+                                             dry_run=options['dry_run'],
+                                             start_after=options['start_after'],
+                                             progress=progress)
+        verb = "would repair" if options['dry_run'] else "repaired"
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} products, {verb} {drifted}"))
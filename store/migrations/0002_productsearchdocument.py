@@ -0,0 +1,61 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def add_search_vector(apps, schema_editor):
+    # the weighted tsvector and its GIN index only exist on postgres,
+    # other databases use the in-memory backend in store.search
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "ALTER TABLE store_productsearchdocument ADD COLUMN search_vector tsvector "
+        "GENERATED ALWAYS AS ("
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(brand, '')), 'B') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'C')"
+        ") STORED"
+    )
+    schema_editor.execute(
+        "CREATE INDEX store_productsearchdocument_vector_gin "
+        "ON store_productsearchdocument USING gin (search_vector)"
+    )
+
+
+def remove_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS store_productsearchdocument_vector_gin")
+    schema_editor.execute("ALTER TABLE store_productsearchdocument DROP COLUMN IF EXISTS search_vector")
+
+
+def populate_documents(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    ProductSearchDocument = apps.get_model('store', 'ProductSearchDocument')
+    documents = [ProductSearchDocument(product_id=product_id, name=name, brand=brand, description=description)
+                 for product_id, name, brand, description
+                 in Product.objects.values_list('id', 'name', 'brand', 'description').iterator()]
+    ProductSearchDocument.objects.bulk_create(documents, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='store.product')),
+                ('name', models.CharField(max_length=255)),
+                ('brand', models.CharField(max_length=100)),
+                ('description', models.TextField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(add_search_vector, remove_search_vector),
+        migrations.RunPython(populate_documents, migrations.RunPython.noop),
+    ]
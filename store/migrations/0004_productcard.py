@@ -0,0 +1,58 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import CharField, Count, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def populate_cards(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    ProductCard = apps.get_model('store', 'ProductCard')
+    Product_Image = apps.get_model('store', 'Product_Image')
+    OrderItem = apps.get_model('store', 'OrderItem')
+    Review = apps.get_model('store', 'Review')
+
+    first_image = Product_Image.objects.filter(product=OuterRef('pk')).order_by('pk').values('image')[:1]
+    units_sold = (OrderItem.objects.filter(product=OuterRef('pk')).order_by()
+                  .values('product').annotate(total=Sum('quantity')).values('total'))
+    reviews = (Review.objects.filter(product=OuterRef('pk')).order_by()
+               .values('product').annotate(total=Count('pk')).values('total'))
+    products = Product.objects.order_by().annotate(
+        card_thumbnail=Coalesce(Subquery(first_image), Value(''), output_field=CharField()),
+        card_units_sold=Coalesce(Subquery(units_sold, output_field=IntegerField()), 0),
+        card_reviews=Coalesce(Subquery(reviews, output_field=IntegerField()), 0),
+    )
+    ProductCard.objects.bulk_create(
+        [ProductCard(product_id=product.pk, name=product.name, brand=product.brand,
+                     description=product.description[:255], unit_price=product.unit_price,
+                     thumbnail=product.card_thumbnail, units_sold=product.card_units_sold,
+                     review_count=product.card_reviews, in_stock=product.inventory > 0)
+         for product in products.iterator()],
+        batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0003_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductCard',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='card', serialize=False, to='store.product')),
+                ('name', models.CharField(max_length=255)),
+                ('brand', models.CharField(max_length=100)),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('unit_price', models.PositiveIntegerField(default=0)),
+                ('thumbnail', models.CharField(blank=True, max_length=255)),
+                ('units_sold', models.PositiveIntegerField(default=0)),
+                ('review_count', models.PositiveIntegerField(default=0)),
+                ('in_stock', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(populate_cards, migrations.RunPython.noop),
+    ]
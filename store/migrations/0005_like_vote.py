@@ -0,0 +1,60 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:59
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def booleans_to_vote(apps, schema_editor):
+    Like = apps.get_model('store', 'Like')
+    Like.objects.filter(like=True).update(vote=1)
+    Like.objects.filter(dislike=True).update(vote=-1)
+
+
+def vote_to_booleans(apps, schema_editor):
+    Like = apps.get_model('store', 'Like')
+    Like.objects.filter(vote=1).update(like=True, dislike=None)
+    Like.objects.filter(vote=-1).update(like=None, dislike=True)
+
+
+def count_votes(apps, schema_editor):
+    Like = apps.get_model('store', 'Like')
+    Product = apps.get_model('store', 'Product')
+
+    def count(vote):
+        votes = (Like.objects.filter(product=OuterRef('pk'), vote=vote).order_by()
+                 .values('product').annotate(total=Count('pk')).values('total'))
+        return Coalesce(Subquery(votes, output_field=IntegerField()), 0)
+
+    Product.objects.update(total_likes=count(1), total_dislikes=count(-1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0004_productcard'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='like',
+            name='vote',
+            field=models.SmallIntegerField(choices=[(1, 'Like'), (0, 'No vote'), (-1, 'Dislike')], default=0),
+        ),
+        migrations.RunPython(booleans_to_vote, vote_to_booleans),
+        migrations.RemoveField(
+            model_name='like',
+            name='dislike',
+        ),
+        migrations.RemoveField(
+            model_name='like',
+            name='like',
+        ),
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['product', 'vote'], name='like_product_vote_idx'),
+        ),
+        migrations.RunPython(count_votes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:06
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_expected_amounts(apps, schema_editor):
+    # orders placed so far were checked against their total, in naira
+    Order = apps.get_model('store', 'Order')
+    Order.objects.update(expected_amount=F('total_amount') * 100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_review_feed_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+                ('event', models.CharField(max_length=50)),
+                ('reference', models.CharField(blank=True, max_length=100)),
+                ('payload', models.JSONField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='expected_amount',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(set_expected_amounts, migrations.RunPython.noop),
+    ]
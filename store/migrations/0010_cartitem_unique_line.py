@@ -0,0 +1,33 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:14
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # double clicks left several rows for the same line, fold them into the oldest
+    CartItem = apps.get_model('store', 'CartItem')
+    duplicates = (CartItem.objects.values('user', 'product', 'size')
+                  .annotate(rows=Count('pk'), total=Sum('quantity')).filter(rows__gt=1))
+    for line in duplicates:
+        rows = CartItem.objects.filter(user=line['user'], product=line['product'], size=line['size']).order_by('created_at')
+        keep = rows.first()
+        rows.exclude(pk=keep.pk).delete()
+        CartItem.objects.filter(pk=keep.pk).update(quantity=line['total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0009_stock_ledger'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('user', 'product', 'size'), name='cartitem_unique_line'),
+        ),
+    ]
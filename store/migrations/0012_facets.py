@@ -0,0 +1,98 @@
+# Generated by Django 5.0.6 on 2026-10-18 14:31
+
+from collections import Counter
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+PRICE_BANDS = (0, 5000, 10000, 25000, 50000)
+
+
+def price_band(unit_price):
+    lower = max(bound for bound in PRICE_BANDS if bound <= unit_price)
+    upper = next((bound for bound in PRICE_BANDS if bound > unit_price), None)
+    return f'{lower}-{upper}' if upper is not None else f'{lower}+'
+
+
+def populate_facets(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    Size = apps.get_model('store', 'Size')
+    ProductFacet = apps.get_model('store', 'ProductFacet')
+    FacetCount = apps.get_model('store', 'FacetCount')
+    StockMovement = apps.get_model('store', 'StockMovement')
+
+    # stock is the counter plus the movements not yet compacted, as ledger.with_stock() sums it
+    pending = StockMovement.objects.filter(compacted=False).order_by()
+    product_pending = dict(pending.values('product_id').annotate(total=models.Sum('quantity'))
+                           .values_list('product_id', 'total'))
+    size_pending = dict(pending.filter(size__isnull=False).values('size_id').annotate(total=models.Sum('quantity'))
+                        .values_list('size_id', 'total'))
+
+    values = {}
+    for product_id, brand, unit_price, inventory in Product.objects.values_list('pk', 'brand', 'unit_price',
+                                                                                 'inventory').iterator():
+        stock = inventory + product_pending.get(product_id, 0)
+        values[product_id] = {('brand', brand.strip().lower()), ('price', price_band(unit_price)),
+                              ('stock', 'in' if stock > 0 else 'out')}
+    for product_id, name in Product.categories.through.objects.values_list('product_id', 'category__name'):
+        values[product_id].add(('category', name.strip().lower()))
+    for product_id, sex in Product.genders.through.objects.values_list('product_id', 'gender__sex'):
+        values[product_id].add(('gender', sex.strip().lower()))
+    for size_id, product_id, size, quantity in Size.objects.values_list('pk', 'product_id', 'size', 'quantity'):
+        if quantity + size_pending.get(size_id, 0) > 0:
+            values[product_id].add(('size', size.strip().upper()))
+
+    counts = Counter()
+    facets = []
+    for product_id, product_values in values.items():
+        facets += [ProductFacet(product_id=product_id, facet=facet, value=value) for facet, value in product_values]
+        in_stock = ('stock', 'in') in product_values
+        counts.update(value for value in product_values if in_stock or value[0] == 'stock')
+    ProductFacet.objects.bulk_create(facets, batch_size=2000)
+    FacetCount.objects.bulk_create([FacetCount(facet=facet, value=value, count=count)
+                                    for (facet, value), count in counts.items()], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_invalidationevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=20)),
+                ('value', models.CharField(max_length=100)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProductFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=20)),
+                ('value', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='facetcount',
+            constraint=models.UniqueConstraint(fields=('facet', 'value'), name='facetcount_unique'),
+        ),
+        migrations.AddField(
+            model_name='productfacet',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='facets', to='store.product'),
+        ),
+        migrations.AddIndex(
+            model_name='productfacet',
+            index=models.Index(fields=['facet', 'value', 'product'], name='productfacet_value_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='productfacet',
+            constraint=models.UniqueConstraint(fields=('product', 'facet', 'value'), name='productfacet_unique'),
+        ),
+        migrations.RunPython(populate_facets, migrations.RunPython.noop),
+    ]
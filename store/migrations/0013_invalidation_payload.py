@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 15:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_facets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invalidationevent',
+            name='payload',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -2,8 +2,10 @@ import uuid
 from account.models import User
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Sum
 from django.db.models.query import QuerySet
-from .store_managers import productManager, sizeManager, productImageManager
+from .query_cache import CachingManager
+from .store_managers import productManager, sizeManager, productImageManager, reservationManager, stockMovementManager
 from django.core.validators import MinValueValidator
 import datetime
 import os
@@ -67,7 +69,7 @@ class Product(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
 
     # undeleted = productManager.UndeletedProductManager()
-    objects = models.Manager()
+    objects = productManager.ProductQuerySet.as_manager()
 
     def has_reviews(self) -> bool:
         """
@@ -88,8 +90,16 @@ class Product(models.Model):
         return self.reviews.all()
 
     @property
-    def in_stock(self):
-        return self.inventory > 0
+    def in_stock(self) -> bool:
+        """
+        whether the counter plus the stock movements not yet compacted
+        leave any, see store.ledger; products read through
+        ledger.with_stock carry the sum, others cost a query
+        """
+        stock = self.__dict__.get('stock')
+        if stock is None:
+            stock = self.inventory + (self.stock_movements.pending().aggregate(total=Sum('quantity'))['total'] or 0)
+        return stock > 0
 
 
     def __str__(self):
@@ -113,8 +123,70 @@ class Product(models.Model):
         ordering = [
             'name', 'brand'
             ]
+        indexes = [
+            # keyset pagination seeks on the catalog ordering plus id
+            models.Index(fields=['name', 'brand', 'id'], name='product_keyset_idx'),
+        ]
+
+
+
+
+class ProductSearchDocument(models.Model):
+    """
+    Search document of a product.
+
+    Holds the normalized text the search backends index, one row per
+    product, kept current by store.signals whenever a product is saved.
+    name is weighted highest, then brand, then description.
+    """
+    product = models.OneToOneField(Product,
+                                   on_delete=models.CASCADE,
+                                   primary_key=True,
+                                   related_name='search_document')
+    name = models.CharField(max_length=255)
+    brand = models.CharField(max_length=100)
+    description = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"search document for {self.name}"
+
+
+class ProductCard(models.Model):
+    """
+    Read model of a product card
+
+    Everything a card on the list pages shows, so a page of cards is read
+    with the product rows alone. Kept current by store.signals through
+    store.cards, and rebuilt in bulk by the rebuild_product_cards command.
+    """
+    product = models.OneToOneField(Product,
+                                   on_delete=models.CASCADE,
+                                   primary_key=True,
+                                   related_name='card')
+    name = models.CharField(max_length=255)
+    brand = models.CharField(max_length=100)
+    description = models.CharField(max_length=255, blank=True)
+    unit_price = models.PositiveIntegerField(default=0)
+    # storage name of the product's first image, urls are built when rendering
+    # since signed storage urls expire
+    thumbnail = models.CharField(max_length=255, blank=True)
+    units_sold = models.PositiveIntegerField(default=0)
+    review_count = models.PositiveIntegerField(default=0)
+    in_stock = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
+    @property
+    def thumbnail_url(self) -> str:
+        """
+        returns the url of the card's image
+        """
+        if not self.thumbnail:
+            return ''
+        return Product_Image._meta.get_field('image').storage.url(self.thumbnail)
 
+    def __str__(self):
+        return f"card for {self.name}"
 
 
 class Size(models.Model):
@@ -132,6 +204,7 @@ class Size(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
 
     # undeleted = sizeManager.UndeletedSizeManager()
+    # not query cached (see query_cache.py), its quantity is stock that checkout must read fresh
     objects = models.Manager()
 
     def clean(self):
@@ -172,6 +245,8 @@ class Category(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
 
+    objects = CachingManager()
+
     def __str__(self):
         return self.name
 
@@ -196,6 +271,8 @@ class Gender(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
 
+    objects = CachingManager()
+
     def __str__(self):
         return self.sex
 
@@ -221,6 +298,10 @@ class CartItem(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        constraints = [
+            # one line per size of a product, cart writes upsert on it (see cart.py)
+            models.UniqueConstraint(fields=['user', 'product', 'size'], name='cartitem_unique_line'),
+        ]
 
     def __str__(self):
         return f'{self.user.get_full_name()} {self.product.name} {self.quantity} {self.size}'
@@ -247,6 +328,8 @@ class Order(models.Model):
     # billing_address = models.TextField()
     # payment_method = models.CharField(max_length=50)
     payment_status = models.CharField(max_length=20, default='UNPAID')
+    # what paystack must report as paid, in kobo, fixed when the order is placed
+    expected_amount = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
@@ -258,6 +341,144 @@ class Order(models.Model):
         ordering = ['created_at']
         unique_together = ['order_number', 'user']
 
+class Reservation(models.Model):
+    """
+    A hold on units of a size for an order awaiting payment. A hold counts
+    against the size's stock until expires_at; payment turns it into a sale
+    (see reservations.py).
+    """
+    size = models.ForeignKey(Size, on_delete=models.CASCADE, related_name='reservations')
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
+
+    objects = reservationManager.ReservationQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.quantity} of {self.size_id} held for {self.order_id} until {self.expires_at}"
+
+    class Meta:
+        indexes = [
+            # live holds of a size are summed on every stock read and hold
+            models.Index(fields=['size', 'expires_at'], name='reservation_live_idx'),
+            # the sweeper finds expired holds without a scan
+            models.Index(fields=['expires_at'], name='reservation_expiry_idx'),
+        ]
+
+
+class StockMovement(models.Model):
+    """
+    An append-only ledger entry of stock coming in or going out: a signed
+    quantity of a product, and of one of its sizes if size is set.
+
+    A product's stock is Product.inventory plus its movements that haven't
+    been compacted, likewise for Size.quantity; compaction rolls movements
+    into those columns and marks them compacted (see ledger.py). The rows are
+    kept as the audit trail.
+    """
+    RECEIPT = 'RECEIPT'
+    SALE = 'SALE'
+    ADJUSTMENT = 'ADJUSTMENT'
+    KIND_CHOICES = [
+        (RECEIPT, 'Receipt'),
+        (SALE, 'Sale'),
+        (ADJUSTMENT, 'Adjustment'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_movements')
+    # sizes are deleted when they sell out, the label keeps the history readable
+    size = models.ForeignKey(Size, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    size_label = models.CharField(max_length=4, blank=True)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='stock_movements')
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    quantity = models.IntegerField()
+    note = models.CharField(max_length=255, blank=True)
+    compacted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = stockMovementManager.StockMovementQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.kind} {self.quantity:+} of {self.product_id} {self.size_label}"
+
+    class Meta:
+        indexes = [
+            # compaction walks the pending movements in order
+            models.Index(fields=['id'], condition=models.Q(compacted=False), name='movement_pending_idx'),
+            # stock reads sum the pending movements of a product or size
+            models.Index(fields=['product'], condition=models.Q(compacted=False), name='movement_pending_product_idx'),
+            models.Index(fields=['size'], condition=models.Q(compacted=False), name='movement_pending_size_idx'),
+        ]
+
+
+class PaymentEvent(models.Model):
+    """
+    A paystack webhook event, stored once per event so redelivered or
+    replayed events are acknowledged without being processed again
+    """
+    key = models.CharField(max_length=100, unique=True)  # "<event>:<paystack id>"
+    event = models.CharField(max_length=50)
+    reference = models.CharField(max_length=100, blank=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.key
+
+
+class ProductFacet(models.Model):
+    """
+    One value of one facet of a product: a category, gender, brand, price
+    band, size in stock, or whether it is in stock. Faceted filtering looks
+    products up here instead of joining the m2m tables; kept current by
+    store/facets.py
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='facets')
+    facet = models.CharField(max_length=20)
+    value = models.CharField(max_length=100)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'facet', 'value'], name='productfacet_unique'),
+        ]
+        indexes = [
+            # the products having a value, for the filters and the counts
+            models.Index(fields=['facet', 'value', 'product'], name='productfacet_value_idx'),
+        ]
+
+
+class FacetCount(models.Model):
+    """
+    The number of listed products having a facet value, what the listing's
+    facet counts show when nothing is filtered; kept current by store/facets.py
+    """
+    facet = models.CharField(max_length=20)
+    value = models.CharField(max_length=100)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['facet', 'value'], name='facetcount_unique'),
+        ]
+
+
+class InvalidationEvent(models.Model):
+    """
+    A cache invalidation broadcast to the worker processes. The id is the
+    sequence number workers catch up by, see store/invalidation.py
+    """
+    key = models.CharField(max_length=255)  # "<kind>:<name>", e.g. "table:store_category"
+    payload = models.TextField(blank=True, default='')  # the name instead, when too long for the key
+    origin = models.CharField(max_length=32)  # the publishing process, which has applied it already
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.pk} {self.key}"
+
+
 class OrderItem(models.Model):
     """
     Order Item Model
@@ -287,25 +508,39 @@ class OrderItem(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='orderitem_keyset_idx'),
+        ]
 
 
 class Like(models.Model):
     """
     Likes model
+
+    One vote per user and product: 1 is a like, -1 a dislike and 0 no vote.
+    Product.total_likes and total_dislikes count them, see store.votes
     """
+    LIKE = 1
+    NO_VOTE = 0
+    DISLIKE = -1
+    VOTE_CHOICES = (
+        (LIKE, 'Like'),
+        (NO_VOTE, 'No vote'),
+        (DISLIKE, 'Dislike'),
+    )
+
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='likes')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='likes')
-    like = models.BooleanField(null=True, blank=True)
-    dislike = models.BooleanField(null=True, blank=True)
+    vote = models.SmallIntegerField(choices=VOTE_CHOICES, default=NO_VOTE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True)
 
     def is_like(self):
-        return self.like == 1
+        return self.vote == self.LIKE
 
     def is_dislike(self):
-        return self.dislike == 1
+        return self.vote == self.DISLIKE
 
     def __str__(self):
         if self.is_like():
@@ -316,6 +551,10 @@ class Like(models.Model):
     
     class Meta:
         unique_together = ['user', 'product']
+        indexes = [
+            # counter reconciliation counts votes per product
+            models.Index(fields=['product', 'vote'], name='like_product_vote_idx'),
+        ]
 
 
 class Review(models.Model):
@@ -336,6 +575,10 @@ class Review(models.Model):
     class Meta:
         unique_together = ['user', 'product']
         ordering = ['-created_at']
+        indexes = [
+            # the review feed seeks on (created_at, id) within a product
+            models.Index(fields=['product', '-created_at', '-id'], name='review_feed_idx'),
+        ]
 
 class ImageReviews(models.Model):
     """
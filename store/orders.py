@@ -0,0 +1,48 @@
+"""
+Order placement.
+
+place_order turns the buyer's cart into an order in one transaction with a
+fixed number of queries however many items the cart holds: the cart lines
+are read once, locked, with their products and line totals, the order total
+is summed from those same lines and the order items are written with a
+single bulk_create.
+"""
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import F
+
+from . import cards, fragments, ledger
+from .models import CartItem, Order, OrderItem
+
+
+def place_order(user, shipping_address: str | None = None) -> Order | None:
+    """
+    creates an order of the user's in-stock cart items
+    returns None if there is nothing in stock in the cart
+    """
+    cart = (ledger.in_stock(CartItem.objects.filter(user=user), 'product')
+            .annotate(line_total=F('quantity') * F('product__unit_price')))
+
+    with transaction.atomic():
+        # one read, so the total and the items are of the same lines
+        lines = list(cart.select_related('product').select_for_update(of=('self',)))
+        total_price = sum(cart_item.line_total for cart_item in lines)
+        if not total_price:
+            return None
+
+        order = Order.objects.create(user=user, total_amount=total_price,
+                                     expected_amount=total_price * 100,
+                                     shipping_address=shipping_address)
+        items = [OrderItem(order=order, product_id=cart_item.product_id, quantity=cart_item.quantity,
+                           unit_price=cart_item.product.unit_price, total_price=cart_item.line_total,
+                           size=cart_item.size)
+                 for cart_item in lines]
+        OrderItem.objects.bulk_create(items)
+
+        sold = Counter()
+        for item in items:
+            sold[item.product_id] += item.quantity
+        cards.add_units_sold_many(sold)
+        fragments.bump(*sold, catalog=False)
+    return order
@@ -0,0 +1,113 @@
+"""
+Whole page cache for anonymous visitors to the catalog.
+
+Anonymous visitors all get the same catalog pages, so those are cached
+whole, keyed on the path, the query string and the HX-Request header (the
+things get_template_names picks a template by) together with a version
+stamp: the product's for a detail page, the catalog's for the listing (see
+fragments.py). A write to a product changes the stamp, so the old pages are
+never read again and expire on their own.
+
+Nothing personal is cached. Pages are rendered with a placeholder in place
+of the csrf token, which is swapped for the visitor's own token when the
+page is served; the viewer's vote and review form are loaded separately
+(ProductViewerView) and only for signed in users. Visitors with flash
+messages waiting are rendered as usual.
+
+When a popular page expires many requests miss at once. Only the one that
+takes the recompute lock renders it; the others wait up to LOCK_WAIT for
+its result and render it themselves if it doesn't come.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+from . import fragments
+
+# pages are keyed by version, this only bounds memory of unvisited pages
+PAGE_TIMEOUT = 60 * 60
+# how long a recompute may hold its lock before another request takes over
+LOCK_TIMEOUT = 10
+# how long requests that didn't get the lock wait for the page
+LOCK_WAIT = 2
+LOCK_POLL = 0.05
+
+CSRF_PLACEHOLDER = 'csrf-token-7c0e4f1d-page-cache'
+
+
+def _cache():
+    return caches[getattr(settings, 'STORE_PAGE_CACHE', 'default')]
+
+
+class AnonymousPageCacheMixin:
+    """
+    Serves GETs of anonymous visitors from the page cache. Views call
+    cached_page() with the page's version stamp and a callable rendering it
+    when page_cacheable() says so.
+    """
+    rendering_cached_page = False
+
+    def page_cacheable(self) -> bool:
+        return (self.request.method == 'GET' and not self.request.user.is_authenticated
+                and not len(messages.get_messages(self.request)))
+
+    def get_page_key(self, version: str) -> str:
+        request = self.request
+        vary = '|'.join([request.path, request.META.get('QUERY_STRING', ''), request.headers.get('HX-Request', '')])
+        return f'store:page:{version}:{hashlib.md5(vary.encode()).hexdigest()}'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        if self.rendering_cached_page:
+            context['csrf_token'] = CSRF_PLACEHOLDER
+        return context
+
+    def _render_for_cache(self, render):
+        self.rendering_cached_page = True
+        try:
+            response = render()
+            if hasattr(response, 'render'):
+                response.render()
+        finally:
+            self.rendering_cached_page = False
+        if response.status_code != 200:
+            return None, response
+        return (response.content.decode(response.charset), response['Content-Type']), response
+
+    def _wait_for(self, cache, key):
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL)
+            page = cache.get(key)
+            if page is not None:
+                return page
+        return None
+
+    def cached_page(self, version: str, render):
+        cache = _cache()
+        key = self.get_page_key(version)
+        page = cache.get(key)
+        if page is None:
+            lock = f'{key}:lock'
+            if cache.add(lock, 1, LOCK_TIMEOUT):
+                try:
+                    page, response = self._render_for_cache(render)
+                    if page is None:
+                        return response
+                    cache.set(key, page, fragments.media_timeout(PAGE_TIMEOUT))
+                finally:
+                    cache.delete(lock)
+            else:
+                page = self._wait_for(cache, key)
+                if page is None:
+                    page, response = self._render_for_cache(render)
+                    if page is None:
+                        return response
+
+        content, content_type = page
+        return HttpResponse(content.replace(CSRF_PLACEHOLDER, get_token(self.request)), content_type=content_type)
@@ -0,0 +1,215 @@
+"""
+Keyset (cursor) pagination.
+
+Instead of OFFSET/LIMIT and a COUNT(*), each page seeks past the ordering
+values of the last row of the previous page, so every page costs the same
+indexed range scan however deep it is, and no total is computed.
+
+Cursors are opaque url safe tokens carried in the `page` query parameter,
+so the existing `hx-get="?page=..."` buttons keep working.
+"""
+import base64
+import datetime
+import json
+import uuid
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from django.http import Http404, QueryDict
+from django.utils.translation import gettext_lazy as _
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+def _json_default(value):
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f"can't put {type(value).__name__} in a cursor")
+
+
+class KeysetPage:
+    """
+    A page of a KeysetPaginator, shaped like django's Page for the templates
+    """
+
+    def __init__(self, object_list, next_cursor, previous_cursor, query_params=None,
+                 cursor_query_param='page'):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.query_params = query_params if query_params is not None else QueryDict()
+        self.cursor_query_param = cursor_query_param
+
+    def __repr__(self):
+        return f"<KeysetPage of {len(self.object_list)} items>"
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    def has_other_pages(self) -> bool:
+        return self.has_next() or self.has_previous()
+
+    def _querystring(self, cursor) -> str:
+        params = self.query_params.copy()
+        params[self.cursor_query_param] = cursor
+        return params.urlencode()
+
+    def next_querystring(self) -> str:
+        """
+        the current query string pointing at the next page, filters included
+        """
+        return self._querystring(self.next_cursor)
+
+    def previous_querystring(self) -> str:
+        return self._querystring(self.previous_cursor)
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset by seeking on `ordering`.
+
+    ordering is a sequence of field or annotation names, optionally prefixed
+    with '-', that must end in a unique field so every row has a distinct key,
+    e.g. ('name', 'brand', 'id'). There should be an index matching it.
+    """
+
+    def __init__(self, queryset, per_page: int, ordering, cursor_query_param: str = 'page'):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.cursor_query_param = cursor_query_param
+        self.ordering = [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+
+    def encode_cursor(self, obj, direction: str) -> str:
+        key = [getattr(obj, field) for field, _ in self.ordering]
+        payload = json.dumps([direction, key], default=_json_default, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor: str) -> tuple[str, list]:
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            direction, key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        except (ValueError, TypeError):
+            raise InvalidCursor(_("That page is not valid"))
+        if direction not in ('n', 'p') or not isinstance(key, list) or len(key) != len(self.ordering):
+            raise InvalidCursor(_("That page is not valid"))
+        # a value its field can't take would fail in the database instead
+        for (name, _descending), value in zip(self.ordering, key):
+            field = self._field(name)
+            if field is None:
+                continue
+            try:
+                field.to_python(value)
+            except (ValidationError, ValueError, TypeError):
+                raise InvalidCursor(_("That page is not valid"))
+        return direction, key
+
+    def _field(self, name: str):
+        """
+        the model field or annotation output field an ordering name sorts by, None if unknown
+        """
+        opts = self.queryset.model._meta
+        if name == 'pk':
+            return opts.pk
+        try:
+            return opts.get_field(name)
+        except FieldDoesNotExist:
+            annotation = self.queryset.query.annotations.get(name)
+            return annotation.output_field if annotation is not None else None
+
+    def _seek(self, key: list, backwards: bool) -> Q:
+        """
+        rows strictly after key in the ordering (before it when backwards),
+        e.g. for (name, id): name > a OR (name = a AND id > b)
+        """
+        condition = Q()
+        equal = Q()
+        for (field, descending), value in zip(self.ordering, key):
+            lookup = 'lt' if descending != backwards else 'gt'
+            condition |= equal & Q(**{f'{field}__{lookup}': value})
+            equal &= Q(**{field: value})
+
+        # a bound on the leading column lets the database range scan the index
+        field, descending = self.ordering[0]
+        lookup = 'lte' if descending != backwards else 'gte'
+        return Q(**{f'{field}__{lookup}': key[0]}) & condition
+
+    def _order_by(self, backwards: bool) -> list[str]:
+        return [f'-{field}' if descending != backwards else field for field, descending in self.ordering]
+
+    def fetch(self, key: list | None, backwards: bool) -> list:
+        """
+        up to per_page + 1 rows after key (before it when backwards), nearest first
+        """
+        queryset = self.queryset
+        if key is not None:
+            queryset = queryset.filter(self._seek(key, backwards))
+        return list(queryset.order_by(*self._order_by(backwards))[:self.per_page + 1])
+
+    def page(self, cursor: str | None, query_params=None) -> KeysetPage:
+        key = None
+        backwards = False
+        if cursor:
+            direction, key = self.decode_cursor(cursor)
+            backwards = direction == 'p'
+
+        rows = self.fetch(key, backwards)
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        next_cursor = previous_cursor = None
+        if rows:
+            if has_more or backwards:
+                next_cursor = self.encode_cursor(rows[-1], 'n')
+            if (has_more and backwards) or (cursor and not backwards):
+                previous_cursor = self.encode_cursor(rows[0], 'p')
+        return KeysetPage(rows, next_cursor, previous_cursor, query_params, self.cursor_query_param)
+
+
+class KeysetPaginationMixin:
+    """
+    Makes a ListView paginate with a KeysetPaginator.
+
+    Set keyset_ordering on the view (or override get_keyset_ordering) along
+    with paginate_by.
+    """
+    keyset_ordering = None
+    page_kwarg = 'page'
+
+    def get_keyset_ordering(self):
+        return self.keyset_ordering
+
+    def get_page_query_params(self):
+        """
+        the query parameters the next/previous links carry over
+        """
+        return self.request.GET
+
+    def get_keyset_paginator(self, queryset, page_size) -> KeysetPaginator:
+        return KeysetPaginator(queryset, page_size, self.get_keyset_ordering(), self.page_kwarg)
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = self.get_keyset_paginator(queryset, page_size)
+        try:
+            page = paginator.page(self.request.GET.get(self.page_kwarg), self.get_page_query_params())
+        except InvalidPage as e:
+            raise Http404(str(e))
+        return paginator, page, page.object_list, page.has_other_pages()
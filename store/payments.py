@@ -0,0 +1,153 @@
+"""
+Payment confirmation from paystack webhooks.
+
+Paystack posts signed events to the webhook, which stores each one in
+PaymentEvent once (keyed by event and paystack id) and queues a job for a
+charge.success or charge.failed; redelivered events only get acknowledged,
+and events without an id or reference are rejected. A failed charge marks
+its unpaid order FAILED and releases its holds. The job confirms
+the order under a row lock, so however often an event is processed the
+inventory is decremented once, and only when the paid amount matches the
+order's expected_amount. Stock is taken by stock.commit_stock, and an order
+that sold out in the meantime is marked OVERSOLD for a refund. The browser
+callback reads the order's state, asking paystack about a charge it hasn't
+heard of yet so a failed one isn't reported as being confirmed.
+"""
+import hashlib
+import hmac
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from jobs.queue import enqueue
+from . import fragments, reservations
+from .models import CartItem, Order, PaymentEvent
+from .stock import OutOfStock, commit_stock
+
+logger = logging.getLogger(__name__)
+
+# events the worker acts on
+PROCESSED_EVENTS = ('charge.success', 'charge.failed')
+
+# transaction statuses of charges that won't be paid
+FAILED_STATUSES = ('failed', 'abandoned', 'reversed')
+
+
+def valid_signature(body: bytes, signature: str) -> bool:
+    """
+    checks the X-Paystack-Signature header, an HMAC SHA512 of the body with the secret key
+    """
+    secret = getattr(settings, 'PAYSATCK_SECRETE_KEY', None)
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha512).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def record_event(event: dict) -> bool:
+    """
+    stores the event and queues its processing, unless it was seen before
+    returns whether the event was new
+    raises ValueError if the event has no name, or no id or reference to tell it apart
+    """
+    data = event.get('data') if isinstance(event, dict) else None
+    if not isinstance(data, dict):
+        raise ValueError("payment event without data")
+    name = event.get('event') or ''
+    event_id = data.get('id') or data.get('reference')
+    if not name or not event_id:
+        raise ValueError("payment event without a name, id or reference")
+    key = f"{name}:{event_id}"
+    try:
+        with transaction.atomic():
+            payment_event = PaymentEvent.objects.create(key=key, event=name,
+                                                        reference=data.get('reference') or '',
+                                                        payload=event)
+            if name in PROCESSED_EVENTS:
+                enqueue('store.process_payment_event', {'event_id': payment_event.pk})
+    except IntegrityError:
+        return False
+    return True
+
+
+def confirm_payment(reference: str, amount: int) -> str | None:
+    """
+    marks the order paid if amount (in kobo) is what it expects, takes its
+    items out of stock and the buyer's cart, and queues the confirmation email
+    returns the order's payment status, None if there is no such order
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(order_number=reference).first()
+        if order is None:
+            logger.warning("payment for unknown order %s", reference)
+            return None
+        if order.payment_status == 'PAID':
+            return order.payment_status
+
+        if amount != order.expected_amount:
+            logger.warning("order %s paid %s, expected %s", reference, amount, order.expected_amount)
+            order.payment_status = 'AMOUNT_MISMATCH'
+            order.save(update_fields=['payment_status', 'updated_at'])
+            return order.payment_status
+
+        items = list(order.order_items.all())
+        try:
+            commit_stock(items, order_id=order.pk)
+        except OutOfStock as e:
+            # paid for but sold out meanwhile, the order is left for a refund
+            logger.error("order %s oversold: %s", reference, e.shortages)
+            reservations.release(order)
+            order.payment_status = 'OVERSOLD'
+            order.save(update_fields=['payment_status', 'updated_at'])
+            return order.payment_status
+        CartItem.objects.filter(user_id=order.user_id, product__in=[item.product_id for item in items]).delete()
+
+        order.payment_status = 'PAID'
+        order.save(update_fields=['payment_status', 'updated_at'])
+        # the buyer may review the products now, which changes their pages
+        fragments.bump(*{item.product_id for item in items}, catalog=False)
+        # the worker emails the user and admin concerning the payment
+        enqueue('store.send_order_confirmation', {'order_number': reference})
+        return order.payment_status
+
+
+def fail_payment(reference: str) -> str | None:
+    """
+    marks the order FAILED and releases its holds, unless it was settled already;
+    a later successful charge still confirms it
+    returns the order's payment status, None if there is no such order
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(order_number=reference).first()
+        if order is None:
+            logger.warning("failed payment for unknown order %s", reference)
+            return None
+        if order.payment_status != 'UNPAID':
+            return order.payment_status
+        reservations.release(order)
+        order.payment_status = 'FAILED'
+        order.save(update_fields=['payment_status', 'updated_at'])
+        return order.payment_status
+
+
+def process_event(event_id) -> None:
+    payment_event = PaymentEvent.objects.get(pk=event_id)
+    if payment_event.processed_at is not None:
+        return
+    data = payment_event.payload.get('data') or {}
+    reference = data.get('reference')
+    if data.get('status') == 'success':
+        try:
+            amount = int(data.get('amount'))
+        except (TypeError, ValueError):
+            amount = None
+        if reference and amount is not None:
+            confirm_payment(reference, amount)
+        else:
+            # retrying won't make it whole
+            logger.error("payment event %s without a reference or amount: %s", event_id, data)
+    elif data.get('status') in FAILED_STATUSES and reference:
+        fail_payment(reference)
+    PaymentEvent.objects.filter(pk=event_id).update(processed_at=timezone.now())
@@ -1,13 +1,199 @@
-from config.settings import PAYSATCK_SECRETE_KEY
+"""
+Paystack API client.
+
+One PaystackClient per process keeps a pooled keep-alive session, so a
+checkout doesn't pay for a fresh TLS handshake, and bounds every call with
+connect/read timeouts. Connection failures are retried for every call since
+nothing reached Paystack; read failures and 429/5xx responses are retried
+only for the idempotent GETs. A circuit breaker fails calls fast while
+Paystack keeps failing, and each call's latency is recorded in `metrics`.
+
+The base url comes from the PAYSTACK_BASE_URL setting so tests and local
+development can point the client at a fake server.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
 import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = "https://api.paystack.co"
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class PaystackError(Exception):
+    """
+    a call to paystack failed without a response
+    """
+
+
+class PaystackUnavailable(PaystackError):
+    """
+    the circuit breaker is open, so the call wasn't made
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls
+    until reset_timeout seconds have passed, then lets one trial call through
+    (half open): success closes it again, failure reopens it.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return
+            raise PaystackUnavailable("paystack is failing, not calling it for now")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("paystack circuit opened after %s failures", self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class CallMetrics:
+    """
+    latencies of the most recent calls per operation
+    """
+
+    def __init__(self, keep: int = 1000):
+        self.latencies = defaultdict(lambda: deque(maxlen=keep))
+        self.errors = defaultdict(int)
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, operation: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.calls[operation] += 1
+            self.latencies[operation].append(seconds)
+            if not ok:
+                self.errors[operation] += 1
+
+    def summary(self) -> dict:
+        """
+        {operation: {calls, errors, p50_ms, p95_ms, max_ms}}
+        """
+        with self._lock:
+            summary = {}
+            for operation, latencies in self.latencies.items():
+                ordered = sorted(latencies)
+                summary[operation] = {
+                    'calls': self.calls[operation],
+                    'errors': self.errors[operation],
+                    'p50_ms': round(ordered[len(ordered) // 2] * 1000, 1),
+                    'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                    'max_ms': round(ordered[-1] * 1000, 1),
+                }
+            return summary
+
+
+metrics = CallMetrics()
+
+
+class PaystackClient:
+
+    def __init__(self, secret_key: str, base_url: str = BASE_URL, connect_timeout: float = 3.05,
+                 read_timeout: float = 10, retries: int = 2, backoff: float = 0.3, pool_size: int = 10,
+                 breaker: CircuitBreaker | None = None, metrics: CallMetrics = metrics):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = metrics
+
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset({'GET'}), raise_on_status=False)
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f"Bearer {secret_key}"
+        self.session.mount(self.base_url, HTTPAdapter(pool_maxsize=pool_size, max_retries=retry))
+
+    def _request(self, operation: str, method: str, path: str, **kwargs) -> requests.Response:
+        self.breaker.before_call()
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            self.metrics.record(operation, time.perf_counter() - start, ok=False)
+            raise PaystackError(f"paystack {operation} failed: {e}") from e
+
+        elapsed = time.perf_counter() - start
+        ok = response.status_code < 500
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        self.metrics.record(operation, elapsed, ok)
+        logger.info("paystack %s %s in %.0fms", operation, response.status_code, elapsed * 1000)
+        return response
+
+    def initiate_transaction(self, params: dict) -> requests.Response:
+        return self._request('initialize', 'POST', '/transaction/initialize', json=params)
+
+    def verify_transaction(self, reference: str) -> requests.Response:
+        return self._request('verify', 'GET', f'/transaction/verify/{reference}')
+
+    # async views share the pooled session by running the call in a thread
+    async def ainitiate_transaction(self, params: dict) -> requests.Response:
+        return await asyncio.to_thread(self.initiate_transaction, params)
+
+    async def averify_transaction(self, reference: str) -> requests.Response:
+        return await asyncio.to_thread(self.verify_transaction, reference)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> PaystackClient:
+    """
+    the process wide client, created on first use
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PaystackClient(settings.PAYSATCK_SECRETE_KEY,
+                                         getattr(settings, 'PAYSTACK_BASE_URL', BASE_URL))
+    return _client
 
-url = "https://api.paystack.co/transaction/initialize"
-authorization = f"Bearer {PAYSATCK_SECRETE_KEY}"
 
 def initiate_transaction(params):
-    return requests.post(url,
-                         headers={"Authorization": authorization},
-                         json=params)
+    return get_client().initiate_transaction(params)
+
+
 def verify_transaction(reference):
-    return requests.get(f"https://api.paystack.co/transaction/verify/{reference}",
-                        headers={"Authorization": authorization})
\ No newline at end of file
+    return get_client().verify_transaction(reference)
@@ -0,0 +1,269 @@
+"""
+A cache of queryset results for tables that rarely change.
+
+Models opt in by using a CachingManager:
+
+    objects = CachingManager()
+
+Evaluating one of their querysets looks the results up under the query's
+compiled sql and params first. Only queries that read nothing but opted in
+tables are cached, so a join or subquery into any other table makes the
+query run as usual; so do select_for_update, prefetch_related and
+iterator().
+
+Writes drop the entries of the tables they touch: post_save, post_delete
+and m2m_changed of the opted in models, and the bulk queryset writes
+(update, bulk_create, bulk_update, delete), which send no signals. Other
+workers hear of them through the invalidation bus (invalidation.py). Inside a
+transaction a written table isn't cached until the transaction commits, so
+nobody caches rows that may still be rolled back, and a query that raced a
+write (the table changed while it ran) isn't stored.
+
+The cache is per process, a least recently used list bounded by the pickled
+size of the results (STORE_QUERY_CACHE_MAX_BYTES, 4MB by default). stats()
+reports hits and misses per model.
+"""
+import pickle
+import threading
+from collections import Counter, OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, models, transaction
+from django.db.models.query import FlatValuesListIterable, ModelIterable, ValuesIterable, ValuesListIterable
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from . import invalidation
+
+MAX_BYTES = 4 * 1024 * 1024
+
+CACHED_ITERABLES = (ModelIterable, ValuesIterable, ValuesListIterable, FlatValuesListIterable)
+
+
+class QueryCache:
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (pickled results, tables)
+        self.by_table = defaultdict(set)
+        self.generations = Counter()
+        self.size = 0
+        self.stats = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def get(self, key, label: str):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats[label]['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats[label]['hits'] += 1
+        return pickle.loads(entry[0])
+
+    def set(self, key, tables: frozenset, results: list, generations: tuple) -> None:
+        data = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+        # a single result set may take up to a tenth of the cache
+        if len(data) > self.max_bytes // 10:
+            return
+        with self._lock:
+            if generations != self.generations_of(tables):
+                # a write to the tables landed while the query ran
+                return
+            self._remove(key)
+            self.entries[key] = (data, tables)
+            self.size += len(data)
+            for table in tables:
+                self.by_table[table].add(key)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def generations_of(self, tables) -> tuple:
+        return tuple(self.generations[table] for table in sorted(tables))
+
+    def _remove(self, key) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[0])
+        for table in entry[1]:
+            self.by_table[table].discard(key)
+
+    def invalidate(self, table: str) -> None:
+        with self._lock:
+            self.generations[table] += 1
+            for key in list(self.by_table.pop(table, ())):
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+            self.by_table.clear()
+            self.size = 0
+            self.stats.clear()
+
+
+cache = QueryCache(getattr(settings, 'STORE_QUERY_CACHE_MAX_BYTES', MAX_BYTES))
+
+# db tables of opted in models, and the models to connect signals for
+cached_tables = set()
+cached_models = []
+
+# tables written by the current thread's open transactions, per database
+_local = threading.local()
+
+
+def _dirty(using: str) -> set:
+    dirty = getattr(_local, 'dirty', None)
+    if dirty is None:
+        dirty = _local.dirty = defaultdict(set)
+    if not connections[using].in_atomic_block:
+        # whatever was written before has been committed or rolled back by now
+        dirty[using].clear()
+    return dirty[using]
+
+
+def register(model) -> None:
+    if model._meta.db_table not in cached_tables:
+        cached_tables.add(model._meta.db_table)
+        cached_models.append(model)
+
+
+def table_written(table: str, using: str) -> None:
+    """
+    drops the table's entries, and keeps it out of the cache until the
+    current transaction (if any) commits; the other workers drop theirs
+    when the invalidation reaches them
+    """
+    cache.invalidate(table)
+    invalidation.publish('table', table)
+    if connections[using].in_atomic_block:
+        dirty = _dirty(using)
+        dirty.add(table)
+
+        def committed():
+            dirty.discard(table)
+            cache.invalidate(table)
+        transaction.on_commit(committed, using=using)
+
+
+_quoted_tables = {}
+
+
+def _tables_in(sql: str, using: str) -> frozenset:
+    quoted = _quoted_tables.get(using)
+    if quoted is None:
+        connection = connections[using]
+        quoted = _quoted_tables[using] = {connection.ops.quote_name(table): table
+                                          for table in connection.introspection.django_table_names()}
+    return frozenset(table for name, table in quoted.items() if name in sql)
+
+
+def stats() -> dict:
+    """
+    {model label: {'hits': .., 'misses': .., 'hit_rate': ..}} of this process
+    """
+    with cache._lock:
+        return {label: {'hits': counts['hits'], 'misses': counts['misses'],
+                        'hit_rate': counts['hits'] / (counts['hits'] + counts['misses'])}
+                for label, counts in cache.stats.items()}
+
+
+def reset() -> None:
+    """
+    empties the cache and its statistics
+    """
+    cache.clear()
+    getattr(_local, 'dirty', {}).clear()
+
+
+class CachingQuerySet(models.QuerySet):
+
+    def _cache_key(self):
+        """
+        (key, tables) of the query, or None if it may not be cached
+        """
+        if (self.query.select_for_update or self._prefetch_related_lookups or
+                self._iterable_class not in CACHED_ITERABLES):
+            return None
+        try:
+            sql, params = self.query.get_compiler(using=self.db).as_sql()
+        except EmptyResultSet:
+            return None
+        tables = _tables_in(sql, self.db)
+        if not tables or not tables <= cached_tables or tables & _dirty(self.db):
+            return None
+        return (self.db, self._iterable_class.__name__, sql, repr(params)), tables
+
+    def _fetch_all(self):
+        if self._result_cache is None:
+            cacheable = self._cache_key()
+            if cacheable is not None:
+                key, tables = cacheable
+                label = self.model._meta.label
+                results = cache.get(key, label)
+                if results is None:
+                    generations = cache.generations_of(tables)
+                    super()._fetch_all()
+                    cache.set(key, tables, self._result_cache, generations)
+                else:
+                    self._result_cache = results
+                return
+        super()._fetch_all()
+
+    def _written(self):
+        table_written(self.model._meta.db_table, self.db)
+
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        self._written()
+        return rows
+    update.alters_data = True
+
+    def delete(self):
+        deleted = super().delete()
+        self._written()
+        return deleted
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super().bulk_create(objs, *args, **kwargs)
+        self._written()
+        return created
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        rows = super().bulk_update(objs, fields, batch_size)
+        self._written()
+        return rows
+    bulk_update.alters_data = True
+
+
+class CachingManager(models.Manager.from_queryset(CachingQuerySet)):
+    """
+    a manager whose querysets are cached, see store/query_cache.py
+    """
+
+    def contribute_to_class(self, cls, name):
+        super().contribute_to_class(cls, name)
+        if not cls._meta.abstract:
+            register(cls)
+
+
+def _model_written(sender, using='default', **kwargs):
+    table_written(sender._meta.db_table, using)
+
+
+def connect_signals() -> None:
+    """
+    invalidates the opted in tables on writes through the models, called once the apps are ready
+    """
+    invalidation.subscribe('table', cache.invalidate)
+    for model in list(cached_models):
+        post_save.connect(_model_written, sender=model, dispatch_uid=f'query_cache_save_{model._meta.label}')
+        post_delete.connect(_model_written, sender=model, dispatch_uid=f'query_cache_delete_{model._meta.label}')
+        for field in model._meta.many_to_many:
+            through = field.remote_field.through
+            cached_tables.add(through._meta.db_table)
+            m2m_changed.connect(_model_written, sender=through,
+                                dispatch_uid=f'query_cache_m2m_{through._meta.label}')
@@ -0,0 +1,98 @@
+"""
+Time bounded holds on stock while an order is being paid for.
+
+When checkout hands the buyer to paystack, hold() reserves the order's
+units of each size for RESERVATION_TTL. Available stock is a size's stock
+(see ledger.py) less its live holds, summed through the (size, expires_at)
+index. On payment stock.commit_stock sells the units, taking only from stock
+other orders don't hold, and the order's holds are dropped; holds nobody
+paid for simply stop counting when they expire and release_expired()
+deletes them in batches.
+
+hold() checks and inserts under the same per product lock as
+stock.commit_stock (ledger.lock_stock), for one short transaction, and
+leaves the size rows unlocked.
+"""
+from collections import Counter
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .ledger import lock_stock, size_stock
+from .models import Reservation, Size
+from .stock import OutOfStock, Shortage
+
+RESERVATION_TTL = timedelta(minutes=15)
+
+
+def with_available_stock(sizes):
+    """
+    annotates a Size queryset with `available`, their stock less live holds
+    """
+    return sizes.annotate(available=size_stock() - Reservation.objects.live().total_for())
+
+
+def available_sizes(product_id):
+    """
+    the product's sizes annotated with `available`
+    """
+    return with_available_stock(Size.objects.filter(product_id=product_id))
+
+
+def hold(order, ttl: timedelta = RESERVATION_TTL) -> list[Reservation]:
+    """
+    reserves the order's items, all or nothing
+    raises OutOfStock listing the sizes that can't cover their line
+    """
+    wanted = Counter()
+    for item in order.order_items.all():
+        if item.size:
+            wanted[item.product_id, item.size.upper()] += item.quantity
+    if not wanted:
+        return []
+
+    match = Q()
+    for product_id, size in wanted:
+        match |= Q(product_id=product_id, size=size)
+
+    with transaction.atomic():
+        lock_stock(product_id for product_id, _ in wanted)
+        sizes = {(size.product_id, size.size): size for size in
+                 Size.objects.filter(match).order_by()
+                 .annotate(available=size_stock() - Reservation.objects.live().exclude(order=order).total_for())}
+        shortages = []
+        for key, quantity in wanted.items():
+            size = sizes.get(key)
+            available = size.available if size else 0
+            if available < quantity:
+                shortages.append(Shortage(key[0], key[1], quantity, max(available, 0)))
+        if shortages:
+            raise OutOfStock(shortages)
+
+        expires_at = timezone.now() + ttl
+        Reservation.objects.filter(order=order).delete()
+        return Reservation.objects.bulk_create(
+            [Reservation(size=sizes[key], order=order, quantity=quantity, expires_at=expires_at)
+             for key, quantity in wanted.items()])
+
+
+def release(order) -> None:
+    """
+    drops the order's holds, once it's paid for or abandoned
+    """
+    Reservation.objects.filter(order=order).delete()
+
+
+def release_expired(batch_size: int = 1000) -> int:
+    """
+    deletes expired holds a batch at a time
+    returns how many were deleted
+    """
+    released = 0
+    while True:
+        ids = list(Reservation.objects.expired().values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return released
+        released += Reservation.objects.filter(pk__in=ids).delete()[0]
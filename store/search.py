@@ -0,0 +1,319 @@
+"""
+Product search backends.
+
+Every product has a ProductSearchDocument row holding its name, brand and
+description. A backend keeps that document current and answers ranked
+searches over it:
+
+    PostgresSearchBackend: matches a weighted tsvector column (GIN indexed)
+                           added to the document table by migration 0002
+    InMemorySearchBackend: a pure python inverted index built from the
+                           document table, for SQLite and development
+
+get_search_backend() returns the backend configured by the
+STORE_SEARCH_BACKEND setting, or picks one from the database vendor.
+
+Both backends give every query term prefix semantics and require all terms
+to match, so `nik run` finds "Nike running shoe".
+"""
+import bisect
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BooleanField, Case, FloatField, OuterRef, Q, Subquery, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.query import QuerySet
+from django.utils.module_loading import import_string
+
+from .models import Product, ProductSearchDocument
+
+# letters and digits of any script, "café" is one token
+TOKEN_RE = re.compile(r'\w+')
+
+# ts_rank's default weights for the A, B and C labels
+WEIGHTS = {
+    'name': 1.0,
+    'brand': 0.4,
+    'description': 0.2,
+}
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    splits text into casefolded word tokens
+    """
+    return TOKEN_RE.findall((text or '').casefold())
+
+
+def icontains_search(queryset: QuerySet, query: str) -> QuerySet:
+    """
+    the unindexed search ProductListView used before the search backends
+    """
+    return queryset.filter(
+        Q(name__icontains=query) |
+        Q(description__icontains=query) |
+        Q(brand__icontains=query)
+    )
+
+
+class BaseSearchBackend:
+    """
+    Maintains product search documents and searches them.
+    """
+
+    def update(self, product: Product) -> None:
+        """
+        writes the product's search document in a single upsert
+        """
+        document = ProductSearchDocument(product=product,
+                                         name=product.name,
+                                         brand=product.brand,
+                                         description=product.description)
+        ProductSearchDocument.objects.bulk_create(
+            [document],
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=['name', 'brand', 'description', 'updated_at'])
+
+    def remove(self, product_id) -> None:
+        """
+        called after a product is deleted, the document itself goes with the
+        product through the cascade
+        """
+
+    def rebuild(self, batch_size: int = 2000) -> int:
+        """
+        recreates every search document from the product table
+        returns the number of documents written
+        """
+        count = 0
+        batch = []
+        products = Product.objects.order_by().values_list('id', 'name', 'brand', 'description')
+        for product_id, name, brand, description in products.iterator(chunk_size=batch_size):
+            batch.append(ProductSearchDocument(product_id=product_id, name=name,
+                                               brand=brand, description=description))
+            if len(batch) == batch_size:
+                count += self._write_batch(batch)
+                batch = []
+        if batch:
+            count += self._write_batch(batch)
+        return count
+
+    def _write_batch(self, documents: list) -> int:
+        ProductSearchDocument.objects.bulk_create(
+            documents,
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=['name', 'brand', 'description', 'updated_at'])
+        return len(documents)
+
+    def search(self, queryset: QuerySet, query: str) -> QuerySet:
+        """
+        narrows a product queryset to the products matching query,
+        annotated with `search_rank` and ordered by it
+        """
+        raise NotImplementedError
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    Searches the generated `search_vector` tsvector column through its GIN index.
+    """
+    config = 'english'
+
+    @staticmethod
+    def to_tsquery(query: str) -> str:
+        """
+        turns free text into a prefix tsquery, e.g. `nik run` -> `nik:* & run:*`
+        """
+        return ' & '.join(f'{token}:*' for token in tokenize(query))
+
+    def search(self, queryset: QuerySet, query: str) -> QuerySet:
+        tsquery = self.to_tsquery(query)
+        if not tsquery:
+            return queryset.none()
+
+        params = (self.config, tsquery)
+        matches = ProductSearchDocument.objects.filter(
+            RawSQL('search_vector @@ to_tsquery(%s::regconfig, %s)', params, output_field=BooleanField())
+        ).values('product_id')
+        # ts_rank is a float4, which a cursor can't carry exactly: a float8
+        # rounded to 6 places reads back and compares equal to itself
+        rank = ProductSearchDocument.objects.filter(product_id=OuterRef('pk')).annotate(
+            rank=RawSQL('round(ts_rank(search_vector, to_tsquery(%s::regconfig, %s))::numeric, 6)::float8',
+                        params, output_field=FloatField())
+        ).values('rank')[:1]
+
+        return (queryset.filter(pk__in=matches)
+                .annotate(search_rank=Subquery(rank, output_field=FloatField()))
+                .order_by('-search_rank', *Product._meta.ordering, 'pk'))
+
+
+class InMemorySearchBackend(BaseSearchBackend):
+    """
+    Inverted index held in the worker process.
+
+    postings maps a token to {product_id: score}, where the score is the sum of
+    the weights of the fields the token appears in. vocabulary is the sorted
+    list of tokens so prefix lookups are a bisect instead of a scan.
+
+    The index is loaded from the document table on first search and patched
+    after each committed product write. Writes made by other processes are
+    only picked up by rebuild(), which is fine for SQLite/dev setups.
+
+    A search goes to the database as a list of the matching ids, so only the
+    best max_results matches the queryset lets through are kept, ties broken
+    by id. They are found max_results at a time, one query per batch.
+    """
+    max_results = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.reset()
+
+    def reset(self) -> None:
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.vocabulary = []
+        self._loaded = False
+
+    def update(self, product: Product) -> None:
+        super().update(product)
+        fields = {'name': product.name, 'brand': product.brand, 'description': product.description}
+        transaction.on_commit(lambda: self._index(product.pk, fields))
+
+    def remove(self, product_id) -> None:
+        transaction.on_commit(lambda: self._unindex(product_id))
+
+    def rebuild(self, batch_size: int = 2000) -> int:
+        count = super().rebuild(batch_size)
+        with self._lock:
+            self.reset()
+        self._load()
+        return count
+
+    def _load(self) -> None:
+        with self._lock:
+            if self._loaded:
+                return
+            documents = ProductSearchDocument.objects.values_list('product_id', 'name', 'brand', 'description')
+            for product_id, name, brand, description in documents.iterator(chunk_size=2000):
+                self._add({'name': name, 'brand': brand, 'description': description}, product_id)
+            self.vocabulary = sorted(self.postings)
+            self._loaded = True
+
+    def _add(self, fields: dict, product_id) -> None:
+        scores = defaultdict(float)
+        for field, text in fields.items():
+            for token in set(tokenize(text)):
+                scores[token] += WEIGHTS[field]
+        for token, score in scores.items():
+            self.postings[token][product_id] = score
+        self.documents[product_id] = tuple(scores)
+
+    def _discard(self, product_id) -> None:
+        for token in self.documents.pop(product_id, ()):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(product_id, None)
+            if not posting:
+                del self.postings[token]
+
+    def _index(self, product_id, fields: dict) -> None:
+        with self._lock:
+            if not self._loaded:
+                # the full load will read the committed row
+                return
+            self._discard(product_id)
+            self._add(fields, product_id)
+            self.vocabulary = sorted(self.postings)
+
+    def _unindex(self, product_id) -> None:
+        with self._lock:
+            if not self._loaded:
+                return
+            self._discard(product_id)
+            self.vocabulary = sorted(self.postings)
+
+    def _prefix_scores(self, prefix: str) -> dict:
+        """
+        merges the postings of every token starting with prefix
+        """
+        scores = {}
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        for token in self.vocabulary[start:]:
+            if not token.startswith(prefix):
+                break
+            for product_id, score in self.postings[token].items():
+                if score > scores.get(product_id, 0):
+                    scores[product_id] = score
+        return scores
+
+    def rank(self, query: str) -> list[tuple]:
+        """
+        returns (product_id, score) pairs for the products matching every
+        token of query, best first
+        """
+        self._load()
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        with self._lock:
+            # intersect the rarest terms first to keep the candidate set small
+            per_token = sorted((self._prefix_scores(token) for token in set(tokens)), key=len)
+            ranked = dict(per_token[0])
+            for scores in per_token[1:]:
+                ranked = {product_id: total + scores[product_id]
+                          for product_id, total in ranked.items() if product_id in scores}
+                if not ranked:
+                    break
+        return sorted(ranked.items(), key=lambda item: (-item[1], str(item[0])))
+
+    def search(self, queryset: QuerySet, query: str) -> QuerySet:
+        ranked = self.rank(query)
+        # the queryset may filter out the best matches, so the cap applies to those it keeps
+        kept = []
+        for start in range(0, len(ranked), self.max_results):
+            batch = ranked[start:start + self.max_results]
+            allowed = set(queryset.filter(pk__in=[product_id for product_id, _ in batch])
+                          .order_by().values_list('pk', flat=True))
+            kept += [(product_id, score) for product_id, score in batch if product_id in allowed]
+            if len(kept) >= self.max_results:
+                break
+        ranked = kept[:self.max_results]
+        if not ranked:
+            return queryset.none()
+        # scores are sums of a few field weights so there are only a handful of
+        # distinct values, one WHEN per score keeps the statement small
+        by_score = defaultdict(list)
+        for product_id, score in ranked:
+            by_score[round(score, 4)].append(product_id)
+        search_rank = Case(*[When(pk__in=ids, then=Value(score)) for score, ids in by_score.items()],
+                           default=Value(0.0), output_field=FloatField())
+        return (queryset.filter(pk__in=[product_id for product_id, _ in ranked])
+                .annotate(search_rank=search_rank)
+                .order_by('-search_rank', *Product._meta.ordering, 'pk'))
+
+
+_backend = None
+
+
+def get_search_backend() -> BaseSearchBackend:
+    """
+    returns the process wide search backend
+    """
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'STORE_SEARCH_BACKEND', None)
+        if path:
+            _backend = import_string(path)()
+        elif connection.vendor == 'postgresql':
+            _backend = PostgresSearchBackend()
+        else:
+            _backend = InMemorySearchBackend()
+    return _backend
@@ -1,19 +1,122 @@
 # signals.py
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
+from django.db.models import F
+from django.db.models.functions import Greatest
 from django.dispatch import receiver
-from .models import Review, Product
+from .models import CartItem, Category, Gender, Review, Product, Product_Image, OrderItem, Like, Size
+from .search import get_search_backend
+from . import cards, facets, fragments
+from .cart import forget_summary
+from .votes import counter_changes
 
 @receiver(post_save, sender=Review)
 def increment_review_count(sender, instance, created, **kwargs):
     if created:
-        product = instance.product
-        product.total_reviews += 1
-        product.save()
-        print('Review count incremented')
+        # a single UPDATE so concurrent reviews can't overwrite each other's count
+        Product.objects.filter(pk=instance.product_id).update(total_reviews=F('total_reviews') + 1)
+        cards.add_reviews(instance.product_id, 1)
 
 @receiver(post_delete, sender=Review)
 def decrement_review_count(sender, instance, **kwargs):
-    product = instance.product
-    if product.total_reviews > 0:
-        product.total_reviews -= 1
-        product.save()
\ No newline at end of file
+    Product.objects.filter(pk=instance.product_id).update(total_reviews=Greatest(F('total_reviews') - 1, 0))
+    cards.add_reviews(instance.product_id, -1)
+
+@receiver(post_save, sender=Product)
+def update_search_document(sender, instance, update_fields=None, **kwargs):
+    # saves that don't touch the searchable fields leave the document as is
+    if update_fields is not None and not {'name', 'brand', 'description'} & set(update_fields):
+        return
+    get_search_backend().update(instance)
+
+@receiver(post_delete, sender=Product)
+def remove_search_document(sender, instance, **kwargs):
+    get_search_backend().remove(instance.pk)
+
+
+@receiver(post_save, sender=Product)
+def update_product_card(sender, instance, **kwargs):
+    cards.update_card(instance)
+
+@receiver(post_save, sender=Product_Image)
+@receiver(post_delete, sender=Product_Image)
+def update_card_thumbnail(sender, instance, **kwargs):
+    cards.refresh_thumbnail(instance.product_id)
+
+@receiver(post_save, sender=OrderItem)
+def add_card_units_sold(sender, instance, created, **kwargs):
+    if created:
+        cards.add_units_sold(instance.product_id, instance.quantity)
+
+@receiver(post_delete, sender=OrderItem)
+def remove_card_units_sold(sender, instance, **kwargs):
+    cards.add_units_sold(instance.product_id, -instance.quantity)
+
+@receiver(post_delete, sender=Like)
+def remove_vote_from_counters(sender, instance, **kwargs):
+    changes = counter_changes(instance.vote, Like.NO_VOTE)
+    if changes:
+        Product.objects.filter(pk=instance.product_id).update(**changes)
+
+@receiver(post_save, sender=CartItem)
+@receiver(post_delete, sender=CartItem)
+def forget_cart_summary(sender, instance, **kwargs):
+    forget_summary(instance.user_id)
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Size)
+@receiver(post_save, sender=Product_Image)
+@receiver(post_delete, sender=Product_Image)
+def bump_fragment_version(sender, instance, **kwargs):
+    # the product, its stock and its thumbnail are what the listing shows
+    fragments.bump(instance.pk if sender is Product else instance.product_id)
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+@receiver(post_save, sender=Like)
+@receiver(post_delete, sender=Like)
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def bump_product_version(sender, instance, **kwargs):
+    # the product's page shows these, the listing's counts of them may lag until its pages expire
+    fragments.bump(instance.product_id, catalog=False)
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Size)
+def refresh_product_facets(sender, instance, **kwargs):
+    facets.refresh([instance.pk if sender is Product else instance.product_id])
+
+@receiver(pre_delete, sender=Product)
+def forget_product_facets(sender, instance, **kwargs):
+    facets.forget(instance.pk)
+
+@receiver(post_delete, sender=Product)
+def product_facets_forgotten(sender, instance, **kwargs):
+    facets.forgotten(instance.pk)
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Gender)
+def refresh_renamed_facets(sender, instance, created, **kwargs):
+    if not created:
+        product_ids = list(instance.products.values_list('pk', flat=True))
+        facets.refresh(product_ids)
+        fragments.bump(*product_ids)
+
+@receiver(m2m_changed, sender=Product.categories.through)
+@receiver(m2m_changed, sender=Product.genders.through)
+def refresh_classified_facets(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # the products losing the category or gender, gone by post_clear
+        instance._cleared_product_ids = list(instance.products.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        product_ids = [instance.pk]
+    elif action == 'post_clear':
+        product_ids = getattr(instance, '_cleared_product_ids', [])
+    else:
+        product_ids = list(pk_set)
+    facets.refresh(product_ids)
+    fragments.bump(*product_ids)
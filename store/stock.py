@@ -0,0 +1,101 @@
+"""
+Committing an order's stock.
+
+commit_stock sells an order's lines by inserting SALE movements into the
+stock ledger (see ledger.py) rather than updating the Product and Size rows.
+The check that there is enough left (counter plus pending movements) happens
+in the same transaction under ledger.lock_stock(), so concurrent buyers of
+the same product queue up for the check instead of both taking the last
+unit, while the hot Product and Size rows stay unlocked for everyone else.
+A fixed number of statements runs however many lines the order has.
+
+If any line is short nothing is recorded and OutOfStock reports which lines
+were short. Units other orders hold in reservations don't count as stock.
+"""
+from collections import Counter
+from dataclasses import dataclass
+
+from django.db import transaction
+from django.db.models import Q
+
+from . import cards, facets, fragments
+from .ledger import lock_stock, product_stock, size_stock
+from .models import Product, Reservation, Size, StockMovement
+
+
+@dataclass(frozen=True)
+class Shortage:
+    product_id: object
+    size: str  # '' when the product's inventory is short
+    wanted: int
+    available: int
+
+
+class OutOfStock(Exception):
+
+    def __init__(self, shortages: list[Shortage]):
+        self.shortages = shortages
+        super().__init__(f"{len(shortages)} order lines are out of stock")
+
+
+def _wanted(items) -> tuple[Counter, Counter]:
+    by_product = Counter()
+    by_size = Counter()
+    for item in items:
+        by_product[item.product_id] += item.quantity
+        if item.size:
+            # sizes are saved upper cased
+            by_size[item.product_id, item.size.upper()] += item.quantity
+    return by_product, by_size
+
+
+def commit_stock(items, order_id=None) -> None:
+    """
+    takes the quantities of items (anything with product_id, quantity and
+    size) out of stock, all or nothing; units held by orders other than
+    order_id (see reservations.py) are left alone
+    raises OutOfStock listing the short lines
+    """
+    by_product, by_size = _wanted(items)
+    if not by_product:
+        return
+
+    with transaction.atomic():
+        lock_stock(by_product)
+        products = dict(Product.objects.filter(pk__in=by_product).order_by()
+                        .annotate(available=product_stock()).values_list('pk', 'available'))
+        shortages = [Shortage(product_id, '', wanted, max(products.get(product_id, 0), 0))
+                     for product_id, wanted in by_product.items() if products.get(product_id, 0) < wanted]
+
+        sizes = {}
+        if by_size:
+            match = Q()
+            for product_id, size in by_size:
+                match |= Q(product_id=product_id, size=size)
+            held = Reservation.objects.live().exclude(order_id=order_id).total_for()
+            sizes = {(size.product_id, size.size): size for size in
+                     Size.objects.filter(match).order_by().annotate(available=size_stock() - held)}
+            for key, wanted in by_size.items():
+                available = sizes[key].available if key in sizes else 0
+                if available < wanted:
+                    shortages.append(Shortage(key[0], key[1], wanted, max(available, 0)))
+        if shortages:
+            raise OutOfStock(shortages)
+
+        movements = [StockMovement(product_id=item.product_id, kind=StockMovement.SALE, quantity=-item.quantity,
+                                   order_id=order_id,
+                                   size=sizes.get((item.product_id, item.size.upper())) if item.size else None,
+                                   size_label=item.size.upper() if item.size else '')
+                     for item in items]
+        StockMovement.objects.bulk_create(movements)
+        if order_id is not None:
+            # the order's held units are sold now
+            Reservation.objects.filter(order_id=order_id).delete()
+
+        # the counters catch up at the next compaction, but a product that
+        # just sold out leaves the listing's cards and facets now
+        sold_out = [product_id for product_id, wanted in by_product.items() if products[product_id] == wanted]
+        if sold_out:
+            cards.sync_stock(sold_out)
+            facets.refresh(sold_out)
+            fragments.bump(*sold_out)
@@ -1,8 +1,52 @@
 from django.db import models
+from django.db.models import Exists, OuterRef, Prefetch, Value
 
 class UndeletedProductManager(models.Manager):
     """
     returns all undeleted products
     """
     def get_queryset(self):
-        return super().get_queryset().prefetch_related('sizes', 'categories').filter(is_deleted=False)
\ No newline at end of file
+        return super().get_queryset().prefetch_related('sizes', 'categories').filter(is_deleted=False)
+
+
+class ProductQuerySet(models.QuerySet):
+    """
+    queryset of products
+    """
+    def with_viewer_flags(self, user):
+        """
+        annotates whether the user has reviewed, liked, disliked and bought
+        each product, as EXISTS subqueries of the same statement
+        """
+        from store.models import Like, OrderItem, Review
+
+        if not user.is_authenticated:
+            return self.annotate(user_has_reviewed=Value(False),
+                                 has_liked=Value(False),
+                                 has_disliked=Value(False),
+                                 user_has_bought=Value(False))
+
+        likes = Like.objects.filter(product=OuterRef('pk'), user=user)
+        return self.annotate(
+            user_has_reviewed=Exists(Review.objects.filter(product=OuterRef('pk'), user=user)),
+            has_liked=Exists(likes.filter(vote=Like.LIKE)),
+            has_disliked=Exists(likes.filter(vote=Like.DISLIKE)),
+            user_has_bought=Exists(OrderItem.objects.filter(product=OuterRef('pk'),
+                                                            order__user=user,
+                                                            order__payment_status__iexact='PAID')),
+        )
+
+    def for_detail_page(self):
+        """
+        everything the product detail page renders, the same for every
+        viewer: the product, then one prefetch each for sizes and images.
+        reviews are paged separately, see store.views.review_feed, and the
+        viewer's flags are loaded after the page, see ProductViewerView
+        """
+        from store.models import Product_Image
+
+        return self.prefetch_related(
+            'sizes',
+            # ordered so images.first is served from the prefetch
+            Prefetch('images', queryset=Product_Image.objects.order_by('pk')),
+        )
@@ -0,0 +1,24 @@
+from django.db.models import IntegerField, OuterRef, QuerySet, Subquery, Sum
+from django.db.models.functions import Coalesce, Now
+
+
+class ReservationQuerySet(QuerySet):
+
+    def live(self):
+        """
+        holds that haven't expired
+        """
+        return self.filter(expires_at__gt=Now())
+
+    def expired(self):
+        return self.filter(expires_at__lte=Now())
+
+    def total_for(self, size_ref: str = 'pk') -> Coalesce:
+        """
+        the quantity these holds take from the outer query's size, an
+        expression for annotations and filters on Size; it reads the
+        (size, expires_at) index rather than every reservation
+        """
+        held = (self.filter(size=OuterRef(size_ref)).order_by()
+                .values('size').annotate(total=Sum('quantity')).values('total'))
+        return Coalesce(Subquery(held, output_field=IntegerField()), 0)
@@ -0,0 +1,20 @@
+from django.db.models import IntegerField, OuterRef, QuerySet, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+class StockMovementQuerySet(QuerySet):
+
+    def pending(self):
+        """
+        movements not yet rolled up into the counter columns
+        """
+        return self.filter(compacted=False)
+
+    def total_for(self, column: str, ref: str = 'pk') -> Coalesce:
+        """
+        the sum of these movements for the outer query's product or size
+        (column is 'product' or 'size'), an expression for annotations
+        """
+        total = (self.filter(**{column: OuterRef(ref)}).order_by()
+                 .values(column).annotate(total=Sum('quantity')).values('total'))
+        return Coalesce(Subquery(total, output_field=IntegerField()), 0)
@@ -0,0 +1,54 @@
+"""
+Background tasks of the store app, run by the jobs worker
+"""
+import requests
+from django.conf import settings
+
+from account.tasks import MAILGUN_TIMEOUT, mailgun_send
+from jobs.queue import task
+from . import payments
+from .models import Order
+
+order_confirmation_html = """
+<html>
+  <body style="font-family: Arial, sans-serif;">
+    <h2>Thank you for your order</h2>
+    <p>We have received your payment of &#8358;{amount} for order <strong>{order_number}</strong>.</p>
+    <p>We will let you know once it ships.</p>
+  </body>
+</html>
+"""
+
+
+@task('store.send_order_confirmation', batch_size=50, timeout=sum(MAILGUN_TIMEOUT))
+def send_order_confirmations(payloads: list[dict]) -> list:
+    """
+    emails the buyer (and the site admins) that an order was paid for
+    payload: {"order_number": ...}
+    """
+    orders = (Order.objects.select_related('user')
+              .in_bulk([payload['order_number'] for payload in payloads], field_name='order_number'))
+    admins = [email for _, email in getattr(settings, 'ADMINS', [])]
+    results = []
+    with requests.Session() as session:
+        for payload in payloads:
+            order = orders.get(payload['order_number'])
+            if order is None:
+                results.append(None)
+                continue
+            try:
+                mailgun_send(session, [order.user.email, *admins], f"Order {order.order_number} confirmed",
+                             order_confirmation_html.format(amount=order.total_amount,
+                                                            order_number=order.order_number))
+                results.append(None)
+            except requests.RequestException as e:
+                results.append(e)
+    return results
+
+
+@task('store.process_payment_event', max_attempts=10)
+def process_payment_event(payload: dict) -> None:
+    """
+    payload: {"event_id": ...} of a stored paystack charge.success event
+    """
+    payments.process_event(payload['event_id'])
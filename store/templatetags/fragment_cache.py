@@ -0,0 +1,44 @@
+from django import template
+
+from store import fragments
+
+register = template.Library()
+
+
+class FragmentNode(template.Node):
+
+    def __init__(self, nodelist, name, product_id, vary):
+        self.nodelist = nodelist
+        self.name = name
+        self.product_id = product_id
+        self.vary = vary
+
+    def render(self, context):
+        name = self.name.resolve(context)
+        product_id = self.product_id.resolve(context)
+        version = (context.get('fragment_versions') or {}).get(product_id)
+        if version is None:
+            version = fragments.versions([product_id])[product_id]
+
+        key = fragments.fragment_key(name, product_id, version, [value.resolve(context) for value in self.vary])
+        html = fragments.get(key)
+        if html is None:
+            html = self.nodelist.render(context)
+            fragments.set(key, html)
+        return html
+
+
+@register.tag('cachefragment')
+def do_cachefragment(parser, token):
+    """
+    {% cachefragment "name" product.pk [vary ...] %} ... {% endcachefragment %}
+
+    caches the enclosed template under the product's version stamp, see store/fragments.py
+    """
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' takes a fragment name and a product id")
+    nodelist = parser.parse(('endcachefragment',))
+    parser.delete_first_token()
+    return FragmentNode(nodelist, parser.compile_filter(bits[1]), parser.compile_filter(bits[2]),
+                        [parser.compile_filter(bit) for bit in bits[3:]])
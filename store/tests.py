@@ -1,3 +1,1416 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import tempfile
+import threading
+import uuid
+from unittest import mock, skipUnless
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from types import SimpleNamespace
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from account.models import User
+from jobs import queue
+from jobs.models import Job
+from store.models import (CartItem, Category, FacetCount, Gender, Like, Order, PaymentEvent, Product, ProductCard,
+                          Product_Image, ProductSearchDocument, Reservation, Review, Size, StockMovement)
+from store import catalog_index, facets, fragments, invalidation, page_cache, query_cache, search
+from store.counters import reconcile_likes, reconcile_reviews
+from store.cart import CartSummary, available_stock, cart_summary, change_quantity, reconcile_cart
+from store.ledger import compact, receive, record
+from store.orders import place_order
+from store.pagination import InvalidCursor, KeysetPaginator
+from store.reservations import available_sizes, hold, release_expired
+from store.stock import OutOfStock, Shortage, commit_stock
+from store.paystack import CallMetrics, CircuitBreaker, PaystackClient, PaystackError, PaystackUnavailable
+from store.votes import toggle_vote
+
+
+class SearchBackendTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.runner = Product.objects.create(name='Nike runner', brand='Nike', description='light running shoe')
+        cls.boot = Product.objects.create(name='Trail boot', brand='Bata', description='for running on nike trails')
+        cls.sandal = Product.objects.create(name='Sandal', brand='Vans', description='beach sandal')
+
+    def setUp(self):
+        self.backend = search.InMemorySearchBackend()
+        patcher = mock.patch.object(search, '_backend', self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def names(self, query):
+        return [product.name for product in self.backend.search(Product.objects.all(), query)]
+
+    def test_documents_follow_product_writes(self):
+        self.runner.name = 'Nike racer'
+        self.runner.save()
+        self.assertEqual(ProductSearchDocument.objects.get(product=self.runner).name, 'Nike racer')
+        self.sandal.delete()
+        self.assertFalse(ProductSearchDocument.objects.filter(product_id=self.sandal.pk).exists())
+
+    def test_terms_match_as_prefixes_and_all_must_match(self):
+        self.assertEqual(self.names('nik run'), ['Nike runner', 'Trail boot'])
+        self.assertEqual(self.names('nik beach'), [])
+        self.assertEqual(self.names('!!'), [])
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.names('nike'), ['Nike runner', 'Trail boot'])
+        self.assertEqual(self.names('trail'), ['Trail boot'])
+
+    def test_index_follows_committed_writes(self):
+        self.assertEqual(self.names('sandal'), ['Sandal'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sandal.name = 'Flip flop'
+            self.sandal.description = 'for the pool'
+            self.sandal.save()
+        self.assertEqual(self.names('sandal'), [])
+        self.assertEqual(self.names('flip'), ['Flip flop'])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.boot.delete()
+        self.assertEqual(self.names('trail'), [])
+
+    def test_only_the_best_matches_are_kept(self):
+        with mock.patch.object(self.backend, 'max_results', 1):
+            self.assertEqual(self.names('nike'), ['Nike runner'])
+            # of those the queryset lets through
+            products = self.backend.search(Product.objects.exclude(pk=self.runner.pk), 'nike')
+            self.assertEqual([product.name for product in products], ['Trail boot'])
+
+    def test_letters_beyond_ascii_are_searched(self):
+        Product.objects.create(name='Café espadrille', brand='Alpargatas', description='woven')
+        Product.objects.create(name='Кроссовки', brand='Nike', description='бег')
+        self.assertEqual(self.names('CAFÉ'), ['Café espadrille'])
+        self.assertEqual(self.names('кросс'), ['Кроссовки'])
+
+    @skipUnless(connection.vendor == 'postgresql', "the tsvector column is postgres only")
+    def test_postgres_backend_ranks_names_first(self):
+        backend = search.PostgresSearchBackend()
+        products = backend.search(Product.objects.all(), 'nik run')
+        self.assertEqual([product.name for product in products], ['Nike runner', 'Trail boot'])
+
+
+class KeysetPaginatorTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for number in range(3):
+            Product.objects.create(name=f'Nike runner {number}', brand='Nike', description='running shoe')
+        Product.objects.create(name='Trail boot', brand='Bata', description='nike trail running')
+        for _ in range(3):
+            Product.objects.create(name='Twin', brand='Vans', description='same name and brand')
+
+    def walk(self, queryset, ordering, per_page=1):
+        paginator = KeysetPaginator(queryset, per_page, ordering)
+        page = paginator.page(None)
+        pages = [[product.name for product in page]]
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            pages.append([product.name for product in page])
+        return pages
+
+    def test_pages_forward_then_back(self):
+        ordering = ('name', 'brand', 'id')
+        paginator = KeysetPaginator(Product.objects.all(), 2, ordering)
+        first = paginator.page(None)
+        self.assertFalse(first.has_previous())
+        second = paginator.page(first.next_cursor)
+        third = paginator.page(second.next_cursor)
+        self.assertEqual([product.name for product in third], ['Twin', 'Twin'])
+        self.assertEqual([len(first), len(second)], [2, 2])
+        self.assertFalse(paginator.page(third.next_cursor).has_next())
+
+        back = paginator.page(third.previous_cursor)
+        self.assertEqual(list(back), list(second))
+        self.assertEqual(list(paginator.page(back.previous_cursor)), list(first))
+        self.assertFalse(paginator.page(back.previous_cursor).has_previous())
+
+    def test_tied_keys_are_each_listed_once(self):
+        twins = Product.objects.filter(name='Twin')
+        seen = []
+        paginator = KeysetPaginator(twins, 1, ('name', 'brand', 'id'))
+        page = paginator.page(None)
+        while True:
+            seen.append(page[0].pk)
+            if not page.has_next():
+                break
+            page = paginator.page(page.next_cursor)
+        self.assertEqual(sorted(seen), sorted(twins.values_list('pk', flat=True)))
+
+    def test_ranked_search_results_page_through_ties(self):
+        backend = search.InMemorySearchBackend()
+        products = backend.search(Product.objects.all(), 'nike run')
+        self.assertEqual(self.walk(products, ('-search_rank', 'name', 'brand', 'id')),
+                         [['Nike runner 0'], ['Nike runner 1'], ['Nike runner 2'], ['Trail boot']])
+
+    def test_invalid_cursors_are_not_found(self):
+        paginator = KeysetPaginator(Product.objects.all(), 2, ('name', 'brand', 'id'))
+        for cursor in ('garbage', 'WyJ4IixbXV0'):
+            with self.assertRaises(InvalidCursor):
+                paginator.page(cursor)
+        response = self.client.get(reverse('store:product-list'), {'page': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursors_with_values_their_fields_cant_take_are_not_found(self):
+        paginator = KeysetPaginator(search.InMemorySearchBackend().search(Product.objects.all(), 'nike'), 2,
+                                    ('-search_rank', 'name', 'brand', 'id'))
+        for key in ([1.0, 'Twin', 'Vans', 'not-a-uuid'], ['high', 'Twin', 'Vans', str(uuid.uuid4())]):
+            with self.assertRaises(InvalidCursor):
+                paginator.page(paginator.encode_cursor(SimpleNamespace(search_rank=key[0], name=key[1],
+                                                                       brand=key[2], id=key[3]), 'n'))
+        cursor = KeysetPaginator(Product.objects.all(), 2, ('name', 'brand', 'id')).encode_cursor(
+            SimpleNamespace(name='Twin', brand='Vans', id='not-a-uuid'), 'n')
+        response = self.client.get(reverse('store:product-list'), {'page': cursor})
+        self.assertEqual(response.status_code, 404)
+
+    @skipUnless(connection.vendor == 'postgresql', "the tsvector column is postgres only")
+    def test_search_rank_cursors_seek_exactly_on_postgres(self):
+        ordering = ('-search_rank', 'name', 'brand', 'id')
+        products = search.PostgresSearchBackend().search(Product.objects.all(), 'nike run')
+        self.assertEqual(self.walk(products, ordering),
+                         [['Nike runner 0'], ['Nike runner 1'], ['Nike runner 2'], ['Trail boot']])
+
+
+class ProductCardTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('card@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Runner', brand='nike', description='light shoe',
+                                             unit_price=12000, inventory=3)
+
+    def card(self):
+        return ProductCard.objects.get(pk=self.product.pk)
+
+    def test_cards_follow_product_saves(self):
+        self.product.name = 'Racer'
+        self.product.unit_price = 15000
+        self.product.inventory = 0
+        self.product.save()
+        card = self.card()
+        self.assertEqual((card.name, card.brand, card.unit_price, card.in_stock), ('Racer', 'Nike', 15000, False))
+
+    def test_cards_point_at_the_first_image(self):
+        Product_Image.objects.create(product=self.product, image='product_image/first.jpg')
+        Product_Image.objects.create(product=self.product, image='product_image/second.jpg')
+        # the storage name, not a url that expires
+        self.assertEqual(self.card().thumbnail, Product_Image.objects.order_by('pk').first().image.name)
+        Product_Image.objects.all().delete()
+        self.assertEqual(self.card().thumbnail, '')
+
+    def test_cards_count_orders_and_reviews(self):
+        order = Order.objects.create(user=self.user, total_amount=0)
+        item = order.order_items.create(product=self.product, quantity=2)
+        order.order_items.create(product=self.product, quantity=1)
+        Review.objects.create(product=self.product, user=self.user, review='Comfy')
+        self.assertEqual((self.card().units_sold, self.card().review_count), (3, 1))
+        item.delete()
+        self.assertEqual(self.card().units_sold, 1)
+
+    def test_rebuild_recomputes_every_card(self):
+        order = Order.objects.create(user=self.user, total_amount=0)
+        order.order_items.create(product=self.product, quantity=2)
+        Product_Image.objects.create(product=self.product, image='product_image/first.jpg')
+        ProductCard.objects.update(name='stale', units_sold=0, thumbnail='', in_stock=False)
+        stdout = StringIO()
+        call_command('rebuild_product_cards', stdout=stdout)
+        self.assertIn('Rebuilt 1 product cards', stdout.getvalue())
+        card = self.card()
+        self.assertEqual((card.name, card.units_sold, card.thumbnail, card.in_stock),
+                         ('Runner', 2, 'product_image/first.jpg', True))
+
+
+class ReviewCounterTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('counter@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.products = [Product.objects.create(name=f'Shoe {number}', description='shoe') for number in range(5)]
+        for product in cls.products[:3]:
+            Review.objects.create(product=product, user=cls.user, review='Fits well')
+
+    def totals(self):
+        return list(Product.objects.order_by('pk').values_list('total_reviews', flat=True))
+
+    def test_reviews_update_the_counters_atomically(self):
+        product = self.products[3]
+        review = Review.objects.create(product=product, user=self.user, review='Fits well')
+        self.assertEqual(Product.objects.get(pk=product.pk).total_reviews, 1)
+        self.assertEqual(ProductCard.objects.get(pk=product.pk).review_count, 1)
+        review.delete()
+        self.assertEqual(Product.objects.get(pk=product.pk).total_reviews, 0)
+        self.assertEqual(ProductCard.objects.get(pk=product.pk).review_count, 0)
+
+    def test_reconciliation_repairs_corrupted_counters(self):
+        expected = self.totals()
+        ordered = Product.objects.order_by('pk')
+        Product.objects.filter(pk=ordered[0].pk).update(total_reviews=7)
+        Product.objects.filter(pk=ordered[4].pk).update(total_reviews=3)
+
+        self.assertEqual(reconcile_reviews(batch_size=2, dry_run=True), (5, 2))
+        self.assertNotEqual(self.totals(), expected)
+
+        chunks = []
+        self.assertEqual(reconcile_reviews(batch_size=2, progress=lambda *args: chunks.append(args)), (5, 2))
+        self.assertEqual(self.totals(), expected)
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(ProductCard.objects.get(pk=ordered[0].pk).review_count, expected[0])
+        self.assertEqual(reconcile_reviews(batch_size=2), (5, 0))
+
+    def test_reconciliation_resumes_after_a_product(self):
+        ordered = list(Product.objects.order_by('pk'))
+        Product.objects.filter(pk=ordered[0].pk).update(total_reviews=7)
+        self.assertEqual(reconcile_reviews(start_after=ordered[0].pk), (4, 0))
+        stdout = StringIO()
+        call_command('reconcile_review_counters', stdout=stdout)
+        self.assertIn('Checked 5 products, repaired 1', stdout.getvalue())
+
+
+class ReviewFeedTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(name='Runner', description='light shoe', inventory=5)
+        cls.users = User.objects.bulk_create([User(email=f'reader{number}@example.com', first_name='Ada',
+                                                   last_name=f'Obi{number}', phone=f'0801234{number:04d}',
+                                                   is_active=True)
+                                              for number in range(12)])
+
+    def review(self, number):
+        return Review.objects.create(product=self.product, user=self.users[number], review=f'Review number {number}')
+
+    def test_feed_pages_newest_first_until_the_last(self):
+        for number in range(12):
+            self.review(number)
+        url = reverse('store:review-list', args=[self.product.pk])
+        first = self.client.get(url)
+        self.assertEqual(len(first.context['reviews']), 10)
+        self.assertEqual(first.context['reviews'][0].review, 'Review number 11')
+        cursor = first.context['page_obj'].next_cursor
+        self.assertContains(first, 'intersect once')
+
+        # the authors are joined and the images fetched once per page
+        with self.assertNumQueries(2):
+            last = self.client.get(url, {'page': cursor})
+        self.assertEqual([review.review for review in last.context['reviews']],
+                         ['Review number 1', 'Review number 0'])
+        self.assertNotContains(last, 'review__sentinel')
+
+    def test_new_reviews_go_to_the_top_of_the_feed_first_or_not(self):
+        detail = self.client.get(reverse('store:product-detail', args=[self.product.pk]), HTTP_HX_REQUEST='true')
+        self.assertContains(detail, 'id="review_feed"')
+
+        url = reverse('store:review', args=[self.product.pk])
+        for number in range(2):
+            self.client.force_login(self.users[number])
+            response = self.client.post(url, {'review': f'review number {number}'})
+            self.assertContains(response, 'hx-swap-oob="afterbegin:#review_feed"')
+            self.assertContains(response, f'Review number {number}')
+            self.assertNotContains(response, 'id="reviews"')
+        self.assertContains(response, '2 reviews')
+
+
+class ProductDetailQueryTests(TestCase):
+    """
+    the detail page must load in a fixed number of queries however many
+    sizes, images and reviews a product has
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('buyer@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Runner', description='light shoe', inventory=20)
+
+    def add_related(self, count):
+        start = self.product.sizes.count()
+        for i in range(start, start + count):
+            Size.objects.create(product=self.product, size=str(40 + i), quantity=1)
+            Product_Image.objects.create(product=self.product, image=f'product_image/{i}.jpg')
+            reviewer = User.objects.create_user(f'r{i}@example.com', 'Rev', 'Iewer', f'0701234567{i}',
+                                                'pass@1234', is_active=True)
+            Review.objects.create(product=self.product, user=reviewer, review='nice')
+
+    def test_loader_query_count(self):
+        self.add_related(3)
+        toggle_vote(self.user, self.product.pk, Like.LIKE)
+        order = Order.objects.create(user=self.user, total_amount=1000, payment_status='PAID')
+        order.order_items.create(product=self.product, quantity=1)
+
+        # product with like counts, then sizes and images
+        with self.assertNumQueries(3):
+            product = Product.objects.for_detail_page().get(pk=self.product.pk)
+            self.assertEqual(product.total_likes, 1)
+            self.assertEqual(len(product.sizes.all()), 3)
+            self.assertIsNotNone(product.images.first())
+
+        # the viewer's flags, loaded after the page
+        with self.assertNumQueries(1):
+            product = Product.objects.with_viewer_flags(self.user).get(pk=self.product.pk)
+            self.assertTrue(product.has_liked)
+            self.assertFalse(product.has_disliked)
+            self.assertTrue(product.user_has_bought)
+            self.assertFalse(product.user_has_reviewed)
+
+    def test_view_query_count_is_flat(self):
+        self.client.force_login(self.user)
+        url = reverse('store:product-detail', args=[self.product.pk])
+
+        self.add_related(1)
+        with self.assertNumQueries(7) as small:
+            self.client.get(url, HTTP_HX_REQUEST='true')
+
+        self.add_related(5)
+        with self.assertNumQueries(len(small.captured_queries)):
+            response = self.client.get(url, HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 200)
+
+
+class FragmentCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('fragments@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Runner', description='light shoe', inventory=20)
+        Review.objects.create(product=cls.product, user=cls.user, review='Great fit')
+
+    def setUp(self):
+        fragments.reset_stats()
+        self.url = reverse('store:product-detail', args=[self.product.pk])
+
+    def test_fragments_served_from_cache_until_the_product_changes(self):
+        self.client.force_login(self.user)
+        self.client.get(self.url, HTTP_HX_REQUEST='true')
+        misses = fragments.stats()['misses']
+
+        # the review page isn't read for a cached reviews fragment
+        with self.assertNumQueries(5):
+            response = self.client.get(self.url, HTTP_HX_REQUEST='true')
+        self.assertContains(response, 'Great fit')
+        self.assertEqual(fragments.stats()['misses'], misses)
+        self.assertEqual(fragments.stats()['hits'], misses)
+
+        reviewer = User.objects.create_user('second@example.com', 'Rev', 'Iewer', '07012345678',
+                                            'pass@1234', is_active=True)
+        Review.objects.create(product=self.product, user=reviewer, review='Runs small')
+        self.assertContains(self.client.get(self.url, HTTP_HX_REQUEST='true'), 'Runs small')
+
+    def test_vote_renders_the_new_counts(self):
+        self.client.force_login(self.user)
+        self.client.get(self.url, HTTP_HX_REQUEST='true')
+        response = self.client.post(reverse('store:toggle-like', args=[self.product.pk]))
+        self.assertContains(response, '<span class="total_likes" id="total_likes">1</span>')
+
+    def test_list_cards_follow_product_saves(self):
+        list_url = reverse('store:product-list')
+        self.assertContains(self.client.get(list_url, HTTP_HX_REQUEST='true'), 'Runner')
+        self.product.name = 'Racer'
+        self.product.save()
+        self.assertContains(self.client.get(list_url, HTTP_HX_REQUEST='true'), 'Racer')
+
+    def test_bumps_reach_the_other_workers(self):
+        with mock.patch.object(invalidation, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                fragments.bump(self.product.pk)
+        publish.assert_called_once_with('version', f'{self.product.pk},{fragments.CATALOG}')
+
+        stamp, catalog = fragments.versions([self.product.pk])[self.product.pk], fragments.catalog_version()
+        # as applied by the bus in another worker
+        invalidation.handlers['version'](f'{self.product.pk}')
+        self.assertNotEqual(fragments.versions([self.product.pk])[self.product.pk], stamp)
+        self.assertEqual(fragments.catalog_version(), catalog)
+
+    def test_html_with_signed_media_urls_goes_before_they_expire(self):
+        with mock.patch('store.fragments.default_storage', mock.Mock(querystring_auth=False)):
+            self.assertEqual((fragments.media_timeout(3600), fragments.media_epoch()), (3600, ''))
+        signing = mock.Mock(querystring_auth=True, querystring_expire=3600)
+        with mock.patch('store.fragments.default_storage', signing), \
+                mock.patch('store.fragments.time.time', return_value=900 * 7 + 5):
+            self.assertEqual(fragments.media_timeout(fragments.FRAGMENT_TIMEOUT), 900)
+            self.assertEqual(fragments.media_timeout(600), 600)
+            self.assertEqual(fragments.media_epoch(), '7')
+
+
+class ConditionalGetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('etag@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.other = User.objects.create_user('other@example.com', 'Rev', 'Iewer', '07012345678',
+                                             'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Runner', description='light shoe', inventory=20)
+
+    def test_detail_revalidates_without_reading_the_product(self):
+        self.client.force_login(self.user)
+        url = reverse('store:product-detail', args=[self.product.pk])
+        etag = self.client.get(url, HTTP_HX_REQUEST='true')['ETag']
+
+        # the session and the user
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_HX_REQUEST='true', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # the full page is another representation
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        Review.objects.create(product=self.product, user=self.other, review='Runs small')
+        self.assertEqual(self.client.get(url, HTTP_HX_REQUEST='true', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_etag_is_per_viewer(self):
+        url = reverse('store:product-detail', args=[self.product.pk])
+        self.client.force_login(self.user)
+        etag = self.client.get(url, HTTP_HX_REQUEST='true')['ETag']
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(url, HTTP_HX_REQUEST='true', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_list_revalidates_until_a_product_changes(self):
+        url = reverse('store:product-list')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.product.unit_price = 2000
+        self.product.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_list_revalidates_through_votes_reviews_and_orders(self):
+        url = reverse('store:product-list')
+        etag = self.client.get(url)['ETag']
+        toggle_vote(self.user, self.product.pk, Like.LIKE)
+        Review.objects.create(product=self.product, user=self.other, review='Runs small')
+        Order.objects.create(user=self.user, total_amount=0).order_items.create(product=self.product, quantity=1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Size.objects.create(product=self.product, size='40', quantity=1)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_unknown_products_are_404_and_their_stamps_expire(self):
+        cache = fragments._cache()
+        with mock.patch.object(cache, 'add', wraps=cache.add) as add:
+            response = self.client.get(reverse('store:product-detail', args=[uuid.uuid4()]), HTTP_HX_REQUEST='true')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual({call.kwargs['timeout'] for call in add.call_args_list if 'version' in call.args[0]},
+                         {fragments.STAMP_TIMEOUT})
+
+
+class AnonymousPageCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(name='Runner', description='light shoe', inventory=20)
+        Size.objects.create(product=cls.product, size='42', quantity=3)
+
+    def test_pages_cached_until_the_product_changes(self):
+        url = reverse('store:product-detail', args=[self.product.pk])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertNotContains(response, page_cache.CSRF_PLACEHOLDER)
+        self.assertContains(response, 'Runner')
+
+        Product.objects.filter(pk=self.product.pk).update(name='Racer')
+        self.assertContains(self.client.get(url), 'Runner')
+        self.product.name = 'Racer'
+        self.product.save()
+        self.assertContains(self.client.get(url), 'Racer')
+
+    def test_each_visitor_gets_their_own_csrf_token(self):
+        url = reverse('store:product-list')
+        first = self.client.get(url)
+        other = self.client_class().get(url)
+        self.assertNotEqual(first.cookies['csrftoken'].value, other.cookies['csrftoken'].value)
+        self.assertEqual(first.content.count(b'X-CSRFToken'), 1)
+        self.assertNotContains(other, page_cache.CSRF_PLACEHOLDER)
+
+    def test_requests_missing_while_locked_render_without_caching(self):
+        url = reverse('store:product-list')
+        # another request holds the recompute lock and never finishes
+        with mock.patch.object(page_cache._cache(), 'add', return_value=False), \
+                mock.patch.object(page_cache, 'LOCK_WAIT', 0.1):
+            self.assertContains(self.client.get(url), 'Runner')
+            # the page and its facet counts
+            with self.assertNumQueries(2):
+                self.client.get(url)
+
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+    def test_signed_in_viewers_load_their_state_after_the_page(self):
+        user = User.objects.create_user('viewer@example.com', 'Ada', 'Obi', '08012345678',
+                                        'pass@1234', is_active=True)
+        order = Order.objects.create(user=user, total_amount=1000, payment_status='PAID')
+        order.order_items.create(product=self.product, quantity=1)
+        self.client.force_login(user)
+        page = self.client.get(reverse('store:product-detail', args=[self.product.pk]), HTTP_HX_REQUEST='true')
+        viewer_url = reverse('store:product-viewer', args=[self.product.pk])
+        self.assertContains(page, viewer_url)
+        self.assertNotContains(page, 'Write a review')
+        self.assertContains(self.client.get(viewer_url), 'Write a review')
+
+
+class QueryCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        shoes = Category.objects.create(name='shoes')
+        cls.product = Product.objects.create(name='Runner', description='light shoe', inventory=20)
+        cls.product.categories.add(shoes)
+        Size.objects.create(product=cls.product, size='42', quantity=3)
+
+    def setUp(self):
+        # forgets the writes of setUpTestData, whose transaction never commits
+        query_cache.reset()
+
+    def test_results_cached_until_a_write_commits(self):
+        shoes = Category.objects.filter(name__iexact='shoes').values_list('name', flat=True)
+        with self.assertNumQueries(2):
+            self.assertEqual(list(shoes.all()), ['Shoes'])
+            Category.objects.get(name='Shoes')
+        with self.assertNumQueries(0):
+            self.assertEqual(list(shoes.all()), ['Shoes'])
+            self.assertEqual(Category.objects.get(name='Shoes').name, 'Shoes')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Category.objects.filter(name='Shoes').update(name='Boots')
+        with self.assertNumQueries(1):
+            self.assertEqual(list(shoes.all()), [])
+        self.assertEqual(query_cache.stats()['store.Category'], {'hits': 2, 'misses': 3, 'hit_rate': 0.4})
+
+    def test_tables_written_in_an_open_transaction_are_not_cached(self):
+        categories = Category.objects.filter(name='Shoes')
+        list(categories.all())
+        Category.objects.filter(name='Shoes').update(updated_at=timezone.now())
+        with self.assertNumQueries(2):
+            categories.get()
+            categories.get()
+
+    def test_queries_reading_other_tables_are_not_cached(self):
+        categories = Category.objects.filter(products__name='Runner')
+        with self.assertNumQueries(2):
+            list(categories.all())
+            list(categories.all())
+
+    def test_stock_is_never_cached(self):
+        sizes = Size.objects.filter(product=self.product)
+        with self.assertNumQueries(2):
+            list(sizes.all())
+            list(sizes.all())
+
+    def test_least_recently_used_evicted_past_the_size_bound(self):
+        cache = query_cache.QueryCache(max_bytes=2000)
+        for i in range(20):
+            cache.set(i, frozenset({'table'}), ['x' * 150], cache.generations_of({'table'}))
+            cache.get(0, 'label')
+        self.assertLessEqual(cache.size, 2000)
+        self.assertIsNotNone(cache.get(0, 'label'))
+        self.assertIsNone(cache.get(1, 'label'))
+        cache.invalidate('table')
+        self.assertEqual((cache.size, len(cache.entries)), (0, 0))
+
+
+class InvalidationBusTests(TestCase):
+
+    def setUp(self):
+        hub = []
+        self.applied = {'writer': [], 'reader': []}
+        self.writer = invalidation.InvalidationBus(invalidation.InMemoryTransport(hub),
+                                                   {'table': self.applied['writer'].append})
+        self.reader = invalidation.InvalidationBus(invalidation.InMemoryTransport(hub),
+                                                   {'table': self.applied['reader'].append})
+        self.writer.poll()
+        self.reader.poll()
+
+    def publish(self, *names):
+        with self.captureOnCommitCallbacks(execute=True):
+            for name in names:
+                self.writer.publish('table', name)
+
+    def test_other_workers_apply_invalidations(self):
+        self.publish('store_size')
+        with self.assertNumQueries(0):
+            self.reader.poll()
+        self.writer.poll()
+        self.assertEqual(self.applied, {'writer': [], 'reader': ['store_size']})
+
+    def test_missed_notifications_caught_up_from_the_log(self):
+        self.publish('store_size', 'store_category', 'store_gender')
+        # the first one got lost, the next reveals the gap
+        self.reader.transport.inbox.popleft()
+        self.reader.poll()
+        self.assertEqual(self.applied['reader'], ['store_category', 'store_gender', 'store_size'])
+
+        self.publish('store_size')
+        self.reader.transport.inbox.clear()
+        self.reader.poll()
+        self.assertEqual(self.applied['reader'][-1], 'store_size')
+        self.assertEqual(self.reader.watermark, self.reader._latest())
+
+    def test_long_names_are_read_from_the_log(self):
+        name = ','.join(str(uuid.uuid4()) for _ in range(20))
+        self.publish(name)
+        [message] = self.reader.transport.inbox
+        self.assertNotIn(name, message)
+        self.reader.poll()
+        self.assertEqual(self.applied['reader'], [name])
+
+    def test_unix_socket_transport_reaches_the_other_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = invalidation.UnixSocketTransport(directory)
+            second = invalidation.UnixSocketTransport(directory)
+            try:
+                first.send('1:origin:table:store_size')
+                self.assertEqual(second.receive(1), ['1:origin:table:store_size'])
+                self.assertEqual(first.receive(0), [])
+            finally:
+                first.close()
+                second.close()
+
+
+class FacetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        shoes = Category.objects.create(name='Shoes')
+        sports = Category.objects.create(name='Sports')
+        male = Gender.objects.create(sex='Male')
+        female = Gender.objects.create(sex='Female')
+        cls.runner = Product.objects.create(name='Runner', description='runner', inventory=3, unit_price=12000)
+        cls.runner.categories.add(shoes, sports)
+        cls.runner.genders.add(male, female)
+        cls.size = Size.objects.create(product=cls.runner, size='42', quantity=3)
+        cls.sandal = Product.objects.create(name='Sandal', description='sandal', inventory=0, unit_price=4000)
+        cls.sandal.categories.add(shoes)
+
+    def test_filtering_on_several_values_lists_products_once(self):
+        response = self.client.get(reverse('store:product-list'), {'category': ['shoes', 'sports'],
+                                                                   'gender': ['male', 'female']})
+        self.assertEqual(list(response.context['products']), [self.runner])
+
+    def test_counts_of_the_listing_and_of_a_filter(self):
+        self.assertEqual(facets.counts()['category'], {'shoes': 1, 'sports': 1})
+        self.assertEqual(facets.counts()['stock'], {'in': 1, 'out': 1})
+        products = facets.filter_products(Product.objects.all(), {'stock': ['out']})
+        self.assertEqual(facets.counts(products)['price'], {'0-5000': 1})
+
+    def test_sold_out_products_are_listed_when_stock_is_selected(self):
+        url = reverse('store:product-list')
+        self.assertEqual(list(self.client.get(url).context['products']), [self.runner])
+        self.assertEqual(list(self.client.get(url, {'stock': 'out'}).context['products']), [self.sandal])
+
+    def test_counts_follow_stock_and_deletes(self):
+        self.size.quantity = 0
+        self.size.save()
+        self.assertNotIn('size', facets.counts())
+
+        self.runner.delete()
+        self.assertEqual(facets.counts()['stock'], {'out': 1})
+        self.assertNotIn('category', facets.counts())
+
+        FacetCount.objects.all().delete()
+        facets.rebuild()
+        self.assertEqual(facets.counts()['stock'], {'out': 1})
+
+
+class CatalogIndexTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        shoes = Category.objects.create(name='Shoes')
+        cls.user = User.objects.create_user('index@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.products = []
+        for number in range(7):
+            product = Product.objects.create(name=f'Shoe {number}', description='shoe', inventory=2,
+                                             brand='Bata' if number % 2 else 'Vans')
+            product.categories.add(shoes)
+            Size.objects.create(product=product, size='40', quantity=2)
+            cls.products.append(product)
+
+    def setUp(self):
+        self.index = catalog_index.CatalogIndex()
+        patcher = mock.patch.object(catalog_index, 'index', self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index.load()
+        # past the anonymous page cache
+        self.client.force_login(self.user)
+
+    def set_ranks(self, index):
+        return {value: bitmap.nonzero()[0].tolist() for value, bitmap in index.bitmaps.items() if bitmap.any()}
+
+    def listed(self, params):
+        response = self.client.get(reverse('store:product-list'), params)
+        return [product.name for product in response.context['products']], response.context
+
+    def test_filters_match_the_sql_path(self):
+        params = {'category': 'shoes', 'brand': ['bata', 'vans'], 'size': '40'}
+        names, context = self.listed(params)
+        with mock.patch.object(self.index, 'loaded', False):
+            sql_names, sql_context = self.listed(params)
+        self.assertEqual(names, sql_names)
+        self.assertEqual(context['facets'], sql_context['facets'])
+
+    def test_pages_through_the_bitmaps(self):
+        url = reverse('store:product-list')
+        first = self.client.get(url, {'brand': 'vans'}).context['page_obj']
+        self.assertEqual([product.name for product in first], ['Shoe 0', 'Shoe 2', 'Shoe 4', 'Shoe 6'])
+
+        first = self.client.get(url, {'category': 'shoes'}).context['page_obj']
+        # the session, the user, and the page's products with their cards
+        with self.assertNumQueries(3):
+            page = self.client.get(url, {'category': 'shoes', 'page': first.next_cursor}).context['page_obj']
+        self.assertEqual([product.name for product in page], ['Shoe 5', 'Shoe 6'])
+        back = self.client.get(url, {'category': 'shoes', 'page': page.previous_cursor}).context['page_obj']
+        self.assertEqual(list(back), list(first))
+
+    def test_follows_changes_to_products(self):
+        sold_out, renamed, deleted = self.products[0], self.products[1], self.products[2]
+        with self.captureOnCommitCallbacks(execute=True):
+            Size.objects.filter(product=sold_out).update(quantity=0)
+            facets.refresh([sold_out.pk])
+            renamed.name = 'Boot'
+            renamed.save()
+            deleted.delete()
+            Product.objects.create(name='Sneaker', description='sneaker', inventory=1, brand='Vans')
+
+        names, _ = self.listed({'size': '40'})
+        self.assertEqual(names, ['Boot', 'Shoe 3', 'Shoe 4', 'Shoe 5', 'Shoe 6'])
+        names, _ = self.listed({'brand': 'vans'})
+        self.assertEqual(names, ['Shoe 0', 'Shoe 4', 'Shoe 6', 'Sneaker'])
+        # the same as loading afresh
+        fresh = catalog_index.CatalogIndex()
+        fresh.load()
+        self.assertEqual((fresh.keys, self.set_ranks(fresh)), (self.index.keys, self.set_ranks(self.index)))
+
+    def test_publishes_one_invalidation_per_transaction(self):
+        product_ids = [product.pk for product in self.products]
+        with mock.patch.object(invalidation, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                for product_id in product_ids:
+                    Size.objects.filter(product_id=product_id).update(quantity=0)
+                    facets.refresh([product_id])
+        [(kind, name)] = [call.args for call in publish.call_args_list]
+        self.assertEqual(kind, 'catalog')
+        # and whatever rolled back tests left over
+        self.assertLessEqual(set(map(str, product_ids)), set(name.split(',')))
+        names, _ = self.listed({'size': '40'})
+        self.assertEqual(names, [])
+
+    def test_fills_the_page_past_products_deleted_unheard(self):
+        # the on commit update never runs, as when the bus hasn't delivered yet
+        deleted = self.products[2].pk
+        Product.objects.filter(pk=deleted).delete()
+        self.assertIn(deleted, self.index)
+        page = self.client.get(reverse('store:product-list'), {'category': 'shoes'}).context['page_obj']
+        self.assertEqual([product.name for product in page], ['Shoe 0', 'Shoe 1', 'Shoe 3', 'Shoe 4', 'Shoe 5'])
+        self.assertTrue(page.has_next())
+        self.assertNotIn(deleted, self.index)
+
+    def test_places_products_added_together(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for name in ('Shoe 1b', 'Shoe 1a', 'Shoe 9', 'Clog', 'Shoe 1c'):
+                product = Product.objects.create(name=name, description='shoe', inventory=1, brand='Vans')
+                Size.objects.create(product=product, size='40', quantity=1)
+        fresh = catalog_index.CatalogIndex()
+        fresh.load()
+        self.assertEqual((fresh.keys, self.set_ranks(fresh)), (self.index.keys, self.set_ranks(self.index)))
+
+    def test_ranks_follow_the_database_order(self):
+        # python puts lowercase after every capital, most collations don't
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(name='shoe 35', description='shoe', inventory=1, brand='Vans')
+            facets.refresh([product.pk])
+        ordered = list(Product.objects.order_by(*catalog_index.ORDERING).values_list('pk', flat=True))
+        self.assertEqual(self.index.ids, ordered)
+        names, _ = self.listed({'brand': 'vans'})
+        with mock.patch.object(self.index, 'loaded', False):
+            sql_names, _ = self.listed({'brand': 'vans'})
+        self.assertEqual(names, sql_names)
+
+    def test_pages_on_from_a_deleted_cursor(self):
+        url = reverse('store:product-list')
+        first = self.client.get(url, {'category': 'shoes'}).context['page_obj']
+        # the last product of the page, the cursor's
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[4].delete()
+        page = self.client.get(url, {'category': 'shoes', 'page': first.next_cursor}).context['page_obj']
+        self.assertEqual([product.name for product in page], ['Shoe 5', 'Shoe 6'])
+
+
+class VoteTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('voter@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Runner', description='light shoe')
+
+    def assertCounters(self, likes, dislikes):
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.total_likes, self.product.total_dislikes), (likes, dislikes))
+
+    def test_toggle_moves_counters(self):
+        self.assertTrue(toggle_vote(self.user, self.product.pk, Like.LIKE).has_liked)
+        self.assertCounters(1, 0)
+        self.assertTrue(toggle_vote(self.user, self.product.pk, Like.DISLIKE).has_disliked)
+        self.assertCounters(0, 1)
+        result = toggle_vote(self.user, self.product.pk, Like.DISLIKE)
+        self.assertFalse(result.has_liked or result.has_disliked)
+        self.assertCounters(0, 0)
+        self.assertEqual(Like.objects.get().vote, Like.NO_VOTE)
+        self.assertTrue(toggle_vote(self.user, self.product.pk, Like.LIKE).has_liked)
+        self.assertCounters(1, 0)
+
+    def test_a_vote_is_two_statements(self):
+        toggle_vote(self.user, self.product.pk, Like.LIKE)
+        with CaptureQueriesContext(connection) as queries:
+            result = toggle_vote(self.user, self.product.pk, Like.DISLIKE)
+        statements = [query['sql'] for query in queries if 'SAVEPOINT' not in query['sql']]
+        # the old vote is read in the upsert on postgres, just before it elsewhere
+        self.assertEqual(len(statements), 2 if connection.vendor == 'postgresql' else 3)
+        self.assertEqual((result.product.total_likes, result.product.total_dislikes), (0, 1))
+
+    def test_unknown_products_are_not_voted_on(self):
+        with self.assertRaises(Product.DoesNotExist):
+            toggle_vote(self.user, uuid.uuid4(), Like.LIKE)
+        self.assertFalse(Like.objects.exists())
+
+    def test_repaired_counts_get_new_stamps(self):
+        Product.objects.filter(pk=self.product.pk).update(total_likes=7)
+        stamp = fragments.versions([self.product.pk])[self.product.pk]
+        reconcile_likes()
+        self.assertCounters(0, 0)
+        self.assertNotEqual(fragments.versions([self.product.pk])[self.product.pk], stamp)
+
+
+class FakePaystack(BaseHTTPRequestHandler):
+    """
+    answers each request with the next (status, body) in `responses`
+    """
+    responses = []
+    requests = []
+
+    def _answer(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.requests.append((self.command, self.path, self.rfile.read(length)))
+        status, body = self.responses.pop(0) if self.responses else (200, {'status': True})
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+class PaystackClientTests(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakePaystack)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        FakePaystack.responses = []
+        FakePaystack.requests = []
+        self.metrics = CallMetrics()
+        self.client = PaystackClient('sk_test', self.base_url, backoff=0, metrics=self.metrics,
+                                     breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+        self.addCleanup(self.client.close)
+
+    def test_verify_retries_server_errors(self):
+        FakePaystack.responses = [(503, {}), (200, {'data': {'amount': 500}})]
+        response = self.client.verify_transaction('ref-1')
+        self.assertEqual(response.json()['data']['amount'], 500)
+        self.assertEqual([path for _, path, _ in FakePaystack.requests], ['/transaction/verify/ref-1'] * 2)
+        self.assertEqual(self.metrics.summary()['verify']['calls'], 1)
+
+    def test_initialize_is_not_retried(self):
+        FakePaystack.responses = [(502, {})]
+        response = self.client.initiate_transaction({'reference': 'ref-2'})
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(len(FakePaystack.requests), 1)
+
+    def test_breaker_opens_after_failures(self):
+        closed = PaystackClient('sk_test', 'http://127.0.0.1:1', retries=0, metrics=self.metrics,
+                                breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+        for _ in range(2):
+            with self.assertRaises(PaystackError):
+                closed.verify_transaction('ref-3')
+        with self.assertRaises(PaystackUnavailable):
+            closed.verify_transaction('ref-3')
+        self.assertEqual(self.metrics.summary()['verify']['errors'], 2)
+
+
+class PaymentWebhookTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('payer@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Runner', description='light shoe', inventory=5)
+        cls.order = Order.objects.create(user=cls.user, total_amount=1000, expected_amount=100000)
+        cls.order.order_items.create(product=cls.product, quantity=2)
+
+    def post_event(self, amount=100000, secret='sk_test', event='charge.success', **data):
+        data = {'id': 42, 'status': 'success', 'amount': amount, 'reference': self.order.order_number, **data}
+        body = json.dumps({'event': event, 'data': data}).encode()
+        signature = hmac.new(secret.encode(), body, hashlib.sha512).hexdigest()
+        return self.client.post(reverse('store:paystack-webhook'), body, content_type='application/json',
+                                HTTP_X_PAYSTACK_SIGNATURE=signature)
+
+    @override_settings(PAYSATCK_SECRETE_KEY='sk_test')
+    def test_replayed_event_decrements_once(self):
+        self.assertEqual(self.post_event().status_code, 200)
+        self.assertEqual(self.post_event().status_code, 200)
+        self.assertEqual(Job.objects.filter(task='store.process_payment_event').count(), 1)
+        queue.process(task_names=['store.process_payment_event'])
+        queue.process(task_names=['store.process_payment_event'])
+        compact()
+
+        self.product.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.product.inventory, 3)
+        self.assertEqual(self.order.payment_status, 'PAID')
+
+    @override_settings(PAYSATCK_SECRETE_KEY='sk_test')
+    def test_rejects_bad_signature_and_wrong_amount(self):
+        self.assertEqual(self.post_event(secret='forged').status_code, 401)
+        self.post_event(amount=100)
+        queue.process(task_names=['store.process_payment_event'])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'AMOUNT_MISMATCH')
+
+    @override_settings(PAYSATCK_SECRETE_KEY='')
+    def test_rejects_every_event_without_a_secret(self):
+        self.assertEqual(self.post_event(secret='').status_code, 401)
+        self.assertFalse(PaymentEvent.objects.exists())
+
+    @override_settings(PAYSATCK_SECRETE_KEY='sk_test')
+    def test_rejects_events_without_an_id_or_reference(self):
+        self.assertEqual(self.post_event(id=None, reference=None).status_code, 400)
+        self.assertEqual(self.post_event(event='').status_code, 400)
+        self.assertFalse(PaymentEvent.objects.exists())
+
+    @override_settings(PAYSATCK_SECRETE_KEY='sk_test')
+    def test_success_without_a_reference_or_amount_is_logged_and_done(self):
+        self.post_event(reference=None)
+        self.post_event(id=43, amount='lots')
+        with self.assertLogs('store.payments', 'ERROR'):
+            queue.process(task_names=['store.process_payment_event'])
+        self.assertFalse(PaymentEvent.objects.filter(processed_at=None).exists())
+        self.assertFalse(Job.objects.exclude(status=Job.DONE).exists())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'UNPAID')
+
+    @override_settings(PAYSATCK_SECRETE_KEY='sk_test')
+    def test_failed_charge_fails_the_order_and_releases_its_holds(self):
+        size = Size.objects.create(product=self.product, size='42', quantity=5)
+        Reservation.objects.create(size=size, order=self.order, quantity=2,
+                                   expires_at=timezone.now() + timedelta(minutes=15))
+        self.assertEqual(self.post_event(event='charge.failed', id=43, status='failed').status_code, 200)
+        queue.process(task_names=['store.process_payment_event'])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'FAILED')
+        self.assertFalse(Reservation.objects.filter(order=self.order).exists())
+
+        # the buyer retried and paid, the money counts
+        self.post_event()
+        queue.process(task_names=['store.process_payment_event'])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'PAID')
+
+    def test_callback_reports_a_failed_charge(self):
+        self.client.force_login(self.user)
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {'status': True, 'data': {'status': 'abandoned'}}
+        with mock.patch('store.views.verify_transaction', return_value=response):
+            page = self.client.get(reverse('store:callback'), {'reference': self.order.order_number})
+        self.assertRedirects(page, reverse('store:cart'), fetch_redirect_response=False)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'FAILED')
+
+    def test_callback_waits_for_the_webhook_when_paystack_is_down(self):
+        self.client.force_login(self.user)
+        with mock.patch('store.views.verify_transaction', side_effect=PaystackUnavailable('open')):
+            page = self.client.get(reverse('store:callback'), {'reference': self.order.order_number})
+        self.assertRedirects(page, reverse('store:order-list'), fetch_redirect_response=False)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, 'UNPAID')
+
+
+class PlaceOrderTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('cart@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.products = [Product.objects.create(name=f'Shoe {i}', description='shoe', unit_price=100 * (i + 1),
+                                               inventory=10)
+                        for i in range(12)]
+
+    def fill_cart(self, count):
+        CartItem.objects.filter(user=self.user).delete()
+        for product in self.products[:count]:
+            CartItem.objects.create(user=self.user, product=product, quantity=2, size='42')
+
+    def test_query_count_is_flat(self):
+        self.fill_cart(2)
+        with self.assertNumQueries(6) as small:
+            place_order(self.user, 'somewhere')
+
+        self.fill_cart(12)
+        with self.assertNumQueries(len(small.captured_queries)):
+            order = place_order(self.user, 'somewhere')
+        self.assertEqual(order.total_amount, sum(200 * (i + 1) for i in range(12)))
+        self.assertEqual(order.expected_amount, order.total_amount * 100)
+        self.assertEqual(order.order_items.count(), 12)
+        self.assertEqual(ProductCard.objects.get(pk=self.products[0].pk).units_sold, 4)
+
+
+class CommitStockTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('stock@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.products = [Product.objects.create(name=f'Boot {i}', description='boot', inventory=5) for i in range(6)]
+        for product in cls.products:
+            Size.objects.create(product=product, size='42', quantity=3)
+
+    def order_of(self, count, quantity):
+        order = Order.objects.create(user=self.user, total_amount=0)
+        return [order.order_items.create(product=product, quantity=quantity, size='42')
+                for product in self.products[:count]]
+
+    def test_statement_count_is_flat(self):
+        small, large = self.order_of(1, 1), self.order_of(6, 1)
+        with self.assertNumQueries(5) as queries:
+            commit_stock(small)
+        with self.assertNumQueries(len(queries.captured_queries)):
+            commit_stock(large)
+        compact()
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).inventory, 3)
+        self.assertEqual(Size.objects.get(product=self.products[0]).quantity, 1)
+
+    def test_oversell_rolls_back_and_reports_lines(self):
+        items = self.order_of(2, 1)
+        items[1].quantity = 4
+        with self.assertRaises(OutOfStock) as raised:
+            commit_stock(items)
+        self.assertEqual(raised.exception.shortages, [Shortage(self.products[1].pk, '42', 4, 3)])
+        self.assertEqual(Size.objects.get(product=self.products[0]).quantity, 3)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).inventory, 5)
+
+    def test_sold_out_size_is_deleted(self):
+        commit_stock(self.order_of(1, 3))
+        compact()
+        self.assertFalse(Size.objects.filter(product=self.products[0]).exists())
+
+    def test_uncompacted_sales_count_against_stock(self):
+        commit_stock(self.order_of(1, 2))
+        with self.assertRaises(OutOfStock) as raised:
+            commit_stock(self.order_of(1, 2))
+        self.assertEqual(raised.exception.shortages, [Shortage(self.products[0].pk, '42', 2, 1)])
+
+    @skipUnless(connection.vendor == 'postgresql', "advisory locks are postgres'")
+    def test_checks_under_advisory_locks_not_row_locks(self):
+        with self.assertNumQueries(6) as queries:
+            commit_stock(self.order_of(2, 1))
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertIn('pg_advisory_xact_lock', sql)
+        self.assertNotIn('FOR UPDATE', sql)
+
+
+class ReservationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('hold@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Sandal', description='sandal', inventory=10)
+        cls.size = Size.objects.create(product=cls.product, size='40', quantity=3)
+
+    def order_of(self, quantity):
+        order = Order.objects.create(user=self.user, total_amount=0)
+        order.order_items.create(product=self.product, quantity=quantity, size='40')
+        return order
+
+    def test_holds_count_against_stock_until_they_expire(self):
+        first = self.order_of(2)
+        hold(first)
+        self.assertEqual(available_sizes(self.product.pk).get().available, 1)
+        with self.assertRaises(OutOfStock):
+            hold(self.order_of(2))
+        # the held units can't be sold to another order
+        with self.assertRaises(OutOfStock):
+            commit_stock(list(self.order_of(2).order_items.all()))
+
+        Reservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(available_sizes(self.product.pk).get().available, 3)
+        self.assertEqual(release_expired(), 1)
+
+    def test_payment_turns_hold_into_sale(self):
+        order = self.order_of(2)
+        hold(order)
+        commit_stock(list(order.order_items.all()), order_id=order.pk)
+        self.assertEqual(available_sizes(self.product.pk).get().available, 1)
+        compact()
+        self.assertEqual(Size.objects.get(pk=self.size.pk).quantity, 1)
+
+
+class StockLedgerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('ledger@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Loafer', description='loafer', inventory=2)
+        cls.size = Size.objects.create(product=cls.product, size='41', quantity=2)
+
+    def test_sales_insert_until_compacted(self):
+        order = Order.objects.create(user=self.user, total_amount=0)
+        item = order.order_items.create(product=self.product, quantity=2, size='41')
+        receive(self.product.pk, 1, self.size)
+        commit_stock([item], order_id=order.pk)
+
+        # the counters are untouched until compaction, the ledger has the sale
+        self.assertEqual(Product.objects.get(pk=self.product.pk).inventory, 2)
+        self.assertEqual(available_sizes(self.product.pk).get().available, 1)
+        self.assertEqual(StockMovement.objects.pending().count(), 2)
+
+        self.assertEqual(compact(), 2)
+        self.assertEqual(Product.objects.get(pk=self.product.pk).inventory, 1)
+        self.assertEqual(Size.objects.get(pk=self.size.pk).quantity, 1)
+        self.assertEqual(StockMovement.objects.filter(compacted=True).count(), 2)
+        self.assertEqual(compact(), 0)
+
+    def test_counters_driven_below_zero_are_logged(self):
+        record(self.product.pk, -3, StockMovement.ADJUSTMENT, self.size)
+        with self.assertLogs('store.ledger', 'ERROR') as logs:
+            compact()
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn(f"product.inventory below zero, kept at 0: {{'{self.product.pk}': -1}}", logs.output[0])
+        self.assertEqual(Product.objects.get(pk=self.product.pk).inventory, 0)
+        # sold out, so deleted
+        self.assertFalse(Size.objects.filter(pk=self.size.pk).exists())
+
+    def test_readers_count_pending_movements(self):
+        order = Order.objects.create(user=self.user, total_amount=0)
+        item = order.order_items.create(product=self.product, quantity=2, size='41')
+        CartItem.objects.create(user=self.user, product=self.product, quantity=1, size='41')
+        commit_stock([item], order_id=order.pk)
+
+        # sold out before any compaction, everywhere
+        product = Product.objects.get(pk=self.product.pk)
+        self.assertEqual(product.inventory, 2)
+        self.assertFalse(product.in_stock)
+        self.assertNotIn(product, self.client.get(reverse('store:product-list')).context['products'])
+        self.assertFalse(ProductCard.objects.get(pk=product.pk).in_stock)
+        self.assertEqual(facets.counts()['stock'], {'out': 1})
+        self.assertEqual(cart_summary(self.user).lines, 0)
+        self.assertIsNone(place_order(self.user))
+        # a save of the product keeps its card sold out
+        product.save()
+        self.assertFalse(ProductCard.objects.get(pk=product.pk).in_stock)
+
+        receive(self.product.pk, 1)
+        self.assertTrue(Product.objects.get(pk=self.product.pk).in_stock)
+        self.assertIn(product, self.client.get(reverse('store:product-list')).context['products'])
+
+
+class CartUpsertTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('upsert@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Mule', description='mule', inventory=5)
+        Size.objects.create(product=cls.product, size='39', quantity=2)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def add(self):
+        return self.client.post(reverse('store:add-to-cart', args=[self.product.pk]), {'size': '39'})
+
+    def test_add_is_one_line_capped_at_stock(self):
+        self.add()
+        with self.assertNumQueries(2):
+            change = change_quantity(self.user, self.product.pk, '39', 1, available_stock(self.product.pk, '39'))
+        self.assertEqual((change.quantity, change.limited), (2, False))
+
+        change = change_quantity(self.user, self.product.pk, '39', 1, 2)
+        self.assertEqual((change.quantity, change.limited), (2, True))
+        line = CartItem.objects.get()
+        self.assertEqual(line.quantity, 2)
+
+        url = reverse('store:decrease-cart-item', args=[line.pk])
+        self.client.post(url)
+        self.client.post(url)
+        self.assertEqual(CartItem.objects.get().quantity, 1)
+
+    def test_double_click_adds_twice_without_a_false_limit(self):
+        # both clicks read the stock before either wrote the line
+        available = available_stock(self.product.pk, '39')
+        first = change_quantity(self.user, self.product.pk, '39', 1, available)
+        second = change_quantity(self.user, self.product.pk, '39', 1, available)
+        self.assertEqual([(first.quantity, first.limited), (second.quantity, second.limited)],
+                         [(1, False), (2, False)])
+        self.assertEqual(first.id, second.id)
+
+    def test_decrease_ignores_stock_held_by_others(self):
+        line = CartItem.objects.create(user=self.user, product=self.product, size='39', quantity=2)
+        change = change_quantity(self.user, self.product.pk, '39', -1, 0)
+        self.assertEqual((change.quantity, change.limited), (1, False))
+        change = change_quantity(self.user, self.product.pk, '39', -1, 0)
+        self.assertEqual((change.id, change.quantity, change.limited), (line.pk, 1, True))
+
+
+    def test_decrease_of_a_removed_line_doesnt_start_it_again(self):
+        line = CartItem.objects.create(user=self.user, product=self.product, size='39', quantity=2)
+        url = reverse('store:decrease-cart-item', args=[line.pk])
+        line.delete()
+        self.client.post(url)
+        self.assertIsNone(change_quantity(self.user, self.product.pk, '39', -1, 2))
+        self.assertFalse(CartItem.objects.exists())
+
+class CartSummaryTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('summary@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.products = [Product.objects.create(name=f'Clog {i}', description='clog', unit_price=250, inventory=5)
+                        for i in range(3)]
+        for product in cls.products:
+            Size.objects.create(product=product, size='38', quantity=5)
+
+    def test_one_aggregate_then_cached_until_a_write(self):
+        for product in self.products:
+            CartItem.objects.create(user=self.user, product=product, size='38', quantity=2)
+
+        # the lines' products, for their stamps, and the totals
+        with self.assertNumQueries(2):
+            self.assertEqual(cart_summary(self.user), CartSummary(lines=3, quantity=6, total_price=1500))
+        with self.assertNumQueries(0):
+            cart_summary(self.user)
+
+        change_quantity(self.user, self.products[0].pk, '38', 1, available_stock(self.products[0].pk, '38'))
+        self.assertEqual(cart_summary(self.user).total_price, 1750)
+
+        CartItem.objects.filter(product=self.products[1]).delete()
+        self.assertEqual(cart_summary(self.user), CartSummary(lines=2, quantity=5, total_price=1250))
+
+    def test_follows_price_changes(self):
+        CartItem.objects.create(user=self.user, product=self.products[0], size='38', quantity=2)
+        self.assertEqual(cart_summary(self.user).total_price, 500)
+        # another worker's cart cache holds the summary, only the product changes
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.products[0].pk).update(unit_price=300)
+            fragments.bump(self.products[0].pk)
+        self.assertEqual(cart_summary(self.user).total_price, 600)
+
+
+class CartPageTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('page@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+
+    def add_lines(self, count):
+        for _ in range(count):
+            product = Product.objects.create(name='Boot', description='boot', unit_price=100, inventory=9)
+            Product_Image.objects.create(product=product, image='product_image/boot.jpg')
+            Size.objects.create(product=product, size='44', quantity=2)
+            CartItem.objects.create(user=self.user, product=product, size='44')
+
+    def test_query_count_is_flat(self):
+        self.client.force_login(self.user)
+        self.add_lines(1)
+        # the session, the user, the lines, and the summary's stamps and totals
+        with self.assertNumQueries(5) as small:
+            self.client.get(reverse('store:cart'))
+
+        self.add_lines(6)
+        with self.assertNumQueries(len(small.captured_queries)):
+            response = self.client.get(reverse('store:cart'))
+        self.assertEqual(len(response.context['cart_items']), 7)
+
+    def test_lines_whose_card_isnt_built_get_one(self):
+        self.client.force_login(self.user)
+        self.add_lines(1)
+        line = CartItem.objects.get()
+        ProductCard.objects.filter(product=line.product).delete()
+
+        response = self.client.get(reverse('store:cart'))
+        self.assertEqual(response.status_code, 200)
+        card = ProductCard.objects.get(product=line.product)
+        self.assertEqual(response.context['cart_items'][0]['image'], card.thumbnail_url)
+        self.assertTrue(card.thumbnail_url)
+
+    def test_dead_lines_deleted_and_over_quantity_clamped(self):
+        self.add_lines(3)
+        first, second, third = CartItem.objects.order_by('created_at')
+        CartItem.objects.filter(pk=first.pk).update(quantity=5)
+        Size.objects.filter(product=second.product).delete()
+
+        with self.assertNumQueries(4):
+            lines = reconcile_cart(self.user)
+        self.assertEqual([line.pk for line in lines], [first.pk, third.pk])
+        self.assertEqual(CartItem.objects.get(pk=first.pk).quantity, 2)
+        self.assertFalse(CartItem.objects.filter(pk=second.pk).exists())
+
+
+class GuestCartTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('guest@example.com', 'Ada', 'Obi', '08012345678',
+                                            'pass@1234', is_active=True)
+        cls.product = Product.objects.create(name='Slide', description='slide', inventory=9)
+        Size.objects.create(product=cls.product, size='43', quantity=3)
+
+    def test_guest_adds_without_writes_and_merges_on_login(self):
+        url = reverse('store:add-to-cart', args=[self.product.pk])
+        with self.assertNumQueries(1):
+            self.client.post(url, {'size': '43'})
+        self.client.post(url, {'size': '43'})
+        self.assertFalse(CartItem.objects.exists())
+
+        CartItem.objects.create(user=self.user, product=self.product, size='43', quantity=2)
+        self.client.post(reverse('account:login'), {'email': 'guest@example.com', 'password': 'pass@1234'})
+
+        # capped at the size's stock, and the cookie is gone
+        self.assertEqual(CartItem.objects.get().quantity, 3)
+        self.assertEqual(self.client.cookies['guest_cart'].value, '')
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies['guest_cart'] = f'{self.product.pk.hex}:43:5'
+        self.client.force_login(self.user)
+        self.client.get(reverse('store:cart'))
+        self.assertFalse(CartItem.objects.exists())
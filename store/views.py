@@ -1,50 +1,118 @@
+import json
 import os
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Q
+from django.db.models import prefetch_related_objects
 from django.http import Http404, HttpResponse
-from django.shortcuts import render, redirect
+from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse_lazy
 from django.views import View
 from django.views.generic import ListView, DetailView
+from django.utils.functional import SimpleLazyObject
 from django.utils.text import gettext_lazy as _
-from store.models import Product, CartItem, Review, Order, OrderItem, Size
+from store.models import Product, CartItem, Review, Order, OrderItem, Size, Like
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.contrib import messages
-from .paystack import initiate_transaction, verify_transaction
-from functools import reduce
-
-
-class ProductListView(ListView):
+from .paystack import PaystackError, initiate_transaction, verify_transaction
+from .payments import FAILED_STATUSES, fail_payment, record_event, valid_signature
+from .search import get_search_backend
+from .conditional import ConditionalGetMixin
+from .page_cache import AnonymousPageCacheMixin
+from .pagination import KeysetPaginationMixin, KeysetPaginator
+from .votes import toggle_vote
+from .orders import place_order
+from .reservations import hold
+from . import cards, catalog_index, facets, fragments, guest_cart, ledger
+from .cart import available_stock, cart_summary, change_quantity, reconcile_cart, with_available
+from .stock import OutOfStock
+
+
+class ProductListView(AnonymousPageCacheMixin, ConditionalGetMixin, KeysetPaginationMixin, ListView):
     model = Product
     context_object_name = 'products'
     template_name = 'product_list.html'
     paginate_by = 5
+    keyset_ordering = ('name', 'brand', 'id')
 
-    def get_queryset(self):
-        queryset = super().get_queryset().filter(inventory__gt=0)
+    def get_keyset_ordering(self):
+        # search results are ranked, then fall back to the catalog ordering
+        if self.request.GET.get('q', ''):
+            return ('-search_rank',) + self.keyset_ordering
+        return self.keyset_ordering
 
-        category = self.request.GET.get('category', None)
-        gender = self.request.GET.get('gender', None)
+    def get_page_query_params(self):
+        # `to` only picks the template of the first request
+        params = self.request.GET.copy()
+        params.pop('to', None)
+        return params
+
+    def get_queryset(self):
+        # cards carry everything the list templates show, so a page is one query
+        queryset = super().get_queryset().select_related('card')
         search_query = self.request.GET.get('q', '')
 
+        self.facet_selection = facets.selection(self.request.GET)
+        self.index_selection = None
+        if self.facet_selection and not search_query and catalog_index.index.loaded:
+            # filter combinations are resolved in the worker's bitmaps, see catalog_index.py
+            self.index_selection = {'stock': [facets.IN_STOCK], **self.facet_selection}
+            return queryset
 
-        if category and gender:
-            queryset = queryset.filter(categories__name__iexact=category, genders__sex__iexact=gender)
+        if 'stock' not in self.facet_selection:
+            # sold out products are only listed when asked for
+            queryset = ledger.in_stock(queryset)
+        queryset = facets.filter_products(queryset, self.facet_selection)
 
         if search_query:
-            queryset = queryset.filter(
-                Q(name__icontains=search_query) |
-                Q(description__icontains=search_query) |
-                Q(brand__icontains=search_query)
-            )
+            queryset = get_search_backend().search(queryset, search_query)
 
         return queryset
+
+    def get_keyset_paginator(self, queryset, page_size):
+        if self.index_selection is None:
+            return super().get_keyset_paginator(queryset, page_size)
+        return catalog_index.IndexPaginator(queryset, page_size, self.keyset_ordering, self.index_selection,
+                                            cursor_query_param=self.page_kwarg)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         # context['categories'] = Category.objects.all()  # Assuming you have a Category model
         context['search_query'] = self.request.GET.get('q', '')  # Add the search query to the context
+        # the version stamps of the page's cached cards in one cache round trip
+        context['fragment_versions'] = fragments.versions(product.pk for product in context['products'])
+        context['facets'] = self.get_facets()
         return context
+
+    def get_facets(self) -> list:
+        """
+        the facet values with their counts among the listed products, and
+        the query strings that toggle them
+        """
+        if self.index_selection is not None:
+            # matched again, the page may have dropped deleted products from the index
+            found = catalog_index.index.counts(catalog_index.index.matches(self.index_selection))
+        elif self.facet_selection or self.request.GET.get('q', ''):
+            found = facets.counts(self.object_list)
+        else:
+            found = facets.counts()
+        params = self.get_page_query_params()
+        params.pop(self.page_kwarg, None)
+
+        groups = []
+        for facet, values in found.items():
+            selected = self.facet_selection.get(facet, [])
+            entries = []
+            for value, count in values.items():
+                toggled = params.copy()
+                toggled.setlist(facet, [other for other in selected if other != value] +
+                                ([] if value in selected else [value]))
+                entries.append({'value': value, 'count': count, 'selected': value in selected,
+                                'querystring': toggled.urlencode()})
+            groups.append({'name': facet, 'values': entries})
+        return groups
+
     def get_template_names(self):
         if self.request.htmx and self.request.GET.get('to', None) == 'home':
             return ['partials/home_partial.html']
@@ -53,10 +121,26 @@ class ProductListView(ListView):
         return [self.template_name]
 
     def get(self, request, *args, **kwargs):
+        if self.page_cacheable():
+            # anonymous visitors share one copy of the page, see page_cache.py
+            version = fragments.catalog_version()
+            return self.conditional_response({'catalog': version},
+                                             lambda: self.cached_page(version, self.render_list),
+                                             extra=[self.get_page_key(version)])
+
+        context = self.get_list_context()
+        page = context['page_obj']
+        # the facet counts change with any product
+        extra = [fragments.catalog_version()]
+        if page is not None:
+            extra += [page.next_cursor, page.previous_cursor]
+        return self.conditional_response(context['fragment_versions'], lambda: self.render_to_response(context),
+                                         extra=extra)
+
+    def get_list_context(self):
         self.object_list = self.get_queryset()
-        allow_empty = self.get_allow_empty()
 
-        if not allow_empty:
+        if not self.get_allow_empty():
             if self.get_paginate_by(self.object_list) is not None:
                 # When paginate_by is specified, we check whether there are any items to paginate.
                 is_empty = not self.object_list.exists()
@@ -64,18 +148,17 @@ class ProductListView(ListView):
                 is_empty = not self.object_list
 
             if is_empty:
-                # Display empty list if it is allowed.
-                if not self.get_allow_empty():
-                    raise Http404(_("Empty list and '%(class_name)s.allow_empty' is False.")
-                                  % {'class_name': self.__class__.__name__})
-                return self.render_to_response(self.get_context_data())
+                raise Http404(_("Empty list and '%(class_name)s.allow_empty' is False.")
+                              % {'class_name': self.__class__.__name__})
+
+        return self.get_context_data()
 
-        context = self.get_context_data()
-        return self.render_to_response(context)
+    def render_list(self):
+        return self.render_to_response(self.get_list_context())
 
 
 
-class ProductDetailView(DetailView):
+class ProductDetailView(AnonymousPageCacheMixin, ConditionalGetMixin, DetailView):
     model = Product
     context_object_name = 'product'
     # template_name = 'partials/product_detail_partial.html'  # Default template for htmx requests
@@ -86,56 +169,112 @@ class ProductDetailView(DetailView):
             return ['partials/product_detail_partial.html']  # Template for htmx requests
         return ['product_detail.html']  # Template for non-htmx requests
 
+    def get_queryset(self):
+        # with its stock, for the add to cart form
+        return ledger.with_stock(Product.objects.for_detail_page())
+
+    def get(self, request, *args, **kwargs):
+        # a revalidation is answered from the version stamp alone, before the product is read
+        product_id = self.kwargs[self.pk_url_kwarg]
+        versions = fragments.versions([product_id])
+
+        def render_page():
+            return super(ProductDetailView, self).get(request, *args, **kwargs)
+
+        if self.page_cacheable():
+            version = versions[product_id]
+            return self.conditional_response(versions, lambda: self.cached_page(version, render_page),
+                                             extra=[self.get_page_key(version)])
+        return self.conditional_response(versions, render_page)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        
-        context['user_has_reviewed'] = context['has_liked'] = context['has_disliked'] = context['user_has_bought'] = None
 
-        
-        if self.request.user.is_authenticated:
-            context['user_has_reviewed'] = self.object.reviews.filter(user=self.request.user).exists()
-            context['has_liked'] = self.object.likes.filter(user=self.request.user, like=True).exists()
-            context['has_disliked'] = self.object.likes.filter(user=self.request.user, dislike=True).exists()
-            context['user_has_bought'] = Order.objects.filter(user=self.request.user,
-                                                              payment_status__iexact="PAID",
-                                                              order_items__product=self.object).exists()
-            print(context['user_has_bought'])
-        context['total_likes'] = self.object.likes.filter(like=True).count()
-        context['total_dislikes'] = self.object.likes.filter(dislike=True).count()
-        
+        # the viewer's own flags are loaded after the page, see ProductViewerView
+        context['total_likes'] = self.object.total_likes
+        context['total_dislikes'] = self.object.total_dislikes
+
+        paginator = KeysetPaginator(review_feed(self.object.pk), REVIEWS_PER_PAGE, REVIEW_FEED_ORDERING)
+        # only read when the cached reviews fragment has to be rendered
+        context['review_page'] = SimpleLazyObject(lambda: paginator.page(None))
+
         return context
 
+class ProductViewerView(View):
+    """
+    the viewer's vote and, once they bought the product, the review form,
+    loaded by the detail page after it so the page is the same for everyone
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return HttpResponse()
+        product = get_object_or_404(Product.objects.with_viewer_flags(request.user)
+                                    .only('id', 'total_likes', 'total_dislikes'), pk=self.kwargs.get('product_id'))
+        context = {'product': product,
+                   'total_likes': product.total_likes,
+                   'total_dislikes': product.total_dislikes}
+        for flag in ('user_has_reviewed', 'has_liked', 'has_disliked', 'user_has_bought'):
+            context[flag] = getattr(product, flag)
+        return render(request, 'partials/product_viewer_partial.html', context)
+
 class AddToCartView(View):
     def post(self, request, *args, **kwargs):
-        if not self.request.user.is_authenticated:
-            login_url = reverse('account:login')  + f'?next={self.request.path.replace("add_to_cart/", "")}'
-            response = HttpResponse(status=200)
-            response['HX-Location'] = login_url
-            return response
         product_id = self.kwargs.get('product_id')
         size = request.POST.get('size')
 
-        # if that product is already in the user's cart, just raise its quantity
-        # by one
-        if CartItem.objects.filter(user=request.user, product_id=product_id, size=size).exists():
-            cart_item = CartItem.objects.get(user=request.user, product_id=product_id, size=size)
-            # ensure that the quantity does not exceed the product's inventory for that size
-            if cart_item.quantity + 1 > cart_item.product.sizes.get(size=size).quantity:
+        if not self.request.user.is_authenticated:
+            # visitors get a cookie cart, merged into their cart when they log in
+            lines = guest_cart.read(request)
+            if not guest_cart.add(lines, product_id, size or '', available_stock(product_id, size)):
                 messages.error(request, _("Not enough inventory"))
                 return render(request, 'partials/flash_message_partial.html')
-            else:
-                cart_item.quantity += 1
-                cart_item.save(update_fields=['quantity'])
-        else:
-            CartItem.objects.create(
-                product_id=product_id,
-                size=size,
-                user=request.user
-            )
+            messages.success(request, _("Added to cart"))
+            response = render(request, 'partials/flash_message_partial.html')
+            guest_cart.write(response, lines)
+            return response
+
+        # add one unit, or start the line, without going past the size's stock
+        change = change_quantity(request.user, product_id, size, 1, available_stock(product_id, size))
+        if change is None or change.limited:
+            messages.error(request, _("Not enough inventory"))
+            return render(request, 'partials/flash_message_partial.html')
         messages.success(request, _("Added to cart"))
         return render(request, 'partials/flash_message_partial.html')
 
 
+REVIEWS_PER_PAGE = 10
+REVIEW_FEED_ORDERING = ('-created_at', '-id')
+
+
+def review_feed(product_id):
+    """
+    the reviews of a product newest first, with their authors joined and
+    their images fetched in one batch per page
+    """
+    return (Review.objects.filter(product_id=product_id)
+            .select_related('user')
+            .prefetch_related('reviews'))
+
+
+class ReviewListView(KeysetPaginationMixin, ListView):
+    """
+    pages of the review feed, loaded by the infinite scroll sentinel
+    """
+    context_object_name = 'reviews'
+    template_name = 'partials/review_feed_partial.html'
+    paginate_by = REVIEWS_PER_PAGE
+    keyset_ordering = REVIEW_FEED_ORDERING
+
+    def get_queryset(self):
+        return review_feed(self.kwargs.get('product_id'))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['product_id'] = self.kwargs.get('product_id')
+        return context
+
+
 class ReviewCreateView(LoginRequiredMixin, View):
     def post(self, request, *args, **kwargs):
         product_id = self.kwargs.get('product_id')
@@ -145,153 +284,91 @@ class ReviewCreateView(LoginRequiredMixin, View):
             review=review,
             user=request.user
         )
-        product = Product.objects.get(id=product_id)
-        product.save(update_fields=['total_reviews'])
-        reviews = Review.objects.filter(product_id=product_id)
-        return render(request, 'partials/review_partial.html', {'reviews': reviews, 'product': product})
+        # only the new review is rendered, swapped in at the top of the feed
+        review.user = request.user
+        prefetch_related_objects([review], 'reviews')
+        product = Product.objects.only('id', 'total_reviews').get(id=product_id)
+        return render(request, 'partials/review_partial.html', {'review': review, 'product': product})
 
 
-class ToggleLikeView(View):
-    def post(self, request, *args, **kwargs):
-        
-        if not self.request.user.is_authenticated:
-            login_url = reverse('account:login')  + f'?next={self.request.path.replace("toggle_like/", "")}'
-            response = HttpResponse(status=200)
-            response['HX-Location'] = login_url
-            return response
-        product_id = self.kwargs.get('product_id')
-        product = Product.objects.get(id=product_id)
-        
-        # check if a record already exists for the user
-        if product.likes.filter(user=request.user).exists():
-            # if the user has already liked the product, unlike it
-            if product.likes.filter(user=request.user, like=True).exists():
-                product.likes.filter(user=request.user).update(like=False, dislike=None)
-            # if the user has unliked the product, like it
-            else:
-                product.likes.filter(user=request.user).update(like=True, dislike=None)
-        else:
-            product.likes.create(user=request.user, like=True, dislike=None)
-            
-        context = {'total_likes': product.likes.filter(like=True).count(),
-                   'total_dislikes': product.likes.filter(dislike=True).count(),
-                   'has_liked': product.likes.filter(user=request.user, like=True).exists(),
-                   'has_disliked': product.likes.filter(user=request.user, dislike=True).exists(),
-                   'product': product}
-        print('Toggle like view called')
-        return render(request, 'partials/likes_partial.html', context=context)
+class ToggleVoteView(View):
+    """
+    casts or clears the user's vote on a product and re-renders the counts
+    """
+    vote = None
 
-class ToggleDislikeView(View):
     def post(self, request, *args, **kwargs):
         if not self.request.user.is_authenticated:
-            login_url = reverse('account:login')  + f'?next={self.request.path.replace("toggle_dislike/", "")}'
+            login_url = reverse('account:login')  + f'?next={self.request.path.rsplit("/", 2)[0]}/'
             response = HttpResponse(status=200)
             response['HX-Location'] = login_url
             return response
-        product_id = self.kwargs.get('product_id')
-        product = Product.objects.get(id=product_id)
-        
-        # check if a record already exists for the user
-        if product.likes.filter(user=request.user).exists():
-            # if the user has already disliked the product, remove the dislike
-            if product.likes.filter(user=request.user, dislike=True).exists():
-                product.likes.filter(user=request.user).update(dislike=False, like=None)
-            # if the user has removed the dislike, dislike the product
-            else:
-                product.likes.filter(user=request.user).update(dislike=True, like=None)
-        else:
-            product.likes.create(user=request.user, dislike=True, like=None)
-            
-        context = {'total_likes': product.likes.filter(like=True).count(),
-                   'total_dislikes': product.likes.filter(dislike=True).count(),
-                   'has_liked': product.likes.filter(user=request.user, like=True).exists(),
-                   'has_disliked': product.likes.filter(user=request.user, dislike=True).exists(),
-                   'product': product}
-        return render(request, 'partials/likes_partial.html', context=context)
+        result = toggle_vote(request.user, self.kwargs.get('product_id'), self.vote)
 
-class CartView(LoginRequiredMixin, View):
-    def get(self, request, *args, **kwargs):
-        cart_items = CartItem.objects.filter(user=request.user).select_related('product')
+        context = {'total_likes': result.product.total_likes,
+                   'total_dislikes': result.product.total_dislikes,
+                   'has_liked': result.has_liked,
+                   'has_disliked': result.has_disliked,
+                   'product': result.product}
+        return render(request, 'partials/likes_partial.html', context=context)
 
-        cart_item_with_images = []
-        total_price = 0
 
-        for cart_item in cart_items:
-            # ensure each cart Item doesn't exceed the product's inventory
-            if cart_item.product.sizes.filter(size=cart_item.size).exists():
-                print("It exists")
-                if cart_item.quantity > cart_item.product.sizes.get(size=cart_item.size).quantity:
-                    cart_item.save(update_fields=['quantity'])
-            else:
-                # delete that item from the cart
-                cart_item.delete()
+class ToggleLikeView(ToggleVoteView):
+    vote = Like.LIKE
 
-        cart_items = CartItem.objects.filter(user=request.user).select_related('product')
 
-        for cart_item in cart_items:
+class ToggleDislikeView(ToggleVoteView):
+    vote = Like.DISLIKE
 
-            cart_item_with_images.append({
-                'cart_item': cart_item,
-                'image': cart_item.product.images.first().image.url
-            })
-            total_price += cart_item.total_price
+class CartView(LoginRequiredMixin, View):
+    def get(self, request, *args, **kwargs):
+        # one query for the lines and their stock, then bulk fixes of the lines stock changed under
+        cart_item_with_images = [{'cart_item': cart_item, 'image': cards.card(cart_item.product).thumbnail_url}
+                                 for cart_item in reconcile_cart(request.user)]
+        total_price = cart_summary(request.user).total_price
         return render(request, 'cart.html', {'cart_items': cart_item_with_images, 'total_price': total_price})
     
 
-class IncreaseQuantityView(LoginRequiredMixin, View):
+class ChangeQuantityView(LoginRequiredMixin, View):
+    """
+    moves a cart line's quantity by `delta` with one upsert
+    """
+    delta = 0
+    limited_message = None
+    limited_level = messages.ERROR
+
     def post(self, request, *args, **kwargs):
         cart_item_id = self.kwargs.get('cart_item_id')
-        cart_item = CartItem.objects.get(id=cart_item_id)
-        if cart_item.quantity + 1 > cart_item.product.sizes.get(size=cart_item.size).quantity:
-            messages.error(request, _("Not enough inventory"))
+        cart_item = get_object_or_404(with_available(CartItem.objects.select_related('product')),
+                                      id=cart_item_id, user=request.user)
+        change = change_quantity(request.user, cart_item.product_id, cart_item.size, self.delta,
+                                 cart_item.available or 0)
+        if change is None or change.limited:
+            messages.add_message(request, self.limited_level, self.limited_message)
             return render(request, 'partials/flash_message_partial.html')
-        cart_item.quantity += 1
-        cart_item.save(update_fields=['quantity'])
-        cart_items = CartItem.objects.filter(user=request.user, product__inventory__gt=0)
-        
-        total_price = 0
-        for _cart_item in cart_items:
-            total_price += _cart_item.total_price
+        cart_item.quantity = change.quantity
 
-        updated_cart_item = CartItem.objects.get(id=cart_item_id)
-        context = {'total_price': total_price, 'cart_item': updated_cart_item}
+        context = {'total_price': cart_summary(request.user).total_price, 'cart_item': cart_item}
         
         return render(request, 'partials/checkout_partial.html', context=context)
-        
 
-class DecreaseQuantityView(LoginRequiredMixin, View):
-    def post(self, request, *args, **kwargs):
-        cart_item_id = self.kwargs.get('cart_item_id')
-        cart_item = CartItem.objects.get(id=cart_item_id)
-        if cart_item.quantity - 1 < 1:
-            messages.warning(request, _("Minimum quantity is 1"))
-            return render(request, 'partials/flash_message_partial.html')
-        
-        cart_item.quantity -= 1
-        cart_item.save(update_fields=['quantity'])
-        cart_items = CartItem.objects.filter(user=request.user, product__inventory__gt=0)
-        
-        total_price = 0
-        for _cart_item in cart_items:
-            total_price += _cart_item.total_price
 
-        updated_cart_item = CartItem.objects.get(id=cart_item_id)
-        context = {'total_price': total_price, 'cart_item': updated_cart_item}
-        
-        return render(request, 'partials/checkout_partial.html', context=context)
+class IncreaseQuantityView(ChangeQuantityView):
+    delta = 1
+    limited_message = _("Not enough inventory")
+
+
+class DecreaseQuantityView(ChangeQuantityView):
+    delta = -1
+    limited_message = _("Minimum quantity is 1")
+    limited_level = messages.WARNING
 
 
 class DeleteCartItemView(LoginRequiredMixin, View):
     def delete(self, request, *args, **kwargs):
         cart_item_id = self.kwargs.get('cart_item_id')
-        cart_item = CartItem.objects.get(id=cart_item_id)
-        cart_item.delete()
-        
-        total_price = 0
-        cart_items = CartItem.objects.filter(user=request.user)
-        for _cart_item in cart_items:
-            total_price += _cart_item.total_price
-        
+        CartItem.objects.filter(id=cart_item_id, user=request.user).delete()
+        total_price = cart_summary(request.user).total_price
         return render(request, 'partials/total_price_partial.html', {'total_price': total_price, 'cart_item_id': cart_item_id})
 
 @login_required
@@ -299,37 +376,38 @@ def shippingAddressView(request):
     if request.method == 'POST':
         address = request.POST.get('address')
 
-        user_cart_items = CartItem.objects.filter(user=request.user, product__inventory__gt=0)
-        total_price = 0
-
-        # check if this user has items in their cart
-        if user_cart_items:
-            for _cart_item in user_cart_items:
-                total_price += _cart_item.total_price
-            # create an order with this address
-            order = Order.objects.create(user=request.user, total_amount=total_price,
-                                         shipping_address=address)
+        # create an order with this address if this user has items in their cart
+        order = place_order(request.user, address)
+        if order is not None:
             order_number = order.order_number
 
-            #create order_items for each of the cart_items
-            for _cart_item in user_cart_items:
-                print(_cart_item.size)
-                order.order_items.create(product=_cart_item.product, quantity=_cart_item.quantity,
-                                      unit_price=_cart_item.product.unit_price, total_price=_cart_item.total_price,
-                                      size=_cart_item.size)
-
-            response = initiate_transaction({
-                "email": str(request.user.email),
-                "amount": str(total_price * 100),
-                "currency": "NGN",
-                "callback_url": f"{os.environ.get('HOST')}/store/callback_url",
-                "reference": str(order_number)
-            })
+            # hold the units while the buyer pays
+            try:
+                hold(order)
+            except OutOfStock:
+                order.delete()
+                messages.error(request, _("Some sizes in your cart have just sold out"))
+                return redirect(reverse('store:cart'))
+
+            try:
+                response = initiate_transaction({
+                    "email": str(request.user.email),
+                    "amount": str(order.expected_amount),
+                    "currency": "NGN",
+                    "callback_url": f"{os.environ.get('HOST')}/store/callback_url",
+                    "reference": str(order_number)
+                })
+            except PaystackError:
+                order.delete()
+                messages.error(request, _("We couldn't reach the payment provider, try again shortly"))
+                return redirect(reverse('store:cart'))
 
             if response.status_code == 200:
                 return redirect(response.json()["data"]["authorization_url"])
             else:
                 return HttpResponse("status code:", response.status_code)
+        messages.warning(request, _("There is nothing in stock in your cart"))
+        return redirect(reverse('store:cart'))
 
 
     if request.method == 'GET':
@@ -338,58 +416,59 @@ def shippingAddressView(request):
         return response
 
 
-def update_inventory(cart_item):
-    product = cart_item.product
-    product.inventory -= cart_item.quantity
-    product.save(update_fields=['inventory'])
-    return cart_item
-
-def update_sizes(cart_item):
-    '''
-    update the product's size quantity
-    '''
-    if cart_item.size:
-        size_obj = Size.objects.get(product=cart_item.product, size__iexact=cart_item.size)
-        size_obj.quantity -= cart_item.quantity
-
-        # if there is no more stock for that size, delete it  
-        if not size_obj.quantity:
-            size_obj.delete()
-        else:
-             new = size_obj.save(update_fields=['quantity'])
-
-    return cart_item
-
 @login_required
 def callback(request):
+    """
+    where paystack sends the buyer back; the webhook confirms the payment,
+    so this reports the order's payment state, asking paystack whether a
+    charge we haven't heard about failed
+    """
     reference = request.GET.get('reference')
-    response = verify_transaction(reference)
-    total_price = reduce(lambda acc, cart_item: acc + cart_item.total_price,
-                         CartItem.objects.filter(user=request.user, product__inventory__gt=0), 0)
-
-    if (response.status_code == 200) and (total_price * 100 == response.json()['data']['amount']):
-
-        # reduce each product's inventory accordingly and the product's size quantity
-        list(map(update_inventory, CartItem.objects.filter(user=request.user)))
-        list(map(update_sizes, CartItem.objects.filter(user=request.user)))
-
-        # clear this user's cart
-        CartItem.objects.filter(user=request.user).delete()
-        # TODO send an email to the user and admin concerning the payment
-        # set the user's payment status to paid
-        Order.objects.filter(order_number=reference).update(payment_status='PAID')
+    order = Order.objects.filter(order_number=reference, user=request.user).only('payment_status').first()
+    if order is None:
+        raise Http404(_("No such order"))
+
+    if order.payment_status == 'UNPAID':
+        try:
+            response = verify_transaction(reference)
+            if response.status_code == 200 and response.json()['data']['status'] in FAILED_STATUSES:
+                order.payment_status = fail_payment(reference)
+        except (PaystackError, ValueError, KeyError, TypeError):
+            # the webhook will tell
+            pass
+
+    if order.payment_status == 'PAID':
         messages.success(request, _("Payment successful!"))
         return redirect(reverse('store:product-list'))
-    else:
-        # the payment was unsuccessful
-        Order.objects.filter(order_number=reference).delete()
-        messages.error(request, "Something went wrong")
-        return redirect(reverse('store:shipping-address'))
+    if order.payment_status == 'UNPAID':
+        messages.info(request, _("We are confirming your payment, your order will be marked paid shortly"))
+        return redirect(reverse('store:order-list'))
+    if order.payment_status == 'FAILED':
+        messages.error(request, _("Your payment didn't go through, your cart is as you left it"))
+        return redirect(reverse('store:cart'))
+    messages.error(request, "Something went wrong")
+    return redirect(reverse('store:shipping-address'))
+
+
+@csrf_exempt
+@require_POST
+def paystack_webhook(request):
+    """
+    receives paystack's signed events; processing happens in the jobs worker
+    """
+    if not valid_signature(request.body, request.headers.get('X-Paystack-Signature', '')):
+        return HttpResponse(status=401)
+    try:
+        record_event(json.loads(request.body))
+    except ValueError:
+        # not json, or an event that can't be told apart from others
+        return HttpResponse(status=400)
+    return HttpResponse(status=200)
 
 @login_required
 def checkout(request):
     cart_items = CartItem.objects.filter(user=request.user)
-    if cart_items.filter(product__inventory=0).exists():
+    if ledger.with_stock(cart_items, 'product').filter(stock__lte=0).exists():
         messages.warning(request, _("Some products are out of stock!"))
         return render(request, 'partials/flash_message_partial.html')
     if cart_items.exists():
@@ -401,9 +480,10 @@ def checkout(request):
     return HttpResponse()
 
 
-class OrderListView(LoginRequiredMixin, ListView):
+class OrderListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = OrderItem
     paginate_by = 5
+    keyset_ordering = ('created_at', 'id')
     context_object_name = 'order_items'
 
 
@@ -413,6 +493,7 @@ class OrderListView(LoginRequiredMixin, ListView):
         return ['orders_list.html']  # Template for non-htmx requests
 
     def get_queryset(self):
-        orders = OrderItem.objects.filter(order__user=self.request.user, order__payment_status='PAID')
+        orders = (OrderItem.objects.filter(order__user=self.request.user, order__payment_status='PAID')
+                  .select_related('product__card'))
 
         return orders
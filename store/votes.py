@@ -0,0 +1,150 @@
+"""
+Like/dislike voting.
+
+A vote is a single Like row per user and product whose `vote` column is
+1, 0 or -1. Casting the vote a user already has clears it, so the like and
+dislike buttons toggle. A vote is two statements in one transaction, an
+upsert of the Like row returning the new vote and an update of the
+product's total_likes/total_dislikes by the difference returning the new
+counts:
+
+    WITH old AS (SELECT vote FROM like WHERE user_id = %s AND product_id = %s FOR UPDATE)
+    INSERT INTO like (...) SELECT ... WHERE (SELECT COUNT(*) FROM old) >= 0
+    ON CONFLICT (user_id, product_id) DO UPDATE
+    SET vote = CASE WHEN like.vote = vote THEN 0 ELSE vote END
+    RETURNING vote, created_at = updated_at, (SELECT vote FROM old)
+
+The old vote follows from the new one except when the new one is the vote
+cast, where the row held no vote or the opposite one. Postgres reads it
+in the CTE, under the row lock; SQLite, whose RETURNING sees rows after
+the change and whose writes are serialized anyway, reads it just before.
+"""
+import uuid
+from dataclasses import dataclass
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import fragments
+from .models import Like, Product
+
+
+@dataclass
+class VoteResult:
+    product: Product
+    vote: int
+
+    @property
+    def has_liked(self) -> bool:
+        return self.vote == Like.LIKE
+
+    @property
+    def has_disliked(self) -> bool:
+        return self.vote == Like.DISLIKE
+
+
+def counter_changes(old: int, new: int) -> dict:
+    """
+    F() updates moving the product counters from vote old to vote new
+    """
+    changes = {}
+    likes = (new == Like.LIKE) - (old == Like.LIKE)
+    dislikes = (new == Like.DISLIKE) - (old == Like.DISLIKE)
+    if likes:
+        changes['total_likes'] = F('total_likes') + likes
+    if dislikes:
+        changes['total_dislikes'] = F('total_dislikes') + dislikes
+    return changes
+
+
+def _upsert_sql(lock_old: bool) -> str:
+    quote = connection.ops.quote_name
+    opts = Like._meta
+    table = quote(opts.db_table)
+    column = {name: quote(opts.get_field(name).column)
+              for name in ('id', 'user', 'product', 'vote', 'created_at', 'updated_at')}
+    values = "VALUES (%s, %s, %s, %s, %s, %s)"
+    if lock_old:
+        # the row comes from the old vote's CTE, so it is read (and locked) before the
+        # upsert changes the row, and RETURNING reads it from the CTE's stored rows
+        values = "SELECT %s, %s, %s, %s, %s, %s WHERE (SELECT COUNT(*) FROM old) >= 0"
+    sql = (
+        f"INSERT INTO {table} ({column['id']}, {column['user']}, {column['product']}, {column['vote']}, "
+        f"{column['created_at']}, {column['updated_at']}) "
+        f"{values} "
+        f"ON CONFLICT ({column['user']}, {column['product']}) DO UPDATE "
+        f"SET {column['vote']} = CASE WHEN {table}.{column['vote']} = %s THEN %s ELSE %s END, "
+        f"{column['updated_at']} = EXCLUDED.{column['updated_at']} "
+        # an inserted row has the same timestamps, an updated one keeps its created_at
+        f"RETURNING {column['vote']}, {column['created_at']} = {column['updated_at']}"
+    )
+    if lock_old:
+        sql = (f"WITH old AS (SELECT {column['vote']} FROM {table} "
+               f"WHERE {column['user']} = %s AND {column['product']} = %s FOR UPDATE) "
+               f"{sql}, (SELECT {column['vote']} FROM old)")
+    return sql
+
+
+def _counters_sql() -> str:
+    quote = connection.ops.quote_name
+    opts = Product._meta
+    likes, dislikes = quote(opts.get_field('total_likes').column), quote(opts.get_field('total_dislikes').column)
+    return (f"UPDATE {quote(opts.db_table)} SET {likes} = {likes} + %s, {dislikes} = {dislikes} + %s "
+            f"WHERE {quote(opts.pk.column)} = %s RETURNING {likes}, {dislikes}")
+
+
+def toggle_vote(user, product_id, vote: int) -> VoteResult:
+    """
+    casts vote for the user on the product, or clears it if the user's
+    current vote is already vote
+    raises Product.DoesNotExist for an unknown product
+    """
+    opts = Like._meta
+    now = timezone.now()
+    user_id = opts.get_field('user').get_db_prep_value(user.pk, connection)
+    product = opts.get_field('product').get_db_prep_value(product_id, connection)
+    params = [
+        opts.get_field('id').get_db_prep_value(uuid.uuid4(), connection),
+        user_id,
+        product,
+        vote,
+        opts.get_field('created_at').get_db_prep_value(now, connection),
+        opts.get_field('updated_at').get_db_prep_value(now, connection),
+        vote,
+        Like.NO_VOTE,
+        vote,
+    ]
+    lock_old = connection.vendor == 'postgresql'
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            if lock_old:
+                cursor.execute(_upsert_sql(True), [user_id, product, *params])
+                new, inserted, before = cursor.fetchone()
+            else:
+                before = next(iter(Like.objects.filter(user=user, product_id=product_id)
+                                   .values_list('vote', flat=True)[:1]), None)
+                cursor.execute(_upsert_sql(False), params)
+                new, inserted = cursor.fetchone()
+
+            if inserted:
+                old = Like.NO_VOTE
+            elif new == Like.NO_VOTE:
+                old = vote
+            elif before is not None:
+                old = before
+            else:
+                # a first vote of the user inserted meanwhile, and first votes aren't NO_VOTE
+                old = -vote
+
+            likes = (new == Like.LIKE) - (old == Like.LIKE)
+            dislikes = (new == Like.DISLIKE) - (old == Like.DISLIKE)
+            cursor.execute(_counters_sql(), [likes, dislikes, product])
+            counts = cursor.fetchone()
+        if counts is None:
+            raise Product.DoesNotExist(f"no product {product_id}")
+        # the counts are in cached fragments, and raw sql sends no signals
+        fragments.bump(product_id, catalog=False)
+
+    product = Product(pk=product_id, total_likes=counts[0], total_dislikes=counts[1])
+    return VoteResult(product, new)